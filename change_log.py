@@ -0,0 +1,236 @@
+""" Keeps a log of changes to the member properties that other apps care about,
+so that they can keep their own copies up to date by asking for everything that
+changed since the last time they checked. Every change gets a version number,
+and versions only ever go up.
+
+Writing a member doesn't touch the log itself. Instead, the member gets a new
+change_token in the same write, which marks it as having a change that still
+needs a version. (Deleted members leave a PendingDeletion behind, in the same
+transaction as the delete.) assign_versions() then picks those up in batches,
+so the log root only gets written once per batch, and a member write can never
+be saved without its change eventually showing up. If a member changes more
+than once before we get to it, only their newest values get logged. The maglock
+list gets updated from the same changes, before we forget about them. """
+
+
+import datetime
+import logging
+import uuid
+
+from google.appengine.ext import db
+
+import maglock
+
+
+# The key name of the log root.
+_ROOT_NAME = "changes"
+# How many changes we write in one transaction. (A transaction can write 500
+# entities, and the root is one of them.)
+_BATCH_SIZE = 400
+# The most batches that assign_versions() does in one go.
+_MAX_BATCHES = 10
+# How long we keep changes around.
+MAX_AGE = datetime.timedelta(days=30)
+
+# The member properties that we log changes to.
+TRACKED_PROPERTIES = ("status", "plan", "rfid_tag", "username")
+
+
+""" The root of the log. All the changes are in its entity group, so versions
+get handed out in the same order that changes become visible. """
+class ChangeLogRoot(db.Model):
+  # The version of the newest change.
+  version = db.IntegerProperty(default=0)
+  # The version of the newest change that we've thrown away.
+  pruned_version = db.IntegerProperty(default=0)
+
+
+""" One change to a member. It has the new values of all the tracked
+properties, not just the ones that changed. The key name is made from the member
+ID and the change token, so the same change can never be logged twice. """
+class MemberChange(db.Model):
+  version = db.IntegerProperty(required=True)
+  member_id = db.IntegerProperty(required=True, indexed=False)
+  # Whether the member was deleted.
+  deleted = db.BooleanProperty(default=False, indexed=False)
+  status = db.StringProperty(indexed=False)
+  plan = db.StringProperty(indexed=False)
+  rfid_tag = db.StringProperty(indexed=False)
+  username = db.StringProperty(indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+""" A member that was deleted, but whose deletion hasn't been logged yet. The
+key name is the member ID. """
+class PendingDeletion(db.Model):
+  member_id = db.IntegerProperty(required=True, indexed=False)
+  token = db.StringProperty(required=True, indexed=False)
+  status = db.StringProperty(indexed=False)
+  plan = db.StringProperty(indexed=False)
+  rfid_tag = db.StringProperty(indexed=False)
+  username = db.StringProperty(indexed=False)
+
+
+""" Returns: The key of the log root. """
+def _root_key():
+  return db.Key.from_path("ChangeLogRoot", _ROOT_NAME)
+
+
+""" Gets the values of the tracked properties for a member.
+member: The Membership object.
+Returns: A tuple of the values, in the same order as TRACKED_PROPERTIES. """
+def tracked_values(member):
+  return tuple([getattr(member, prop) for prop in TRACKED_PROPERTIES])
+
+
+""" Returns: A new, unique change token. """
+def new_token():
+  return uuid.uuid4().hex
+
+
+""" Marks a member as deleted, so that the deletion gets logged. This is called
+by Membership, in the same transaction as the delete, so nobody else should need
+to.
+member: The Membership object that is being deleted. """
+def mark_deleted(member):
+  values = dict(zip(TRACKED_PROPERTIES, tracked_values(member)))
+  PendingDeletion(key_name=str(member.key().id()),
+                  member_id=member.key().id(), token=new_token(),
+                  **values).put()
+
+
+""" Gives versions to one batch of pending changes.
+members: The members with pending changes.
+deletions: The PendingDeletion objects.
+Returns: A list of (pending entity, token) tuples for the changes that are now
+in the log. """
+def _log_batch(members, deletions):
+  pending = []
+  for member in members:
+    values = dict(zip(TRACKED_PROPERTIES, tracked_values(member)))
+    pending.append((member, member.key().id(), member.change_token, False,
+                    values))
+  for deletion in deletions:
+    values = dict([(prop, getattr(deletion, prop)) \
+                   for prop in TRACKED_PROPERTIES])
+    pending.append((deletion, deletion.member_id, deletion.token, True,
+                    values))
+
+  """ Hands out versions and writes the changes. """
+  def write_changes():
+    root = ChangeLogRoot.get(_root_key())
+    if not root:
+      root = ChangeLogRoot(key_name=_ROOT_NAME)
+
+    names = ["%d:%s" % (member_id, token) \
+             for entity, member_id, token, deleted, values in pending]
+    existing = MemberChange.get_by_key_name(names, parent=_root_key())
+
+    changes = []
+    for name, change, (entity, member_id, token, deleted, values) in \
+        zip(names, existing, pending):
+      if change:
+        # We logged this one before, but didn't get to clean up after it.
+        continue
+      root.version += 1
+      changes.append(MemberChange(key_name=name, parent=_root_key(),
+                                  version=root.version, member_id=member_id,
+                                  deleted=deleted, **values))
+    db.put([root] + changes)
+    return len(changes)
+
+  logged = db.run_in_transaction(write_changes)
+  logging.debug("Logged %d change(s)." % (logged))
+  return [(entity, token) for entity, member_id, token, deleted, values \
+          in pending]
+
+
+""" Clears the change token on a member, unless they changed again since.
+key: The key of the member.
+token: The token that we logged. """
+def _clear_token(key, token):
+  """ Does the clearing. """
+  def clear():
+    member = db.get(key)
+    if (member and member.change_token == token):
+      member.change_token = None
+      # Membership.put() would count this as a new write.
+      db.Model.put(member)
+
+  db.run_in_transaction(clear)
+
+
+""" Gives versions to changes that don't have one yet. This is run every minute
+by a cron job.
+Returns: How many pending changes we went through. """
+def assign_versions():
+  total = 0
+  for i in range(0, _MAX_BATCHES):
+    # The queries here are only eventually consistent, but we get the entities
+    # themselves by key, and anything we miss will be picked up next time.
+    member_keys = db.GqlQuery("SELECT __key__ FROM Membership" \
+                              " WHERE change_token > ''").fetch(_BATCH_SIZE)
+    members = [member for member in db.get(member_keys) \
+               if (member and member.change_token)]
+    deletion_keys = PendingDeletion.all(keys_only=True) \
+        .fetch(_BATCH_SIZE - len(members))
+    deletions = [deletion for deletion in db.get(deletion_keys) if deletion]
+    if not (members or deletions):
+      break
+
+    logged = _log_batch(members, deletions)
+    # This doesn't hurt if we already did it, so it's fine if we crash before
+    # clearing the tokens and do it again next time.
+    maglock.update(members, [deletion.member_id for deletion in deletions])
+    db.delete([entity for entity, token in logged \
+               if isinstance(entity, PendingDeletion)])
+    for entity, token in logged:
+      if not isinstance(entity, PendingDeletion):
+        _clear_token(entity.key(), token)
+
+    total += len(logged)
+    if len(member_keys) + len(deletion_keys) < _BATCH_SIZE:
+      break
+
+  return total
+
+
+""" Gets the changes since a particular version.
+since: The version that the caller already has.
+limit: The most changes to get.
+Returns: A list of MemberChange objects, in order, or None if some of the
+changes after since have already been thrown away. """
+def changes_since(since, limit):
+  root = ChangeLogRoot.get(_root_key())
+  if not root:
+    return []
+  if since < root.pruned_version:
+    return None
+  if since >= root.version:
+    # Nothing has changed.
+    return []
+
+  query = MemberChange.all().ancestor(root).filter("version >", since) \
+                            .order("version")
+  return query.fetch(limit)
+
+
+""" Throws away changes that are older than MAX_AGE. """
+def prune():
+  cutoff = datetime.datetime.now() - MAX_AGE
+  query = MemberChange.all().ancestor(_root_key()) \
+                      .filter("created <", cutoff).order("created")
+  changes = query.fetch(_BATCH_SIZE)
+  while changes:
+    newest = max([change.version for change in changes])
+
+    """ Deletes a batch, and remembers that we did. """
+    def delete_changes():
+      root = ChangeLogRoot.get(_root_key())
+      root.pruned_version = max(root.pruned_version, newest)
+      root.put()
+      db.delete(changes)
+
+    db.run_in_transaction(delete_changes)
+    logging.info("Pruned changes up to version %d." % (newest))
+    changes = query.fetch(_BATCH_SIZE)
@@ -6,15 +6,50 @@ from google.appengine.api import app_identity
 import keymaster
 
 
-""" Class for storing specific configuration parameters. """
-class Config:
+""" Class for storing specific configuration parameters. There is only ever
+one instance of this class per process. It gets built the first time someone
+calls Config(), and every call after that returns the same frozen object. """
+class Config(object):
   # Mutually exclusive flags that specify whether the application is running on
   # hd-signup-hrd, signup-dev/dev_appserver, or local unit tests.
   is_dev = False
   is_prod = True
   is_testing = False;
 
-  def __init__(self):
+  # The shared instance.
+  _instance = None
+
+  def __new__(cls):
+    instance = cls._instance
+    if instance is None:
+      instance = super(Config, cls).__new__(cls)
+      instance.__setup()
+      # Nothing is allowed to change it after this point.
+      object.__setattr__(instance, "_frozen", True)
+      cls._instance = instance
+
+    return instance
+
+  def __setattr__(self, name, value):
+    if getattr(self, "_frozen", False):
+      raise AttributeError("Config is immutable, can't set '%s'." % (name))
+    object.__setattr__(self, name, value)
+
+  def __delattr__(self, name):
+    raise AttributeError("Config is immutable, can't delete '%s'." % (name))
+
+  """ Forgets the shared instance, so that the next call to Config() detects
+  the environment again. This is only meant for unit tests. """
+  @classmethod
+  def reset(cls):
+    cls._instance = None
+    cls.is_dev = False
+    cls.is_prod = True
+    cls.is_testing = False
+
+  """ Detects the environment and fills in all the configuration parameters.
+  This only ever runs once per instance. """
+  def __setup(self):
     try:
       # Check if we are running on the local dev server.
       software = os.environ["SERVER_SOFTWARE"]
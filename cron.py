@@ -1,18 +1,23 @@
 """ Contains handlers that are run periodically as cron jobs. """
 
 
-import cPickle as pickle
 import datetime
 import json
 import logging
 
-from google.appengine.api import taskqueue, urlfetch
+from google.appengine.api import mail, taskqueue, urlfetch
 from google.appengine.ext import db
 
+import dateutil.parser
+
 from config import Config
-from membership import Membership
+from membership import MemberLookup, Membership
 from project_handler import ProjectHandler, BaseApp
+import change_log
+import maglock
+import signin_reset
 import subscriber_api
+import username_directory
 
 
 """ Superclass for all cron jobs. """
@@ -71,11 +76,14 @@ class CronHandlerBase(ProjectHandler):
     return wrapper
 
 
-""" Periodically refreshes the list of cached domain users. """
+""" Periodically gets new domain users for the username directory. Once a day,
+it gets all of them, so we notice users that were deleted. """
 class CacheUsersHandler(CronHandlerBase):
   @CronHandlerBase.cron_only
   def get(self):
-    self.fetch_usernames(use_cache=False)
+    full = self.request.get("full") == "1"
+    if username_directory.sync(full=full) == None:
+      self.response.set_status(500)
 
 
 """ Datastore model to keep track of DataSync information. """
@@ -90,8 +98,8 @@ class SyncRunInfo(db.Model):
 """ Handler for syncing data between dev and production apps. """
 class DataSyncHandler(CronHandlerBase):
   dev_url = "http://signup-dev.appspot.com/cron/datasync"
-  # The size of a batch for __batch_loop.
-  batch_size = 10
+  # How many members we send in each POST.
+  batch_size = 200
 
   @CronHandlerBase.cron_only
   @CronHandlerBase.no_dev
@@ -102,64 +110,68 @@ class DataSyncHandler(CronHandlerBase):
       run_info = SyncRunInfo()
       run_info.put()
 
+    # Anything that changes while we're running will get picked up next time.
+    started = datetime.datetime.now()
     if run_info.run_times == 0:
       # This is the first run. Sync everything.
       logging.info("First run, syncing everything...")
-      self.__batch_loop(run_info.cursor)
+      self.__batch_loop(run_info)
     else:
       # Check for entries that changed since we last ran this.
       last_run = run_info.last_run
       logging.info("Last successful run: " + str(last_run))
-      self.__batch_loop(run_info.cursor, "updated >", last_run)
+      self.__batch_loop(run_info, "updated >", last_run)
 
     # Update the number of times we've run this.
-    run_info = SyncRunInfo().all().get()
     run_info.run_times = run_info.run_times + 1
     # Clear the cursor property if we synced successfully.
     run_info.cursor = None
     logging.info("Ran sync %d time(s)." % (run_info.run_times))
     # Update the time of the last successful run.
-    run_info.last_run = datetime.datetime.now()
+    run_info.last_run = started
     run_info.put()
 
-  """ Gets the requested member information from the datastore and sends it.
-  cursor: Specifies a cursor to start fetching data at.
+  """ Gets the requested member information from the datastore and sends it
+  in batches. After each batch, it saves a cursor, so that if we fail, the next
+  run can pick up where this one left off.
+  run_info: The SyncRunInfo for this run.
   Additional arguments can be specified which will be used as a filter for the
   datastore query. """
-  def __batch_loop(self, cursor = None, *args, **kwargs):
-    cursor = cursor
+  def __batch_loop(self, run_info, *args, **kwargs):
+    query = Membership.all()
+    if (args != () or kwargs != {}):
+      query.filter(*args, **kwargs)
+
+    cursor = run_info.cursor
     while True:
-      if (args == () and kwargs == {}):
-        query = Membership.all()
-      else:
-        query = Membership.all().filter(*args, **kwargs)
-      query.with_cursor(start_cursor = cursor)
+      query.with_cursor(start_cursor=cursor)
       members = query.fetch(self.batch_size)
-
       if len(members) == 0:
         break
-      for member in members:
-        member = self.__strip_sensitive(member)
-        self.__post_member(member)
+
+      self.__post_members(members)
 
       cursor = query.cursor()
-      run_info = SyncRunInfo.all().get()
       run_info.cursor = cursor
       run_info.put()
 
-  """ Posts member data to dev application.
-  member: The member whose data we are posting. """
-  def __post_member(self, member):
-    data = db.to_dict(member)
-    # Pickle datetimes for easy transmission.
-    for key in data.keys():
-      if type(data[key]) == datetime.datetime:
-        data[key] = pickle.dumps(data[key])
-    data = json.dumps(data)
-
-    logging.debug("Posting entry: " + data)
-    response = urlfetch.fetch(url = self.dev_url, payload = data,
-        method = urlfetch.POST,
+  """ Posts a batch of member data to the dev application.
+  members: The members whose data we are posting. """
+  def __post_members(self, members):
+    batch = []
+    for member in members:
+      data = db.to_dict(self.__strip_sensitive(member))
+      # Send datetimes in ISO 8601 format.
+      for key, value in data.iteritems():
+        if type(value) == datetime.datetime:
+          data[key] = value.isoformat()
+      batch.append(data)
+    payload = json.dumps({"members": batch}, separators=(",", ":"))
+
+    logging.debug("Posting %d entries (%d bytes)." % \
+                  (len(batch), len(payload)))
+    response = urlfetch.fetch(url = self.dev_url, payload = payload,
+        method = urlfetch.POST, deadline = 60,
         headers = {"Content-Type": "application/json"})
     if response.status_code != 200:
       logging.error("POST received status code %d!" % (response.status_code))
@@ -177,28 +189,40 @@ class DataSyncHandler(CronHandlerBase):
   def post(self):
     if Config().is_dev:
       # Only allow this if it's the dev server.
-      entry = self.request.body
-      logging.debug("Got new entry: " + entry)
-      entry = json.loads(entry)
-      # Change formatted date back into datetime.
-      for key in entry.keys():
-        if type(getattr(Membership, key)) == db.DateTimeProperty:
-          if not entry[key]:
-            # It could be None as well.
-            continue
-          entry[key] = pickle.loads(str(entry[key]))
-      # entry should have everything nicely in a dict...
-      member = Membership(**entry)
-
-      # Is this an update or a new model?
-      match = Membership.all().filter("email =", member.email).get()
-      if match:
-        # Replace the old one.
-        logging.debug("Found entry with same username. Replacing...")
-        db.delete(match)
-
-      member.put()
-      logging.debug("Put entry in datastore.")
+      entries = json.loads(self.request.body)["members"]
+      logging.debug("Got %d new entries." % (len(entries)))
+
+      # Find the members we already have, by email.
+      emails = [entry["email"] for entry in entries]
+      lookups = MemberLookup.get_by_key_name(
+          [MemberLookup.key_name_for("email", email) for email in emails])
+      new_ids = iter([])
+      num_new = len([lookup for lookup in lookups if not lookup])
+      if num_new:
+        start, end = db.allocate_ids(db.Key.from_path("Membership", 1),
+                                     num_new)
+        new_ids = iter(range(start, end + 1))
+
+      to_put = []
+      for entry, lookup in zip(entries, lookups):
+        # Change formatted dates back into datetimes.
+        for key in entry.keys():
+          if (type(getattr(Membership, key)) == db.DateTimeProperty and \
+              entry[key]):
+            entry[key] = dateutil.parser.parse(entry[key])
+
+        # Replace the old version if we have one.
+        member_id = lookup.member_id if lookup else new_ids.next()
+        member = Membership(key=db.Key.from_path("Membership", member_id),
+                            **entry)
+        to_put.append(member)
+        if not lookup:
+          to_put.append(MemberLookup(
+              key_name=MemberLookup.key_name_for("email", member.email),
+              member_id=member_id))
+
+      db.put(to_put)
+      logging.debug("Put %d entries in datastore." % (len(entries)))
 
 
 """ Handles resetting signin count at the start of every month. """
@@ -206,29 +230,24 @@ class ResetSigninHandler(CronHandlerBase):
   @CronHandlerBase.cron_only
   @CronHandlerBase.no_dev
   def get(self):
-    query = db.GqlQuery("SELECT * FROM Membership WHERE signins != 0")
-
-    member_writes = []
-    for member in query.run():
-      # Signins should role over to the next month if they are not used. The way
-      # this is implemented is by making signins negative to start if the user
-      # has signins rolling over from last month.
-      rollovers = max(0, Config().LITE_VISITS - member.signins)
-      logging.info("Rolling over %d signins." % (rollovers))
-
-      member.signins = 0 - rollovers
-      if member.status == "no_visits":
-        logging.info("Restoring user that ran out of visits: %s" % \
-                     (member.username))
-        subscriber_api.restore(member.username)
-        member.status = "active"
-
-      member_future = db.put_async(member)
-      member_writes.append(member_future)
-
-    logging.debug("Waiting for writes to complete...")
-    for async_write in member_writes:
-      async_write.get_result()
+    # The actual work gets done in tasks.
+    signin_reset.start()
+
+
+""" Adds tasks to a queue as few calls as possible. Tasks that have already been
+added under the same name are skipped, so it's safe to add the same tasks again.
+tasks: The taskqueue.Task objects to add.
+queue_name: The name of the queue to add them to.
+"""
+def _add_tasks(tasks, queue_name="default"):
+  queue = taskqueue.Queue(queue_name)
+  # We can add at most 100 tasks at once.
+  for i in range(0, len(tasks), 100):
+    try:
+      queue.add(tasks[i:i + 100])
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # The rest of the batch still gets added.
+      logging.info("Some tasks were already queued.")
 
 
 """ Notifies and removes users who never finished signing up. """
@@ -236,12 +255,22 @@ class CleanupHandler(CronHandlerBase):
   @CronHandlerBase.cron_only
   @CronHandlerBase.no_dev
   def get(self):
+    # Anyone who started signing up before yesterday.
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    cutoff = datetime.datetime.combine(yesterday, datetime.time())
+    query = Membership.all(keys_only=True).filter("status =", None) \
+                                          .filter("created <", cutoff)
+
+    tasks = []
     countdown = 0
-    for membership in Membership.all().filter("status =", None):
-      if (datetime.datetime.now().date() - membership.created.date()).days > 1:
-        countdown += 90
-        self.response.out.write("bye %s " % (membership.email))
-        taskqueue.add(url="/tasks/clean_row", params={"user": membership.key().id()}, countdown=countdown)
+    for key in query.run(batch_size=1000):
+      countdown += 90
+      self.response.out.write("bye %d " % (key.id()))
+      # They get deleted, so they can only ever get one of these.
+      tasks.append(taskqueue.Task(url="/tasks/clean_row",
+          name="cleanup-%d" % (key.id()), params={"user": key.id()},
+          countdown=countdown))
+    _add_tasks(tasks)
 
 
 """ Sends an email to suspended users who never unsubscribed. """
@@ -249,17 +278,85 @@ class AreYouStillThereHandler(CronHandlerBase):
   @CronHandlerBase.cron_only
   @CronHandlerBase.no_dev
   def get(self):
+    # The task checks unsubscribe_reason, because we can't query on it. We
+    # check extra_dnd here too, because older members don't have it set, and
+    # filtering on it would leave them out.
+    query = Membership.all().filter("status =", "suspended") \
+                            .filter("spreedly_token >", "")
+    # Everyone gets at most one of these a week, even if we run again.
+    year, week, _ = datetime.date.today().isocalendar()
+
+    tasks = []
     countdown = 0
-    for membership in Membership.all().filter("status =", "suspended"):
-      if (not membership.unsubscribe_reason and membership.spreedly_token \
-          and "Deleted" not in membership.last_name and \
-          membership.extra_dnd != True):
-        # One e-mail every 90 seconds = 960 e-mails a day.
-        countdown += 90
-        self.response.out.write("Are you still there %s ?<br/>" % \
-                                (membership.email))
-        taskqueue.add(url="/tasks/areyoustillthere_mail",
-            params={"user": membership.key().id()}, countdown=countdown)
+    for membership in query.run(batch_size=1000):
+      if membership.extra_dnd == True or "Deleted" in membership.last_name:
+        continue
+
+      member_id = membership.key().id()
+      # One e-mail every 90 seconds = 960 e-mails a day.
+      countdown += 90
+      self.response.out.write("Are you still there %d ?<br/>" % (member_id))
+      tasks.append(taskqueue.Task(url="/tasks/areyoustillthere_mail",
+          name="areyoustillthere-%d-%d-%d" % (member_id, year, week),
+          params={"user": member_id}, countdown=countdown))
+    _add_tasks(tasks)
+
+
+""" Recounts the members on every plan and fixes the plan occupancy counters.
+If it finds any sort keys that are missing or out of date, it starts a task to
+fix them all. """
+class ReconcileOccupancyHandler(CronHandlerBase):
+  @CronHandlerBase.cron_only
+  @CronHandlerBase.no_dev
+  def get(self):
+    stale_sort_keys = Membership.reconcile_occupancy()
+
+    if stale_sort_keys:
+      logging.info("%d member(s) have stale sort keys." % (stale_sort_keys))
+      # The name keeps us from starting more than one of these a day.
+      _add_tasks([taskqueue.Task(url="/tasks/backfill_sort_keys",
+          name="backfill-sort-keys-%s" % (datetime.date.today()))])
+
+
+""" Goes through everyone on PinPayments and fixes any members whose status or
+plan is wrong, in case we missed some updates. It emails a report of everything
+that it changed. """
+class ReconcileSubscribersHandler(CronHandlerBase):
+  @CronHandlerBase.cron_only
+  @CronHandlerBase.no_dev
+  def get(self):
+    report = subscriber_api.reconcile_subscribers()
+    logging.info(str(report))
+
+    if (report.changes or report.unknown):
+      conf = Config()
+      mail.send_mail(sender=conf.EMAIL_FROM, to=conf.INTERNAL_DEV_EMAIL,
+                     subject="PinPayments reconciliation report",
+                     body=str(report))
+
+
+""" Gives versions to new entries in the member change log. """
+class AssignChangeVersionsHandler(CronHandlerBase):
+  @CronHandlerBase.cron_only
+  def get(self):
+    change_log.assign_versions()
+
+
+""" Throws away old entries in the member change log. """
+class PruneChangesHandler(CronHandlerBase):
+  @CronHandlerBase.cron_only
+  @CronHandlerBase.no_dev
+  def get(self):
+    change_log.prune()
+
+
+""" Rebuilds the list of people who can open the maglocks from scratch, in case
+it missed any changes. """
+class RebuildMaglockHandler(CronHandlerBase):
+  @CronHandlerBase.cron_only
+  @CronHandlerBase.no_dev
+  def get(self):
+    maglock.rebuild()
 
 
 app = BaseApp([
@@ -267,5 +364,10 @@ app = BaseApp([
     ("/cron/reset_signins", ResetSigninHandler),
     ("/cron/cache_users", CacheUsersHandler),
     ("/cron/cleanup", CleanupHandler),
-    ("/cron/areyoustillthere", AreYouStillThereHandler)],
+    ("/cron/areyoustillthere", AreYouStillThereHandler),
+    ("/cron/reconcile_occupancy", ReconcileOccupancyHandler),
+    ("/cron/reconcile_subscribers", ReconcileSubscribersHandler),
+    ("/cron/rebuild_maglock", RebuildMaglockHandler),
+    ("/cron/assign_change_versions", AssignChangeVersionsHandler),
+    ("/cron/prune_changes", PruneChangesHandler)],
     debug=True)
@@ -0,0 +1,310 @@
+""" Gift codes are the credit-card style codes on the giftcards that we sell.
+Every code that we hand out has a GiftCode entity keyed by the code itself, so
+checking whether a code is real and whether it has been used is just one keyed
+read. Cards that were printed before we had GiftCodes get one the first time
+somebody tries to use them, as long as the code checks out against the secret
+that it was made with. """
+
+
+import datetime
+import hashlib
+import logging
+import re
+import socket
+import urllib2
+import uuid
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import keymaster
+import spreedly
+import subscriber_api
+
+
+# All our giftcards start out with this.
+PREFIX = "1337"
+# How long a code is, in digits.
+CODE_LENGTH = 16
+# How many codes we write at once.
+_BATCH_SIZE = 500
+# How much PinPayments store credit a code is worth, in dollars.
+CREDIT = 95.0
+
+
+""" Raised when someone tries to use a code that we never handed out. """
+class InvalidCodeError(Exception):
+  pass
+
+
+""" Raised when someone tries to use a code that was already used. """
+class UsedCodeError(Exception):
+  pass
+
+
+""" A record of someone trying to use a code. Successful redemptions are
+children of the GiftCode that they used. """
+class UsedCode(db.Model):
+  email = db.StringProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  code = db.StringProperty()
+  extra = db.StringProperty()
+  # When they got their credit on PinPayments.
+  completed = db.DateTimeProperty()
+  # The ID of the member who used the code, which is also their PinPayments
+  # customer ID.
+  member_id = db.IntegerProperty()
+  # Whether we still have to give them their credit.
+  credit_pending = db.BooleanProperty(default=False)
+  # How much store credit they had before we gave them any, so that we can
+  # tell whether we already did.
+  credit_before = db.FloatProperty(indexed=False)
+  # A random key that we save right before we ask PinPayments for the credit.
+  # If it is still set on a retry, the credit might have gone through, so we
+  # must not ask again.
+  credit_attempt = db.StringProperty(indexed=False)
+
+
+""" A code that we've handed out. The key name is the code. """
+class GiftCode(db.Model):
+  serial = db.IntegerProperty(required=True)
+  created = db.DateTimeProperty(auto_now_add=True)
+  # When the code was used, or None if it hasn't been.
+  redeemed = db.DateTimeProperty(indexed=False)
+  # The email of whoever used it.
+  email = db.StringProperty(indexed=False)
+
+  """ Returns: The code, split up the way it is printed on the card. """
+  def pretty(self):
+    code = self.key().name()
+    return " ".join([code[i:i + 4] for i in range(0, CODE_LENGTH, 4)])
+
+
+""" Works out the code for a serial number.
+serial: The serial number.
+secret: The secret that the hash part of the code is based on.
+Returns: The code, as a string of digits. """
+def code_for_serial(serial, secret):
+  serial = "%04d" % (serial)
+  code_hash = hashlib.sha1(serial + secret).hexdigest()
+  code_hash = re.sub("[a-f]", "", code_hash)[:8]
+  return PREFIX + serial + code_hash
+
+
+""" Creates the codes for a range of serial numbers. Codes that already exist
+are left alone, so it is safe to run this again on the same range. Codes that
+UsedCode says were used before we had GiftCode entities get marked as used.
+start: The first serial number.
+end: One past the last serial number.
+Returns: How many new codes were created. """
+def generate(start, end):
+  # keymaster caches this, so we only read it once per instance.
+  secret = keymaster.get("code:hash")
+
+  # Codes sort by serial number, since they all start with the same prefix.
+  old_uses = UsedCode.all() \
+      .filter("code >=", PREFIX + "%04d" % (start)) \
+      .filter("code <=", PREFIX + "%04d" % (end - 1) + "9" * 8)
+  used = dict([(use.code, use) for use in old_uses if use.extra == "OK"])
+
+  created = 0
+  for batch_start in range(start, end, _BATCH_SIZE):
+    serials = range(batch_start, min(end, batch_start + _BATCH_SIZE))
+    codes = [code_for_serial(serial, secret) for serial in serials]
+
+    existing = GiftCode.get_by_key_name(codes)
+    new_codes = []
+    for serial, code, gift_code in zip(serials, codes, existing):
+      if gift_code:
+        continue
+
+      gift_code = GiftCode(key_name=code, serial=serial)
+      if code in used:
+        gift_code.redeemed = used[code].created
+        gift_code.email = used[code].email
+      new_codes.append(gift_code)
+
+    db.put(new_codes)
+    created += len(new_codes)
+
+  logging.info("Created %d gift code(s) in [%d, %d)." % (created, start, end))
+  return created
+
+
+""" Creates the GiftCode for a card that was printed before we had them, if the
+code is real. If the old UsedCode records say that it was already used, it gets
+created as used.
+code: The code, as a string of digits.
+Returns: False if the code isn't real. """
+def _import_legacy_code(code):
+  if (len(code) != CODE_LENGTH or not code.startswith(PREFIX) or
+      not code.isdigit()):
+    return False
+  serial = int(code[len(PREFIX):len(PREFIX) + 4])
+  # keymaster caches this, so we only read it once per instance.
+  if code_for_serial(serial, keymaster.get("code:hash")) != code:
+    return False
+
+  gift_code = GiftCode(key_name=code, serial=serial)
+  for use in UsedCode.all().filter("code =", code):
+    if use.extra == "OK":
+      gift_code.redeemed = use.created
+      gift_code.email = use.email
+
+  """ Saves the code, unless someone else just did. """
+  def insert():
+    if not GiftCode.get_by_key_name(code):
+      gift_code.put()
+
+  db.run_in_transaction(insert)
+  logging.info("Imported legacy gift code %s." % (code))
+  return True
+
+
+""" Uses up a code. Looking up the code and marking it as used happen in the
+same transaction, so two people can't both use the same code. If we know who
+used it, the same transaction queues a task to give them their credit.
+code: The code, as a string of digits.
+email: The email of the person using it.
+member_id: The ID of the member using it, or None if nobody gets credit.
+Returns: The UsedCode record of the redemption.
+Raises InvalidCodeError if the code isn't real, and UsedCodeError if somebody
+already used it. """
+def redeem(code, email, member_id=None):
+  """ Checks and marks the code.
+  Returns: The UsedCode record, or None if there is no GiftCode. """
+  def mark_used():
+    gift_code = GiftCode.get_by_key_name(code)
+    if not gift_code:
+      return None
+    if gift_code.redeemed:
+      raise UsedCodeError("Code %s was used by %s." % (code, gift_code.email))
+
+    gift_code.redeemed = datetime.datetime.now()
+    gift_code.email = email
+    used_code = UsedCode(parent=gift_code, code=code, email=email, extra="OK",
+                         member_id=member_id,
+                         credit_pending=member_id != None)
+    db.put([gift_code, used_code])
+
+    if used_code.credit_pending:
+      taskqueue.add(url="/tasks/credit_gift_code", queue_name="gift-codes",
+                    params={"used_code": str(used_code.key())},
+                    transactional=True)
+    return used_code
+
+  used_code = db.run_in_transaction(mark_used)
+  if used_code:
+    return used_code
+
+  # It might be from before we had GiftCodes.
+  if not _import_legacy_code(code):
+    raise InvalidCodeError("No such code: %s" % (code))
+  return db.run_in_transaction(mark_used)
+
+
+""" Gives someone the credit for a code on PinPayments, creating them there
+first if they aren't yet. Before asking for the credit, we save that we are
+about to, in a transaction. If a retry finds that saved, the first try might
+have given them the credit already, so we never ask for it a second time.
+key: The key of the UsedCode record of the redemption.
+Returns: False if PinPayments failed, and we should try again later. """
+def apply_credit(key):
+  used_code = UsedCode.get(key)
+  if not used_code or not used_code.credit_pending:
+    # Nothing left to do.
+    return True
+
+  api = subscriber_api.get_api()
+  try:
+    try:
+      subscriber = api.subscriber_details(sub_id=used_code.member_id)
+    except spreedly.SpreedlyResponseError as e:
+      if e.code != 404:
+        raise
+      subscriber = api.create_subscriber(used_code.member_id, used_code.email)
+  except (spreedly.SpreedlyResponseError, urllib2.URLError,
+          socket.error) as e:
+    logging.warning("Looking up %d for code %s failed: %s" % \
+                    (used_code.member_id, used_code.code, e))
+    return False
+
+  credit = float(subscriber.get("store-credit") or 0)
+  if used_code.credit_attempt:
+    # We asked before, and never heard whether it worked.
+    if credit < used_code.credit_before + CREDIT:
+      # They might have spent it already, so asking again could give them
+      # twice as much.
+      logging.error("Can't tell whether %d got credit for code %s. Check" \
+                    " PinPayments by hand." % \
+                    (used_code.member_id, used_code.code))
+      _finish_credit(key, completed=False)
+      return True
+    _finish_credit(key)
+    return True
+
+  attempt = uuid.uuid4().hex
+  """ Saves that we are about to ask for the credit, unless another try
+  already did.
+  Returns: True if we should go ahead. """
+  def start_attempt():
+    used_code = UsedCode.get(key)
+    if not used_code.credit_pending or used_code.credit_attempt:
+      return False
+    used_code.credit_before = credit
+    used_code.credit_attempt = attempt
+    used_code.put()
+    return True
+
+  if not db.run_in_transaction(start_attempt):
+    # Another try got here first, so check again once it's done.
+    return False
+
+  try:
+    api.add_credit(used_code.member_id, CREDIT)
+  except spreedly.SpreedlyResponseError as e:
+    logging.warning("Crediting code %s for %d failed: %s" % \
+                    (used_code.code, used_code.member_id, e))
+    if not spreedly.is_retryable(e.code):
+      # PinPayments turned it down, so we know that it didn't go through.
+      _clear_attempt(key, attempt)
+    return False
+  except (urllib2.URLError, socket.error) as e:
+    logging.warning("Crediting code %s for %d failed: %s" % \
+                    (used_code.code, used_code.member_id, e))
+    return False
+
+  _finish_credit(key)
+  logging.info("Gave %d credit for code %s." % \
+               (used_code.member_id, used_code.code))
+  return True
+
+
+""" Marks that someone doesn't need their credit anymore.
+key: The key of the UsedCode record of the redemption.
+completed: Whether we know that they got it. """
+def _finish_credit(key, completed=True):
+  """ Updates the record. """
+  def finish():
+    used_code = UsedCode.get(key)
+    used_code.credit_pending = False
+    if completed:
+      used_code.completed = datetime.datetime.now()
+    used_code.put()
+
+  db.run_in_transaction(finish)
+
+
+""" Forgets a try at giving someone credit, once we know that it didn't go
+through, so that the next try can ask again.
+key: The key of the UsedCode record of the redemption.
+attempt: The key of the try. """
+def _clear_attempt(key, attempt):
+  """ Updates the record, unless a different try is going on. """
+  def clear():
+    used_code = UsedCode.get(key)
+    if used_code.credit_attempt == attempt:
+      used_code.credit_attempt = None
+      used_code.put()
+
+  db.run_in_transaction(clear)
@@ -1,6 +1,8 @@
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 import os
+import time
 
 try:
     from Crypto.Cipher import ARC4
@@ -11,6 +13,19 @@ except ImportError:
         encrypt = classmethod(lambda k,x: x)
         decrypt = classmethod(lambda k,x: x)
 
+# How long (in seconds) a decrypted secret stays in the per-instance cache
+# before we go back to memcache or the datastore for it.
+CACHE_TTL = 60 * 10
+# Prefix for the memcache entries that hold encrypted secrets.
+MEMCACHE_PREFIX = "keymaster."
+# Prefix for the memcache entries that count how many times each secret has
+# changed. Every instance checks this before using its own cached copy, so a
+# change on one instance reaches all of them right away.
+GENERATION_PREFIX = "keymaster_generation."
+
+# Maps key names to (secret, expiry time, generation) tuples.
+_secret_cache = {}
+
 class KeymasterError(Exception): pass
 
 class Keymaster(db.Model):
@@ -24,14 +39,55 @@ class Keymaster(db.Model):
             k.secret = str(secret)
         else:
             k = cls(key_name=str(key_name), secret=str(secret))
-        return k.put()
+        key = k.put()
+
+        # Make sure nobody keeps using the old value.
+        invalidate(key_name)
+        return key
 
     @classmethod
     def decrypt(cls, key_name):
-        k = cls.get_by_key_name(str(key_name))
-        if not k:
-            raise KeymasterError("Keymaster has no secret for %s" % key_name)
-        return ARC4.new(os.environ['APPLICATION_ID']).encrypt(k.secret)
+        # Only the encrypted form ever goes into memcache.
+        memcache_key = MEMCACHE_PREFIX + str(key_name)
+        secret = memcache.get(memcache_key)
+        if secret is None:
+            k = cls.get_by_key_name(str(key_name))
+            if not k:
+                raise KeymasterError("Keymaster has no secret for %s" % key_name)
+            secret = k.secret
+            memcache.set(memcache_key, secret, CACHE_TTL)
+
+        return ARC4.new(os.environ['APPLICATION_ID']).encrypt(secret)
 
+""" Drops a secret from both the per-instance cache and memcache, and makes
+every other instance drop it from their caches too.
+key_name: The name of the secret to drop. """
+def invalidate(key_name):
+    key_name = str(key_name)
+    _secret_cache.pop(key_name, None)
+    memcache.delete(MEMCACHE_PREFIX + key_name)
+    memcache.incr(GENERATION_PREFIX + key_name, initial_value=0)
+
+""" Empties the per-instance cache. Mostly useful for unit tests. """
+def clear_cache():
+    _secret_cache.clear()
+
+""" Gets a decrypted secret, using the per-instance cache when possible.
+key: The name of the secret.
+Returns: The decrypted secret. """
 def get(key):
-    return Keymaster.decrypt(key)
+    key = str(key)
+    now = time.time()
+    # We have to read this before the secret, so that if it changes in
+    # between, we notice next time.
+    generation = memcache.get(GENERATION_PREFIX + key)
+
+    cached = _secret_cache.get(key)
+    # If memcache lost the generation, we can't tell, so we go by the TTL.
+    if (cached and cached[1] > now and
+            (generation is None or generation == cached[2])):
+        return cached[0]
+
+    secret = Keymaster.decrypt(key)
+    _secret_cache[key] = (secret, now + CACHE_TTL, generation)
+    return secret
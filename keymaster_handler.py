@@ -2,6 +2,7 @@ from google.appengine.api import users
 from google.appengine.ext.webapp import util
 
 from keymaster import Keymaster
+import keymaster
 from project_handler import BaseApp, ProjectHandler
 
 
@@ -16,8 +17,9 @@ class KeymasterHandler(ProjectHandler):
 
     def post(self):
         if users.is_current_user_admin():
+            # Encrypting also invalidates any cached copies of the old secret.
             Keymaster.encrypt(self.request.get('key'), self.request.get('secret'))
-            self.response.out.write("Saved: %s" % Keymaster.decrypt(self.request.get('key')))
+            self.response.out.write("Saved: %s" % keymaster.get(self.request.get('key')))
         else:
             self.redirect('/')
 
@@ -2,58 +2,185 @@
 contains utilities for creating those pages with minimal code duplication. """
 
 
+import hashlib
 import json
 import logging
+import re
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
+from membership import Membership
 from project_handler import ProjectHandler
 
 
+# How many members we show on each page.
+PAGE_SIZE = 25
+# Prefix for the memcache entries that hold page counts and cursors.
+_MEMCACHE_PREFIX = "list_pages."
+# How long we keep page counts and cursors. They get thrown away whenever a
+# member's status changes, but other changes can move people between pages too.
+_CACHE_TIME = 60 * 60
+
+
 """ A special handler class for list page handlers. """
 class ListHandler(ProjectHandler):
   """ Gets a response for a particular list page requests. Specifically, there
   are two different types of data that you can request from a list page:
-  /total_pages gets the total number of pages, and setting the page argument
-  requests data for the next page. This function processes the incoming request,
-  grabs the right data, and returns it.
-  data_query: The query to use for requesting page data.
+  /total_pages gets the total number of pages, and setting the page_number
+  argument requests data for a particular page. (Setting the page argument to a
+  cursor also still works.) This function processes the incoming request, grabs
+  the right data, and returns it.
+  data_query: The query to use for requesting page data. This shouldn't be a
+  projection query, because those skip members that don't have all the
+  properties, and the page counts wouldn't match.
   table_template: The template to use for rendering table data.
+  row_filter: If specified, a function that takes a member and returns whether
+  they should be shown. This is for conditions that the datastore can't check.
+  table_values: Any additional values to render the table template with.
   Returns: The response to write, or None, if we are just requesting the base
   page. """
-  def _process_list_page_request(self, data_query, table_template):
+  def _process_list_page_request(self, data_query, table_template,
+                                 row_filter=None, table_values={}):
     if self.request.uri.endswith("/total_pages"):
       # Get the total number of pages.
-      users_query = db.GqlQuery(data_query)
+      return self.__get_page_info(data_query)["pages"]
 
-      users = users_query.count()
-      pages = users / 25
-      if users % 25:
-        pages += 1
+    elif self.request.get("page_number"):
+      # A request for a particular page.
+      try:
+        page = int(self.request.get("page_number"))
+      except ValueError:
+        page = 0
+      page_info = self.__get_page_info(data_query)
+      if (page < 1 or page > max(1, page_info["pages"])):
+        self.response.set_status(400)
+        return "Invalid page number."
 
-      return pages
+      cursor = self.__find_cursor(data_query, page_info, page)
+      fetched_users, next_cursor = self.__fetch_page(data_query, cursor)
+      if page < page_info["pages"]:
+        page_info["cursors"][page + 1] = next_cursor
+      self.__save_page_info(data_query, page_info)
+
+      # Render out the HTML.
+      if row_filter:
+        fetched_users = filter(row_filter, fetched_users)
+      user_table = self.render(table_template, table_values,
+                                signup_users=fetched_users)
+      return json.dumps({"page": page, "nextPage": next_cursor,
+                         "html": user_table})
 
     elif self.request.get("page"):
       # A request for the next page.
       cursor = self.request.get("page")
       logging.debug("Got cursor: %s" % (cursor))
 
-      users_query = db.GqlQuery(data_query)
-
-      if cursor != "start":
-        # Start fetching from where we left off.
-        users_query.with_cursor(start_cursor=cursor)
-
-      fetched_users = users_query.fetch(25)
-
-      next_cursor = users_query.cursor()
-      logging.debug("Next cursor: %s" % (cursor))
+      if cursor == "start":
+        cursor = None
+      fetched_users, next_cursor = self.__fetch_page(data_query, cursor)
+      logging.debug("Next cursor: %s" % (next_cursor))
 
       # Render out the HTML.
-      user_table = self.render(table_template,
+      if row_filter:
+        fetched_users = filter(row_filter, fetched_users)
+      user_table = self.render(table_template, table_values,
                                 signup_users=fetched_users)
       return json.dumps({"nextPage": next_cursor, "html": user_table})
 
+  """ Fetches one page of members.
+  data_query: The query to use.
+  cursor: The cursor to start at, or None to start at the beginning.
+  Returns: A tuple of the members, and the cursor for the next page. """
+  def __fetch_page(self, data_query, cursor):
+    users_query = db.GqlQuery(data_query)
+    if cursor:
+      # Start fetching from where we left off.
+      users_query.with_cursor(start_cursor=cursor)
+
+    fetched_users = users_query.fetch(PAGE_SIZE)
+    return (fetched_users, users_query.cursor())
+
+  """ Makes a version of a query that only gets keys, for when we don't need
+  the members themselves.
+  data_query: The query.
+  Returns: The keys-only query. """
+  def __keys_query(self, data_query):
+    return re.sub(r"^SELECT .+? FROM", "SELECT __key__ FROM", data_query)
+
+  """ Gets the memcache key for the page information for a query. It changes
+  whenever someone's status changes, so we never use stale information.
+  data_query: The query.
+  Returns: The memcache key. """
+  def __page_info_key(self, data_query):
+    return "%s%d.%s" % (_MEMCACHE_PREFIX, Membership.status_version(),
+                        hashlib.md5(data_query).hexdigest())
+
+  """ Gets the number of pages for a query, along with the cursors for all the
+  pages that we know about.
+  data_query: The query.
+  Returns: A dictionary with the number of pages, and a dictionary mapping page
+  numbers to cursors. """
+  def __get_page_info(self, data_query):
+    page_info = memcache.get(self.__page_info_key(data_query))
+    if page_info:
+      return page_info
+
+    users = db.GqlQuery(self.__keys_query(data_query)).count()
+    pages = users / PAGE_SIZE
+    if users % PAGE_SIZE:
+      pages += 1
+
+    page_info = {"pages": pages, "cursors": {1: None}}
+    self.__save_page_info(data_query, page_info)
+    return page_info
+
+  """ Works out something about a list that can't be worked out from one page,
+  like a summary of everyone on it. Like the page information, it is cached
+  until someone's status changes.
+  name: A name for the value, which has to be different for everything that we
+  cache this way.
+  compute: A function that works out the value.
+  Returns: The value. """
+  def _get_cached(self, name, compute):
+    key = "%s%d.%s" % (_MEMCACHE_PREFIX, Membership.status_version(), name)
+    value = memcache.get(key)
+    if value == None:
+      value = compute()
+      memcache.set(key, value, _CACHE_TIME)
+    return value
+
+  """ Saves page information for a query.
+  data_query: The query.
+  page_info: The page information, in the same format that __get_page_info()
+  returns. """
+  def __save_page_info(self, data_query, page_info):
+    memcache.set(self.__page_info_key(data_query), page_info, _CACHE_TIME)
+
+  """ Finds the cursor for the start of a page. If we don't know it, we go
+  forward from the closest page that we do know, remembering the cursors for
+  all the pages in between.
+  data_query: The query.
+  page_info: The page information for the query.
+  page: The page number.
+  Returns: The cursor, or None for the first page. """
+  def __find_cursor(self, data_query, page_info, page):
+    cursors = page_info["cursors"]
+    known_page = max([known for known in cursors.keys() if known <= page])
+
+    # We only need the cursors, so we don't get the members themselves.
+    keys_query = self.__keys_query(data_query)
+    cursor = cursors[known_page]
+    for next_page in range(known_page + 1, page + 1):
+      query = db.GqlQuery(keys_query)
+      if cursor:
+        query.with_cursor(start_cursor=cursor)
+      query.fetch(PAGE_SIZE)
+      cursor = query.cursor()
+      cursors[next_page] = cursor
+
+    return cursor
+
 
 class MemberListHandler(ListHandler):
   @ProjectHandler.admin_only
@@ -85,3 +212,94 @@ class LeaveReasonListHandler(ListHandler):
         return
 
       self.response.out.write(response)
+
+
+class AllHandler(ListHandler):
+    @ProjectHandler.admin_only
+    def get(self, *args):
+      response = self._process_list_page_request("SELECT * FROM Membership" \
+          " ORDER BY last_name_lower ASC", "templates/users_table.html")
+
+      if not response:
+        self.response.out.write(self.render("templates/memberlist.html",
+                                            title="User List",
+                                            endpoint="/userlist"))
+        return
+
+      self.response.out.write(response)
+
+
+class SuspendedHandler(ListHandler):
+    """ Decides whether to show a suspended member. We can't sort by last name
+    and filter on another property with an inequality at the same time, so we
+    skip some people ourselves.
+    user: The member.
+    Returns: True if they should be on the list. """
+    @staticmethod
+    def _show(user):
+      return bool(user.spreedly_token and user.last_name != "Deleted")
+
+    """ Counts the suspended members that we show, and how many of them told us
+    why they left. unsubscribe_reason isn't indexed, so this has to look at all
+    of them.
+    Returns: A tuple of the two counts. """
+    def _count_suspended(self):
+      total = 0
+      with_reasons = 0
+      query = Membership.all().filter("status =", "suspended")
+      for user in query.run(batch_size=1000):
+        if not self._show(user):
+          continue
+        total += 1
+        if user.unsubscribe_reason:
+          with_reasons += 1
+      return (total, with_reasons)
+
+    @ProjectHandler.admin_only
+    def get(self, *args):
+      response = self._process_list_page_request("SELECT * FROM Membership" \
+          " WHERE status = 'suspended' ORDER BY last_name_lower ASC",
+          "templates/suspended_table.html", row_filter=self._show)
+
+      if not response:
+        total, with_reasons = self._get_cached("suspended_summary",
+                                               self._count_suspended)
+        self.response.out.write(self.render("templates/memberlist.html",
+                                            title="Suspended List",
+                                            endpoint="/suspended",
+                                            summary=["Total Suspended: %d" % \
+                                                         (total),
+                                                     "With Reasons: %d" % \
+                                                         (with_reasons)]))
+        return
+
+      self.response.out.write(response)
+
+
+class HardshipHandler(ListHandler):
+    # Parts of the email that we send to people on the hardship plan.
+    _EMAIL_VALUES = {"subject": "About your Hacker Dojo membership",
+        "body1": "\n\nWe hope you have enjoyed your discounted membership at \
+              Hacker Dojo.  As you\nknow, we created the hardship program \
+              to give temporary financial support to help\nmembers get \
+              started at the Dojo. Our records show you began the program\n \
+              on",
+        "body2": ", and we hope you feel that you have benefited.\n\nBeginning \
+              with your next month's term, we ask that you please sign up \
+              at\nour regular rate:\n",
+        "body3": "\n\nThank you for supporting the Dojo!"}
+
+    @ProjectHandler.admin_only
+    def get(self, *args):
+      response = self._process_list_page_request("SELECT * FROM Membership" \
+          " WHERE status = 'active' AND plan = 'hardship'" \
+          " ORDER BY created ASC", "templates/hardship_table.html",
+          table_values=self._EMAIL_VALUES)
+
+      if not response:
+        self.response.out.write(self.render("templates/memberlist.html",
+                                            title="Hardship",
+                                            endpoint="/hardshiplist"))
+        return
+
+      self.response.out.write(response)
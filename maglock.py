@@ -0,0 +1,240 @@
+""" Keeps a precomputed copy of the list of people who are allowed to open the
+maglocks, so that the door controllers can poll it without us having to query
+the datastore every time. """
+
+
+import json
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+# The memcache key for the snapshot.
+_MEMCACHE_KEY = "maglock_acl"
+# The key name of the snapshot entity.
+_SNAPSHOT_NAME = "acl"
+# How many changes we remember, so we can give out deltas.
+_MAX_LOG_SIZE = 500
+# How long the snapshot stays in memcache, in seconds.
+_CACHE_TIME = 60 * 10
+# How many times we try to replace the cached snapshot before giving up.
+_CAS_RETRIES = 5
+# How many members we get at once when rebuilding.
+_GET_BATCH_SIZE = 500
+
+
+""" Stores the current list of people who can open the maglocks. """
+class AclSnapshot(db.Model):
+  # Goes up by one every time the list changes.
+  version = db.IntegerProperty(default=0)
+  # A json dictionary mapping member IDs to [rfid_tag, username] pairs.
+  entries = db.TextProperty(default="{}")
+  # A json list of recent changes. Each one is a list of the form
+  # [version, old entry, new entry], where the entries are [rfid_tag, username]
+  # pairs, or None.
+  log = db.TextProperty(default="[]")
+
+  """ Converts this snapshot into something that we can put in memcache.
+  Returns: A dictionary with the version, entries, and log. """
+  def to_dict(self):
+    return {"version": self.version, "entries": json.loads(self.entries),
+            "log": json.loads(self.log)}
+
+
+""" Figures out what a member's entry in the list should be.
+member: The Membership object.
+Returns: A [rfid_tag, username] pair, or None if they shouldn't be on the list.
+"""
+def _entry_for(member):
+  if (not member.rfid_tag or member.status not in ("active", "no_visits")):
+    return None
+  return [member.rfid_tag, member.username]
+
+
+""" Gets the current snapshot.
+build: Whether to build the snapshot from scratch if it doesn't exist yet.
+Returns: The dictionary form of the snapshot, or None if there isn't one and
+build is False. """
+def get_snapshot(build=True):
+  snapshot = memcache.get(_MEMCACHE_KEY)
+  if snapshot:
+    return snapshot
+
+  entity = AclSnapshot.get_by_key_name(_SNAPSHOT_NAME)
+  if not entity:
+    if not build:
+      return None
+    return rebuild()
+
+  snapshot = entity.to_dict()
+  _cache(snapshot)
+  return snapshot
+
+
+""" Puts a snapshot in memcache, unless there's a newer one there already. Two
+updates can finish in either order, so without this an older snapshot could
+replace a newer one.
+snapshot: The dictionary form of the snapshot. """
+def _cache(snapshot):
+  client = memcache.Client()
+  for i in range(0, _CAS_RETRIES):
+    cached = client.gets(_MEMCACHE_KEY)
+    if cached is None:
+      if client.add(_MEMCACHE_KEY, snapshot, time=_CACHE_TIME):
+        return
+    elif cached["version"] >= snapshot["version"]:
+      return
+    elif client.cas(_MEMCACHE_KEY, snapshot, time=_CACHE_TIME):
+      return
+
+  # Someone else keeps changing it, so let them win. It expires soon anyway.
+  logging.warning("Gave up caching maglock list version %d." % \
+                  (snapshot["version"]))
+
+
+""" Applies a set of changes to the snapshot, and bumps the version. The
+changes are compared to what's in the datastore, so entries that are already
+right are left alone.
+changes: A dictionary mapping member IDs to their new entries.
+create: Whether to create the snapshot if it doesn't exist yet.
+Returns: The dictionary form of the new snapshot, or None if there isn't one and
+create is False. """
+def _apply_changes(changes, create=True):
+  """ Does the actual update. """
+  def update():
+    entity = AclSnapshot.get_by_key_name(_SNAPSHOT_NAME)
+    if not entity:
+      if not create:
+        return None
+      entity = AclSnapshot(key_name=_SNAPSHOT_NAME)
+    entries = json.loads(entity.entries)
+    log = json.loads(entity.log)
+
+    version = entity.version + 1
+    changed = False
+    for member_id, new_entry in changes.iteritems():
+      old_entry = entries.get(member_id)
+      if old_entry == new_entry:
+        continue
+
+      changed = True
+      log.append([version, old_entry, new_entry])
+      if new_entry:
+        entries[member_id] = new_entry
+      else:
+        del entries[member_id]
+
+    if (changed or not entity.is_saved()):
+      entity.version = version
+      entity.entries = json.dumps(entries)
+      if len(log) > _MAX_LOG_SIZE:
+        # Forget whole versions at a time, so we never give out partial deltas.
+        cutoff = log[-_MAX_LOG_SIZE][0]
+        log = [change for change in log if change[0] > cutoff]
+      entity.log = json.dumps(log)
+      entity.put()
+    return entity
+
+  entity = db.run_in_transaction(update)
+  if not entity:
+    return None
+
+  snapshot = entity.to_dict()
+  _cache(snapshot)
+  return snapshot
+
+
+""" Updates the snapshot after some members were written or deleted. This is
+called by change_log when it logs their changes, so nobody else should need to.
+That way, the list can't be changed by a write that never got saved, and a
+write can't be saved without the list eventually getting changed.
+members: The Membership objects that changed.
+deleted_ids: The IDs of the members that were deleted.
+"""
+def update(members, deleted_ids=()):
+  changes = {}
+  for member in members:
+    changes[str(member.key().id())] = _entry_for(member)
+  for member_id in deleted_ids:
+    changes[str(member_id)] = None
+  if not changes:
+    return
+
+  # If there's no snapshot yet, it will be built from scratch the first time
+  # anyone asks for it.
+  logging.debug("Updating maglock list for %d member(s)." % (len(changes)))
+  _apply_changes(changes, create=False)
+
+
+""" Builds the snapshot from scratch by going through the datastore. The query
+that finds everyone is only eventually consistent, so we get everyone that it
+finds, and everyone who is on the list already, by key, and only change the
+entries that are actually wrong.
+Returns: The dictionary form of the new snapshot. """
+def rebuild():
+  logging.info("Rebuilding maglock list.")
+
+  query = db.GqlQuery("SELECT __key__ FROM Membership WHERE rfid_tag != NULL" \
+                      " AND status IN ('active', 'no_visits')")
+  member_ids = set([str(key.id()) for key in query.run()])
+  entity = AclSnapshot.get_by_key_name(_SNAPSHOT_NAME)
+  if entity:
+    member_ids.update(json.loads(entity.entries).keys())
+  member_ids = list(member_ids)
+
+  changes = {}
+  for i in range(0, len(member_ids), _GET_BATCH_SIZE):
+    chunk = member_ids[i:i + _GET_BATCH_SIZE]
+    keys = [db.Key.from_path("Membership", int(member_id)) \
+            for member_id in chunk]
+    for member_id, member in zip(chunk, db.get(keys)):
+      if not member:
+        changes[member_id] = None
+      elif not member.change_token:
+        changes[member_id] = _entry_for(member)
+      # Otherwise, change_log will give us their newest values soon, and we
+      # don't want to replace those with the ones that we just got.
+
+  return _apply_changes(changes)
+
+
+""" Gets the full list of people who can open the maglocks.
+snapshot: The snapshot to use.
+Returns: A list of dictionaries, each of which has an rfid_tag and username. """
+def full_list(snapshot):
+  entries = sorted(snapshot["entries"].values(), key=lambda e: (e[1], e[0]))
+  return [{"rfid_tag": tag, "username": username} \
+          for tag, username in entries]
+
+
+""" Figures out what has changed since a particular version.
+snapshot: The snapshot to use.
+since: The version that the caller has.
+Returns: A tuple of the tags that were added, as a list in the same format as
+full_list, and a list of the tags that were removed. Callers should apply the
+removals first. If we don't remember that far back, it returns None. """
+def changes_since(snapshot, since):
+  if since > snapshot["version"]:
+    return None
+  log = snapshot["log"]
+  if (since < snapshot["version"] and (not log or log[0][0] > since + 1)):
+    # We've forgotten some of the changes.
+    return None
+
+  added = {}
+  removed = set()
+  for version, old_entry, new_entry in log:
+    if version <= since:
+      continue
+
+    if old_entry:
+      if added.get(old_entry[0]) == old_entry[1]:
+        del added[old_entry[0]]
+      removed.add(old_entry[0])
+    if new_entry:
+      added[new_entry[0]] = new_entry[1]
+
+  added = [{"rfid_tag": tag, "username": username} \
+           for tag, username in sorted(added.items())]
+  return (added, sorted(removed))
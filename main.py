@@ -1,6 +1,7 @@
 from cgi import escape
-import base64
+import csv
 import json
+import os
 import sys
 
 import datetime, hashlib, urllib, re
@@ -8,24 +9,18 @@ from google.appengine.api import urlfetch, mail, users, taskqueue
 from google.appengine.ext import db
 
 from config import Config
+from gift_codes import GiftCode, UsedCode
 from list_pages import *
-from membership import Membership
+from membership import DuplicateMemberError, Membership, UsernameReservation
 from project_handler import ProjectHandler, BaseApp
 from select_plan import *
-import keymaster
+import gift_codes
 import logging
 import plans
+import project_handler
 import subscriber_api
 
 
-class UsedCode(db.Model):
-  email = db.StringProperty()
-  created = db.DateTimeProperty(auto_now_add=True)
-  code = db.StringProperty()
-  extra = db.StringProperty()
-  completed = db.DateTimeProperty()
-
-
 class BadgeChange(db.Model):
     created = db.DateTimeProperty(auto_now_add=True)
     rfid_tag = db.StringProperty()
@@ -70,8 +65,7 @@ class MainHandler(ProjectHandler):
         self.response.set_status(400)
         return
 
-      membership = db.GqlQuery("SELECT * FROM Membership WHERE email = :email",
-                               email=email).get()
+      membership = Membership.get_by_unique("email", email)
 
       if membership:
         # A membership object already exists in the datastore.
@@ -121,7 +115,16 @@ class MainHandler(ProjectHandler):
         membership.referrer = re.sub("[^0-9]", "", self.request.get("referrer").upper())
       else:
         membership.referrer = self.request.get("referrer").replace("\n", " ")
-      membership.put()
+      try:
+        membership.put()
+      except DuplicateMemberError:
+        # Someone else signed up with this email at the same time.
+        logging.warning("Lost race to create membership for %s." % (email))
+        self.response.out.write(self.render("templates/main.html",
+                                message="Account already exists.",
+                                plan=plan))
+        self.response.set_status(422)
+        return
 
       logging.debug("Using plan: %s" % (plan))
       if plan == "choose":
@@ -169,15 +172,9 @@ class AccountHandler(ProjectHandler):
         # Error page is already rendered.
         return
       if username in usernames:
-        # Duplicate username. Use the first part of the email instead.
-        username = membership.email.split("@")[0].lower()
-
-        user_number = 0
-        base_username = username
-        while username in usernames:
-          # Still a duplicate. Add a number.
-          user_number += 1
-          username = "%s%d" % (base_username, user_number)
+        # Duplicate username. Use the first part of the email instead, adding a
+        # number if that's taken too.
+        username = usernames.next_free(membership.email.split("@")[0])
 
       if self.request.get("pick_username"):
         pick_username = True
@@ -215,6 +212,23 @@ class AccountHandler(ProjectHandler):
             self.response.set_status(422)
             return
 
+        # Make sure nobody has or is about to get this username.
+        usernames = self.fetch_usernames()
+        if usernames == None:
+            # Error page is already rendered.
+            return
+        taken = username in usernames
+        if not taken:
+            try:
+                UsernameReservation.claim(username, membership)
+            except DuplicateMemberError:
+                taken = True
+        if taken:
+            self.response.out.write(self.render("templates/account.html",
+                locals(), message="That username is already taken."))
+            self.response.set_status(422)
+            return
+
         # Start saving the parameters for new-style accounts now, so that these
         # people won't have to re-enter anything when we make the transition.
         membership.set_password(password)
@@ -222,7 +236,13 @@ class AccountHandler(ProjectHandler):
         # Set a username and password in the datastore.
         membership.username = username
         membership.password = password
-        membership.put()
+        try:
+            membership.put()
+        except DuplicateMemberError:
+            self.response.out.write(self.render("templates/account.html",
+                locals(), message="That username is already taken."))
+            self.response.set_status(422)
+            return
 
         if membership.status in ("active", "no_visits"):
             taskqueue.add(url="/tasks/create_user", method="POST",
@@ -249,13 +269,11 @@ class AccountHandler(ProjectHandler):
                 self.response.set_status(422)
                 return
 
-            # A unique number on all the giftcards.
-            serial = membership.referrer[4:8]
-            # How we know it's valid.
-            hash = membership.referrer[8:16]
-            confirmation_hash = re.sub("[a-f]","",hashlib.sha1(serial+keymaster.get("code:hash")).hexdigest())[:8]
-
-            if hash != confirmation_hash:
+            try:
+                # This also queues a task to give them their credit.
+                gift_codes.redeem(membership.referrer, membership.email,
+                                  member_id=customer_id)
+            except gift_codes.InvalidCodeError:
                 message = "<p>Error: this code was invalid: %s" % \
                     (membership.referrer)
                 message += "<p>Please contact %s if you believe this \
@@ -268,9 +286,7 @@ class AccountHandler(ProjectHandler):
                 self.response.out.write(self.render("templates/error.html", locals()))
                 self.response.set_status(422)
                 return
-
-            previous = UsedCode.all().filter("code =", membership.referrer).get()
-            if previous:
+            except gift_codes.UsedCodeError:
                 message = "<p>Error: this code has already been used: "+ membership.referrer
                 message += "<p>Please contact %s if you believe this" \
                             " message is in error and we can help!" % \
@@ -283,32 +299,6 @@ class AccountHandler(ProjectHandler):
                 self.response.set_status(422)
                 return
 
-            # If we're testing, I don't want it doing random things on
-            # pinpayments.
-            if not Config().is_testing:
-              headers = {"Authorization": "Basic %s" % \
-                  base64.b64encode("%s:X" % conf.get_api_key()),
-                  "Content-Type":"application/xml"}
-              # Create subscriber
-              data = "<subscriber><customer-id>%s</customer-id><email>%s</email></subscriber>" % (customer_id, membership.email)
-              resp = \
-                  urlfetch.fetch("https://subs.pinpayments.com"
-                                "/api/v4/%s/subscribers.xml" % \
-                                (conf.SPREEDLY_ACCOUNT),
-                                method="POST", payload=data,
-                                headers = headers, deadline=5)
-              # Credit
-              data = "<credit><amount>95.00</amount></credit>"
-              resp = \
-                  urlfetch.fetch("https://subs.pinpayments.com/api/v4"
-                                "/%s/subscribers/%s/credits.xml" % \
-                                (conf.SPREEDLY_ACCOUNT, customer_id),
-                                method="POST", payload=data,
-                                headers=headers, deadline=5)
-
-            uc = UsedCode(code=membership.referrer,email=membership.email,extra="OK")
-            uc.put()
-
         # Redirect them to the PinPayments page, where they actually pay.
         self.redirect(membership.new_subscribe_url(self.request.host,
                                                    plan=plan))
@@ -370,8 +360,8 @@ class NeedAccountHandler(ProjectHandler):
         if not email:
             self.redirect(str(self.request.path))
         else:
-            member = Membership.all().filter("email =", email).filter("status =", "active").get()
-            if not member:
+            member = Membership.get_by_unique("email", email)
+            if (not member or member.status != "active"):
                 self.redirect(str(self.request.path + "?message=There is no active record of that email."))
             else:
                 mail.send_mail(sender=Config().EMAIL_FROM,
@@ -383,60 +373,35 @@ class NeedAccountHandler(ProjectHandler):
 
 
 class UpdateHandler(ProjectHandler):
+    # How many subscribers each task updates.
+    chunk_size = 10
+
+    """ PinPayments calls this with a list of subscribers that changed. We
+    split them up into chunks and update them in tasks, so that a big list
+    doesn't time out the request. """
     def post(self):
-        subscriber_ids = self.request.get("subscriber_ids").split(",")
-        for id in subscriber_ids:
-          logging.debug("Updating subscriber with id %s." % id)
-          subscriber_api.update_subscriber(Membership.get_by_id(int(id)))
+        subscriber_ids = []
+        for id in self.request.get("subscriber_ids").split(","):
+          try:
+            subscriber_ids.append(int(id))
+          except ValueError:
+            logging.warning("Ignoring invalid subscriber id '%s'." % (id))
+
+        tasks = []
+        for i in range(0, len(subscriber_ids), self.chunk_size):
+          chunk = subscriber_ids[i:i + self.chunk_size]
+          logging.debug("Queueing update for subscribers %s." % (chunk))
+          tasks.append(taskqueue.Task(url="/tasks/update_subscribers",
+              params={"subscriber_ids": ",".join([str(id) for id in chunk])}))
+
+        # We can add at most 100 tasks at once.
+        queue = taskqueue.Queue("subscriber-updates")
+        for i in range(0, len(tasks), 100):
+          queue.add(tasks[i:i + 100])
 
         self.response.out.write("ok")
 
 
-class SuspendedHandler(ProjectHandler):
-    @ProjectHandler.admin_only
-    def get(self):
-      suspended_users = Membership.all().filter("status =", "suspended").filter("last_name !=", "Deleted").fetch(10000)
-      tokened_users = []
-      for user in suspended_users:
-          if user.spreedly_token:
-              tokened_users.append(user)
-      suspended_users = sorted(tokened_users, key=lambda user: user.last_name.lower())
-      total = len(suspended_users)
-      reasonable = 0
-      for user in suspended_users:
-          if user.unsubscribe_reason:
-              reasonable += 1
-      self.response.out.write(self.render("templates/suspended.html", locals()))
-
-
-class AllHandler(ProjectHandler):
-    @ProjectHandler.admin_only
-    def get(self):
-      signup_users = Membership.all().fetch(10000)
-      signup_users = sorted(signup_users, key=lambda user: user.last_name.lower())
-      user_keys = [str(user.key()) for user in signup_users]
-      user_ids = [user.key().id() for user in signup_users]
-      self.response.out.write(self.render("templates/users.html", locals()))
-
-
-class HardshipHandler(ProjectHandler):
-    @ProjectHandler.admin_only
-    def get(self):
-      active_users = Membership.all().filter("status =", "active").filter("plan =", "hardship").fetch(10000)
-      active_users = sorted(active_users, key=lambda user: user.created)
-      subject = "About your Hacker Dojo membership"
-      body1 = "\n\nWe hope you have enjoyed your discounted membership at \
-              Hacker Dojo.  As you\nknow, we created the hardship program \
-              to give temporary financial support to help\nmembers get \
-              started at the Dojo. Our records show you began the program\n \
-              on"
-      body2 = ", and we hope you feel that you have benefited.\n\nBeginning \
-              with your next month's term, we ask that you please sign up \
-              at\nour regular rate:\n"
-      body3 = "\n\nThank you for supporting the Dojo!"
-      self.response.out.write(self.render("templates/hardship.html", locals()))
-
-
 class ReactivateHandler(ProjectHandler):
     def get(self):
         message = escape(self.request.get("message"))
@@ -444,9 +409,7 @@ class ReactivateHandler(ProjectHandler):
 
     def post(self):
         email = self.request.get("email").lower()
-        existing_member = \
-            db.GqlQuery("SELECT * FROM Membership WHERE email = :email",
-            email=email).get()
+        existing_member = Membership.get_by_unique("email", email)
         if existing_member:
             membership = existing_member
 
@@ -606,18 +569,78 @@ class GenLinkHandler(ProjectHandler):
       self.response.out.write(self.render("templates/genlink.html", locals()))
 
 
+""" Lets admins create gift codes and get them out for printing. """
+class GiftCodesHandler(ProjectHandler):
+    """ Exports all the gift codes as CSV. """
+    @ProjectHandler.admin_only
+    def get(self):
+      self.response.headers["Content-Type"] = "text/csv"
+      self.response.headers["Content-Disposition"] = \
+          "attachment; filename=gift_codes.csv"
+
+      writer = csv.writer(self.response.out)
+      writer.writerow(["serial", "code", "redeemed", "email"])
+      for code in GiftCode.all().order("serial").run(batch_size=500):
+        writer.writerow([code.serial, code.pretty(), code.redeemed or "",
+                         code.email or ""])
+
+    """ Creates the codes for a range of serial numbers.
+    Parameters:
+    start: The first serial number.
+    end: The last serial number. """
+    @ProjectHandler.admin_only
+    def post(self):
+      try:
+        start = int(self.request.get("start"))
+        end = int(self.request.get("end"))
+      except ValueError:
+        self.response.set_status(400)
+        self.response.out.write("start and end must be serial numbers.")
+        return
+      if start < 0 or end < start or end > 9999:
+        self.response.set_status(400)
+        self.response.out.write("Serial numbers must be 0-9999.")
+        return
+
+      created = gift_codes.generate(start, end + 1)
+      self.response.out.write("Created %d code(s).\n" % (created))
+
+
+class WarmupHandler(ProjectHandler):
+    """ App Engine calls this before sending requests to a new instance. We use
+    it to compile all the templates ahead of time. """
+    def get(self):
+      load_times = project_handler.warm_templates()
+      for path, load_time in sorted(load_times.items()):
+        self.response.out.write("%s: %.3fs\n" % (path, load_time))
+
+      # The first instance of a new version starts the things that have to
+      # happen once after a deploy. The name keeps the rest from doing it again.
+      version = re.sub("[^a-zA-Z0-9-]", "-",
+                       os.environ.get("CURRENT_VERSION_ID", ""))
+      try:
+        taskqueue.add(url="/tasks/after_deploy",
+                      name="after-deploy-%s" % (version),
+                      params={"version": version})
+      except (taskqueue.TaskAlreadyExistsError,
+              taskqueue.TombstonedTaskError):
+        logging.debug("After-deploy task for %s was already started." % \
+                      (version))
+
+
 app = BaseApp([
         ("/", MainHandler),
-        ("/userlist", AllHandler),
-        ("/suspended", SuspendedHandler),
+        ("/userlist(.*)", AllHandler),
+        ("/suspended(.*)", SuspendedHandler),
         ("/profile", ProfileHandler),
         ("/key", KeyHandler),
         ("/genlink/(.+)", GenLinkHandler),
+        ("/giftcodes", GiftCodesHandler),
         ("/account/(.+)", AccountHandler),
         ("/upgrade/needaccount", NeedAccountHandler),
         ("/success/(.+)", SuccessHandler),
         ("/leavereasonlist(.*)", LeaveReasonListHandler),
-        ("/hardshiplist", HardshipHandler),
+        ("/hardshiplist(.*)", HardshipHandler),
         ("/memberlist(.*)", MemberListHandler),
         ("/unsubscribe/(.*)", UnsubscribeHandler),
         ("/update", UpdateHandler),
@@ -625,4 +648,5 @@ app = BaseApp([
         ("/plan/(.+)", SelectPlanHandler),
         ("/change_plan", ChangePlanHandler),
         ("/reactivate_plan/(.+)", ReactivatePlanHandler),
+        ("/_ah/warmup", WarmupHandler),
         ], debug=True)
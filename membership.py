@@ -1,5 +1,7 @@
+import base64
 import datetime
 import hashlib
+import hmac
 import logging
 import urllib
 import time
@@ -10,6 +12,8 @@ from google.appengine.ext import db
 from webapp2_extras import auth, security
 
 from config import Config
+import change_log
+import keymaster
 import plans
 
 
@@ -18,6 +22,9 @@ equivalently-named one found here:
 http://webapp-improved.appspot.com/_modules/webapp2_extras/appengine/
     auth/models.html """
 class UserToken:
+  # What signed tokens start with.
+  _SIGNED_PREFIX = "s1"
+
   """ Creates a new token for the given user.
   user: User unique ID.
   subject: The subject of the key, e.g. 'auth'.
@@ -55,12 +62,353 @@ class UserToken:
     key = "%s.%s.%s" % (user, subject, token)
     return memcache.get(key)
 
+  """ Creates a new signed token for the given user. Unlike normal tokens,
+  these contain everything needed to check them, so they don't have to be saved
+  anywhere.
+  user: User unique ID.
+  subject: The subject of the key, e.g. 'auth'.
+  expires: How long before the token expires, in seconds. It defaults to one
+  day.
+  Returns: A UserToken instance containing the token. """
+  @classmethod
+  def create_signed(cls, user, subject, expires=60 * 60 * 24):
+    issued = int(time.time())
+    generation = TokenGeneration.get_generation(user)
+    payload = "%s:%s:%d:%d:%d" % (user, subject, issued, issued + expires,
+                                  generation)
+    payload = base64.urlsafe_b64encode(payload).rstrip("=")
+    token = "%s.%s.%s" % (cls._SIGNED_PREFIX, payload, cls.__sign(payload))
+
+    user_token = cls(user, subject, token=token)
+    user_token.timestamp = issued
+    return user_token
+
+  """ Verifies a signed user token.
+  user: User unique ID.
+  subject: The subject of the key, e.g. 'auth'.
+  token: The token needing verification.
+  check_revoked: Whether to make sure that the token hasn't been revoked. This
+  is the only part of checking that might need to look anything up.
+  Returns: A UserToken instance containing the token, or None if the token is
+  not valid. """
+  @classmethod
+  def verify_signed(cls, user, subject, token, check_revoked=True):
+    if not cls.is_signed(token):
+      return None
+    _, payload, signature = token.split(".")
+    if not security.compare_hashes(signature, cls.__sign(payload)):
+      logging.warning("Token has a bad signature.")
+      return None
+
+    padding = "=" * (-len(payload) % 4)
+    fields = base64.urlsafe_b64decode(str(payload + padding)).split(":")
+    token_user, token_subject, issued, expires, generation = fields
+    if (token_user != str(user) or token_subject != subject):
+      return None
+    if int(expires) < time.time():
+      return None
+    if (check_revoked and \
+        int(generation) != TokenGeneration.get_generation(user)):
+      logging.info("Token for %s was revoked." % (user))
+      return None
+
+    user_token = cls(user, subject, token=token)
+    user_token.timestamp = int(issued)
+    return user_token
+
+  """ Checks whether a token is in the signed format. This doesn't check
+  whether it's valid.
+  token: The token.
+  Returns: True if it is signed. """
+  @classmethod
+  def is_signed(cls, token):
+    parts = token.split(".")
+    return (len(parts) == 3 and parts[0] == cls._SIGNED_PREFIX)
+
+  """ Signs part of a token.
+  payload: The part of the token to sign.
+  Returns: The signature. """
+  @classmethod
+  def __sign(cls, payload):
+    return hmac.new(_get_token_secret(), payload, hashlib.sha256).hexdigest()
+
+
+""" Gets the secret that we sign tokens with. This is the same secret that the
+sessions use.
+Returns: The secret. """
+def _get_token_secret():
+  if Config().is_testing:
+    # This matches what BaseApp uses.
+    return "notasecret"
+  return keymaster.get("token_secret")
+
+
+""" Counts how many times all the signed tokens for a user have been revoked.
+Signed tokens contain the generation that they were made in, and stop working
+as soon as it changes. The key name is the user ID. """
+class TokenGeneration(db.Model):
+  # Prefix for the memcache entries that cache generations.
+  _MEMCACHE_PREFIX = "token_generation."
+  # How long we keep generations in memory. Revoking tokens can take this long
+  # to reach every instance.
+  _LOCAL_CACHE_TIME = 60
+  # Maps user IDs to (generation, expiry time) tuples.
+  _local_cache = {}
+
+  generation = db.IntegerProperty(default=0)
+
+  """ Gets the current generation for a user.
+  user: User unique ID.
+  Returns: The generation. """
+  @classmethod
+  def get_generation(cls, user):
+    user = str(user)
+    now = time.time()
+    cached = cls._local_cache.get(user)
+    if (cached and cached[1] > now):
+      return cached[0]
+
+    generation = memcache.get(cls._MEMCACHE_PREFIX + user)
+    if generation is None:
+      entity = cls.get_by_key_name(user)
+      generation = entity.generation if entity else 0
+      memcache.set(cls._MEMCACHE_PREFIX + user, generation)
+
+    cls._local_cache[user] = (generation, now + cls._LOCAL_CACHE_TIME)
+    return generation
+
+  """ Revokes all the signed tokens for a user.
+  user: User unique ID. """
+  @classmethod
+  def revoke(cls, user):
+    user = str(user)
+
+    """ Increments the generation. """
+    def increment():
+      entity = cls.get_by_key_name(user)
+      if not entity:
+        entity = cls(key_name=user)
+      entity.generation += 1
+      entity.put()
+
+    db.run_in_transaction(increment)
+    memcache.delete(cls._MEMCACHE_PREFIX + user)
+    cls._local_cache.pop(user, None)
+
+
+""" Raised when writing a member would give them the same email, hash, or
+username as another member. """
+class DuplicateMemberError(Exception):
+  pass
+
+
+""" Maps a unique property value to the member that has it, so that members can
+be found with a get instead of a query, and so that no two members can end up
+with the same value. The key name is of the form <property>:<value>. Membership
+keeps these up to date whenever it is written. """
+class MemberLookup(db.Model):
+  # The properties that we keep lookups for.
+  PROPERTIES = ("email", "hash", "username")
+  # Prefix for the memcache entries that cache lookups.
+  _MEMCACHE_PREFIX = "member_lookup."
+
+  # The ID of the member with this value.
+  member_id = db.IntegerProperty(required=True)
+
+  """ Gets the key name of the lookup for a particular value.
+  prop: The name of the property.
+  value: The value of the property.
+  Returns: The key name. """
+  @classmethod
+  def key_name_for(cls, prop, value):
+    return "%s:%s" % (prop, value.strip().lower())
+
+  """ Finds the member with a particular value.
+  prop: The name of the property.
+  value: The value of the property.
+  Returns: The member, or None if there is no lookup for that value. """
+  @classmethod
+  def get_member(cls, prop, value):
+    key_name = cls.key_name_for(prop, value)
+    cache_key = cls._MEMCACHE_PREFIX + key_name
+
+    member_id = memcache.get(cache_key)
+    if member_id is None:
+      lookup = cls.get_by_key_name(key_name)
+      if not lookup:
+        return None
+      member_id = lookup.member_id
+
+    member = Membership.get_by_id(member_id)
+    if (not member or key_name not in member.lookup_names()):
+      # The lookup is stale.
+      memcache.delete(cache_key)
+      return None
+
+    memcache.set(cache_key, member_id)
+    return member
+
+  """ Finds the members with a lot of values at once.
+  prop: The name of the property.
+  values: The values of the property.
+  Returns: A dictionary mapping values to members. Values that there are no
+  lookups for are left out. """
+  @classmethod
+  def get_members(cls, prop, values):
+    key_names = dict([(value, cls.key_name_for(prop, value)) \
+                      for value in values])
+    cached = memcache.get_multi(key_names.values(),
+                                key_prefix=cls._MEMCACHE_PREFIX)
+
+    member_ids = {}
+    missing = [key_name for key_name in key_names.values() \
+               if key_name not in cached]
+    if missing:
+      for key_name, lookup in zip(missing, cls.get_by_key_name(missing)):
+        if lookup:
+          member_ids[key_name] = lookup.member_id
+    for key_name, member_id in cached.iteritems():
+      member_ids[key_name] = member_id
+    if not member_ids:
+      return {}
+
+    unique_ids = list(set(member_ids.values()))
+    members = dict(zip(unique_ids, Membership.get_by_id(unique_ids)))
+
+    found = {}
+    stale = []
+    for value, key_name in key_names.iteritems():
+      if key_name not in member_ids:
+        continue
+      member = members[member_ids[key_name]]
+      if (not member or key_name not in member.lookup_names()):
+        stale.append(key_name)
+        continue
+      found[value] = member
+
+    if stale:
+      # These lookups are stale.
+      memcache.delete_multi(stale, key_prefix=cls._MEMCACHE_PREFIX)
+    memcache.set_multi(dict([(key_name, member_id) \
+                             for key_name, member_id in member_ids.iteritems() \
+                             if key_name not in stale]),
+                       key_prefix=cls._MEMCACHE_PREFIX)
+    return found
+
+  """ Makes sure that nobody else is using any of a set of values. This should
+  be run inside a transaction.
+  member: The member that wants to use the values.
+  key_names: The key names of the lookups for the values.
+  Raises: DuplicateMemberError if someone else is using one of them. """
+  @classmethod
+  def check_available(cls, member, key_names):
+    member_id = member.key().id() if member.has_key() else None
+
+    for lookup in cls.get_by_key_name(list(key_names)):
+      if (not lookup or lookup.member_id == member_id):
+        continue
+
+      # Make sure that the other member hasn't since changed or been deleted
+      # behind our backs.
+      holder = Membership.get_by_id(lookup.member_id)
+      if (holder and lookup.key().name() in holder.lookup_names()):
+        prop, value = lookup.key().name().split(":", 1)
+        raise DuplicateMemberError("Another member already has %s '%s'." % \
+                                   (prop, value))
+
+  """ Points a set of lookups at a member, and removes another set. This should
+  be run inside a transaction.
+  member_id: The ID of the member.
+  released: The key names of the lookups that the member no longer uses.
+  claimed: The key names of the lookups that the member now uses. """
+  @classmethod
+  def move(cls, member_id, released, claimed):
+    if released:
+      to_delete = [lookup for lookup in cls.get_by_key_name(list(released)) \
+                   if (lookup and lookup.member_id == member_id)]
+      db.delete(to_delete)
+
+    if claimed:
+      db.put([cls(key_name=key_name, member_id=member_id) \
+              for key_name in claimed])
+
+  """ Removes lookups from memcache.
+  key_names: The key names of the lookups to remove. """
+  @classmethod
+  def uncache(cls, key_names):
+    if key_names:
+      memcache.delete_multi([cls._MEMCACHE_PREFIX + key_name \
+                             for key_name in key_names])
+
+
+""" Holds a username for a member while they finish signing up, so that two
+people can't pick the same one before either of them has a domain account. The
+key name is the lowercase username. """
+class UsernameReservation(db.Model):
+  # How long someone has to finish signing up before we let someone else have
+  # their username.
+  RESERVATION_TIME = datetime.timedelta(days=2)
+
+  # The ID of the member that has the username.
+  member_id = db.IntegerProperty(required=True)
+  # When the reservation runs out, or None if it never does.
+  expires = db.DateTimeProperty()
+
+  """ Reserves a username for a member. If someone else had it reserved but
+  never finished signing up, they lose it.
+  username: The username to reserve.
+  member: The member to reserve it for. This must already be saved.
+  Raises: DuplicateMemberError if someone else has the username. """
+  @classmethod
+  def claim(cls, username, member):
+    username = username.strip().lower()
+    member_id = member.key().id()
+
+    """ Checks and takes the reservation atomically. """
+    def do_claim():
+      now = datetime.datetime.now()
+      reservation = cls.get_by_key_name(username)
+      if (reservation and reservation.member_id != member_id):
+        holder = Membership.get_by_id(reservation.member_id)
+        if (holder and holder.username and \
+            holder.username.lower() == username):
+          if (reservation.expires == None or reservation.expires > now):
+            raise DuplicateMemberError("Username '%s' is reserved." % \
+                                       (username))
+
+          # They never finished, so they don't get to keep it.
+          logging.info("Reservation for '%s' expired." % (username))
+          holder.username = None
+          holder.put()
+
+      cls(key_name=username, member_id=member_id,
+          expires=now + cls.RESERVATION_TIME).put()
+
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options, do_claim)
+
+  """ Makes a member's reservation permanent, once they have a domain account.
+  username: The username.
+  member: The member that has it. """
+  @classmethod
+  def confirm(cls, username, member):
+    cls(key_name=username.strip().lower(), member_id=member.key().id(),
+        expires=None).put()
+
 
 """ A class for managing HackerDojo members. """
 class Membership(db.Model):
+  # Memcache key for the number that changes whenever a member's status does.
+  _STATUS_VERSION_KEY = "membership.status_version"
+  # The most values we can give to an IN filter in one query.
+  _MAX_IN_VALUES = 30
+
   hash = db.StringProperty()
   first_name = db.StringProperty(required=True)
   last_name = db.StringProperty(required=True)
+  # A lowercase copy of last_name, so we can sort by it in queries. put() keeps
+  # it up to date.
+  last_name_lower = db.StringProperty()
   email = db.StringProperty(required=True)
   # The hash of the user's password.
   # TODO(danielp): Make this required after we finish migrating away from domain
@@ -84,6 +432,15 @@ class Membership(db.Model):
   created = db.DateTimeProperty(auto_now_add=True)
   updated = db.DateTimeProperty()
 
+  # The plan (see Plan.occupancy_name) whose occupancy counter this member is
+  # currently included in, or None if they aren't counted anywhere. This lets
+  # put() figure out how to update the counters without an extra read.
+  counted_plan = db.StringProperty()
+
+  # Set whenever one of the properties in the change log changes, and cleared
+  # once the change has a version. See change_log for details.
+  change_token = db.StringProperty()
+
   # How many times the user has signed in this month.
   signins = db.IntegerProperty(default=0)
   # When the last time they signed in was.
@@ -100,15 +457,282 @@ class Membership(db.Model):
   # Temporarily stores the user's domain password.
   password = db.StringProperty(default=None)
 
+  def __init__(self, *args, **kwargs):
+    super(Membership, self).__init__(*args, **kwargs)
+
+    # The key names of the lookups that point to this member in the datastore,
+    # and the status that is saved there.
+    if kwargs.get("_from_entity"):
+      self._saved_lookups = self.lookup_names()
+      self._saved_status = self.status
+      self._saved_tracked = change_log.tracked_values(self)
+    else:
+      self._saved_lookups = set()
+      self._saved_status = None
+      self._saved_tracked = (None,) * len(change_log.TRACKED_PROPERTIES)
+
   """ Override of the default put method which allows us to skip changing the
   updated property for testing purposes.
   skip_time_update: Whether or not to set updated to the current date and time.
-  """
+  Raises: DuplicateMemberError if another member has the same email, hash, or
+  username. """
   def put(self, *args, **kwargs):
     if not kwargs.pop("skip_time_update", False):
       self.updated = datetime.datetime.now()
+    self.update_sort_keys()
+    self.update_change_token()
+
+    old_plan = self.counted_plan
+    new_plan = self.occupancy_plan()
+    old_lookups = self._saved_lookups
+    new_lookups = self.lookup_names()
+    if (old_plan == new_plan and old_lookups == new_lookups):
+      # Nothing else has to change along with this entity.
+      key = super(Membership, self).put(*args, **kwargs)
+      self._after_put([self])
+      return key
+
+    """ Writes the member, and updates the occupancy counters and lookups
+    atomically. """
+    def put_and_update():
+      MemberLookup.check_available(self, new_lookups - old_lookups)
+
+      self.counted_plan = new_plan
+      key = super(Membership, self).put(*args, **kwargs)
+      plans.PlanOccupancyShard.adjust(old_plan, -1)
+      plans.PlanOccupancyShard.adjust(new_plan, 1)
+      MemberLookup.move(key.id(), old_lookups - new_lookups,
+                        new_lookups - old_lookups)
+      return key
+
+    if db.is_in_transaction():
+      key = put_and_update()
+    else:
+      options = db.create_transaction_options(xg=True)
+      try:
+        key = db.run_in_transaction_options(options, put_and_update)
+      except:
+        # Don't leave a value that doesn't match what's in the datastore.
+        self.counted_plan = old_plan
+        raise
+
+    self._saved_lookups = new_lookups
+    MemberLookup.uncache(old_lookups ^ new_lookups)
+    self._after_put([self])
+    return key
+
+  """ Updates the properties that we only keep so that we can sort by them.
+  Returns: True if any of them changed. """
+  def update_sort_keys(self):
+    last_name_lower = self.last_name.lower() if self.last_name else None
+    if last_name_lower == self.last_name_lower:
+      return False
+
+    self.last_name_lower = last_name_lower
+    return True
+
+  """ Gives the member a new change token if any of the properties in the change
+  log changed, so that the change gets logged along with this write.
+  Returns: True if we need to log a change. """
+  def update_change_token(self):
+    if change_log.tracked_values(self) == self._saved_tracked:
+      return False
+
+    self.change_token = change_log.new_token()
+    return True
+
+  """ Gets the key names of all the lookups that should point to this member.
+  Returns: A set of key names. """
+  def lookup_names(self):
+    names = set()
+    for prop in MemberLookup.PROPERTIES:
+      value = getattr(self, prop)
+      if value:
+        names.add(MemberLookup.key_name_for(prop, value))
+
+    return names
+
+  """ Updates everything that depends on members after they have been written.
+  members: The members that were written. """
+  @classmethod
+  def _after_put(cls, members):
+    changed = [member for member in members \
+               if member.status != member._saved_status]
+    for member in changed:
+      member._saved_status = member.status
+    if changed:
+      cls._status_changed()
+
+    for member in members:
+      member._saved_tracked = change_log.tracked_values(member)
+
+  """ Marks everything that depends on which members have which status as stale.
+  """
+  @classmethod
+  def _status_changed(cls):
+    memcache.incr(cls._STATUS_VERSION_KEY, initial_value=0)
+
+  """ Gets a number that changes every time a member's status changes, so that
+  things that depend on it can be cached.
+  Returns: The current status version. """
+  @classmethod
+  def status_version(cls):
+    return memcache.get(cls._STATUS_VERSION_KEY) or 0
+
+  """ Writes a lot of members at once. This does the same bookkeeping as put(),
+  but all the members whose plan occupancy doesn't change get written with a
+  single datastore call.
+  members: The Membership objects to write.
+  skip_time_update: Same as for put().
+  Returns: A list of the keys of the members. """
+  @classmethod
+  def put_multi(cls, members, skip_time_update=False):
+    now = datetime.datetime.now()
+
+    unchanged = []
+    for member in members:
+      if not skip_time_update:
+        member.updated = now
+      member.update_sort_keys()
+      member.update_change_token()
+
+      if (member.occupancy_plan() == member.counted_plan and \
+          member.lookup_names() == member._saved_lookups):
+        unchanged.append(member)
+      else:
+        # These need their own transactions to update the counters and lookups.
+        member.put(skip_time_update=True)
+
+    if unchanged:
+      db.put(unchanged)
+      cls._after_put(unchanged)
+    return [member.key() for member in members]
+
+  """ Makes sure that a member is included in the right occupancy counter. The
+  member is read again in a transaction, so this can't undo anybody else's
+  write.
+  key: The key of the member.
+  Returns: True if the member had to be fixed. """
+  @classmethod
+  def fix_counted_plan(cls, key):
+    """ Moves the member to the right counter. """
+    def fix():
+      member = cls.get(key)
+      if not member:
+        return False
+      old_plan = member.counted_plan
+      new_plan = member.occupancy_plan()
+      if old_plan == new_plan:
+        return False
+
+      plans.PlanOccupancyShard.adjust(old_plan, -1)
+      plans.PlanOccupancyShard.adjust(new_plan, 1)
+      member.counted_plan = new_plan
+      # put() would change updated, which can change occupancy_plan().
+      db.Model.put(member)
+      return True
+
+    options = db.create_transaction_options(xg=True)
+    return db.run_in_transaction_options(options, fix)
+
+  """ Fixes a member's sort keys if they are missing or out of date. The member
+  is read again in a transaction, so this can't undo anybody else's write.
+  key: The key of the member.
+  Returns: True if the member had to be fixed. """
+  @classmethod
+  def fix_sort_keys(cls, key):
+    """ Updates the sort keys. """
+    def fix():
+      member = cls.get(key)
+      if not (member and member.update_sort_keys()):
+        return False
+      # put() would change updated, which can change occupancy_plan().
+      db.Model.put(member)
+      return True
+
+    return db.run_in_transaction(fix)
+
+  """ Recounts the members on every plan and fixes the plan occupancy counters.
+  put() keeps them up to date, but suspended members stop counting after a
+  while without anything being written, and writes that bypass put() also
+  aren't counted. This also runs once after every deploy, since members from
+  before we had counters aren't counted anywhere until it does.
+  batch_size: How many members to read at once.
+  Returns: How many members have sort keys that are missing or out of date. """
+  @classmethod
+  def reconcile_occupancy(cls, batch_size=200):
+    stale_sort_keys = 0
+    counted_plans = plans.PlanOccupancyShard.get_counted_plans()
+    for member in cls.all().run(batch_size=batch_size):
+      if member.occupancy_plan():
+        counted_plans.add(member.occupancy_plan())
+      if member.occupancy_plan() != member.counted_plan:
+        # This re-reads the member, so we can't overwrite a newer write.
+        cls.fix_counted_plan(member.key())
+      # This only changes our copy, which we never write.
+      if member.update_sort_keys():
+        stale_sort_keys += 1
+
+    # Now every member is counted where counted_plan says they are, so any
+    # counter that doesn't match that has drifted.
+    for plan in counted_plans:
+      """ Counts the members who are counted on the plan. """
+      def count_members(plan=plan):
+        return cls.all(keys_only=True).filter("counted_plan =", plan) \
+                  .count(limit=None)
+
+      delta = plans.PlanOccupancyShard.correct(plan, count_members)
+      if delta == None:
+        logging.warning("Not fixing counter for plan %s, because it kept" \
+                        " changing." % (plan))
+      elif delta:
+        logging.warning("Counter for plan %s was off by %d." % (plan, delta))
+
+    return stale_sort_keys
+
+  """ Override of the default delete method that also removes the member from
+  the plan occupancy counters and lookups. """
+  def delete(self, *args, **kwargs):
+    counted_plan = self.counted_plan
+    lookups = self._saved_lookups
+    member_id = self.key().id()
+
+    """ Deletes the member and everything that points to them atomically. """
+    def delete_and_update():
+      change_log.mark_deleted(self)
+      super(Membership, self).delete(*args, **kwargs)
+      plans.PlanOccupancyShard.adjust(counted_plan, -1)
+      MemberLookup.move(member_id, lookups, set())
+
+    if db.is_in_transaction():
+      delete_and_update()
+    else:
+      options = db.create_transaction_options(xg=True)
+      db.run_in_transaction_options(options, delete_and_update)
+
+    self._saved_lookups = set()
+    MemberLookup.uncache(lookups)
+    self._status_changed()
+
+  """ Figures out which plan occupancy counter this member should be included
+  in. Active members always count, and suspended members (or members who
+  haven't finished signing up) count if their entry has been updated recently.
+  Returns: The name of the counter, or None if this member shouldn't be
+  counted. """
+  def occupancy_plan(self):
+    if not self.plan:
+      return None
+
+    if self.status != "active":
+      if self.status not in ("suspended", None):
+        return None
+
+      threshold = datetime.datetime.now() - \
+          datetime.timedelta(days=Config().PLAN_USER_IGNORE_THRESHOLD)
+      if (not self.updated or self.updated <= threshold):
+        return None
 
-    super(Membership, self).put(*args, **kwargs)
+    return plans.Plan.occupancy_name_for(self.plan)
 
   def icon(self):
     return str("http://www.gravatar.com/avatar/" + hashlib.md5(self.email.lower()).hexdigest())
@@ -174,21 +798,29 @@ class Membership(db.Model):
 
     self.password_hash = security.generate_password_hash(password, length=12)
 
-  """ Creates a new authorization token for a given user ID.
+  """ Creates a new authorization token for a given user ID. It is signed, so
+  checking it later doesn't need memcache or the datastore.
   user_id: User unique ID.
   Returns: A string with the authorization token. """
   @classmethod
   def create_auth_token(cls, user_id):
-    token = UserToken(user_id, "auth")
-    token.save()
+    return UserToken.create_signed(user_id, "auth").token
 
-    return token.token
-
-  """ Deletes a given authorization token.
+  """ Deletes a given authorization token. Signed tokens can't be deleted one at
+  a time, so this revokes all of the user's signed tokens.
   user_id: User unique ID.
   token: A string with the authorization token. """
   @classmethod
   def delete_auth_token(cls, user_id, token):
+    if UserToken.is_signed(token):
+      if not UserToken.verify_signed(user_id, "auth", token):
+        logging.warning("Delete: Ignoring bad token for %d." % (user_id))
+        return
+
+      TokenGeneration.revoke(user_id)
+      return
+
+    # TODO: Remove this once all the old tokens have expired.
     token = UserToken.verify(user_id, "auth", token)
     if not token:
       logging.warning("Delete: Ignoring bad token for %d." % (user_id))
@@ -204,7 +836,11 @@ class Membership(db.Model):
   @classmethod
   def get_by_auth_token(cls, user_id, token):
     # First, check that the token is valid.
-    token = UserToken.verify(user_id, "auth", token)
+    if UserToken.is_signed(token):
+      token = UserToken.verify_signed(user_id, "auth", token)
+    else:
+      # TODO: Remove this once all the old tokens have expired.
+      token = UserToken.verify(user_id, "auth", token)
     if not token:
       logging.warning("Bad token, not getting user %d." % (user_id))
       return (None, None)
@@ -240,17 +876,97 @@ class Membership(db.Model):
       username = email.split("@")[0]
       return cls.get_by_username(username)
 
-    return cls.all().filter('email =', email).get()
+    return cls.get_by_unique("email", email)
+
+  """ Gets a lot of users by email at once.
+  emails: The emails of the users.
+  Returns: A dictionary mapping emails to membership objects. Emails that we
+  didn't find a user for are left out. """
+  @classmethod
+  def get_by_emails(cls, emails):
+    # TODO(danielp): Remove code for dealing with hackerdojo.com emails after
+    # we've finished migrating away from domain accounts.
+    usernames = {}
+    others = []
+    for email in emails:
+      if "@hackerdojo.com" in email:
+        usernames[email.split("@")[0]] = email
+      else:
+        others.append(email)
+
+    found = cls.get_by_unique_multi("email", others)
+    for username, member in \
+        cls.get_by_unique_multi("username", usernames.keys()).iteritems():
+      found[usernames[username]] = member
+    return found
 
   @classmethod
   def get_by_hash(cls, hash):
-    return cls.all().filter('hash =', hash).get()
+    return cls.get_by_unique("hash", hash)
 
   # This is a legacy method:
   # TODO(danielp): Remove this after we migrate away from domain accounts.
   @classmethod
   def get_by_username(cls, username):
-    return cls.all().filter('username =', username).get()
+    return cls.get_by_unique("username", username)
+
+  """ Gets the user with a specific value for a unique property. This uses a
+  lookup entity, so it is strongly consistent.
+  prop: The name of the property. It must be one of MemberLookup.PROPERTIES.
+  value: The value to look for.
+  Returns: The membership object, or None if no user was found. """
+  @classmethod
+  def get_by_unique(cls, prop, value):
+    if not value:
+      return None
+
+    member = MemberLookup.get_member(prop, value)
+    if member:
+      return member
+
+    # Members who haven't been written since we started keeping lookups won't
+    # have one yet, so fall back to a query.
+    member = cls.all().filter("%s =" % (prop), value).get()
+    if member:
+      logging.debug("Adding missing %s lookup for member %d." % \
+                    (prop, member.key().id()))
+      MemberLookup.get_or_insert(MemberLookup.key_name_for(prop, value),
+                                 member_id=member.key().id())
+
+    return member
+
+  """ Gets users with a lot of values for a unique property at once. This is the
+  batched version of get_by_unique().
+  prop: The name of the property. It must be one of MemberLookup.PROPERTIES.
+  values: The values to look for.
+  Returns: A dictionary mapping values to membership objects. Values that we
+  didn't find a user for are left out. """
+  @classmethod
+  def get_by_unique_multi(cls, prop, values):
+    values = [value for value in values if value]
+    found = MemberLookup.get_members(prop, values)
+
+    # Members who haven't been written since we started keeping lookups won't
+    # have one yet, so fall back to querying for them.
+    missing = [value for value in values if value not in found]
+    # The lookups ignore case and whitespace, so match what we find back up to
+    # the values that we were asked for the same way.
+    requested = {}
+    for value in missing:
+      key_name = MemberLookup.key_name_for(prop, value)
+      requested.setdefault(key_name, []).append(value)
+
+    for i in range(0, len(missing), cls._MAX_IN_VALUES):
+      chunk = missing[i:i + cls._MAX_IN_VALUES]
+      for member in cls.all().filter("%s IN" % (prop), chunk):
+        key_name = MemberLookup.key_name_for(prop, getattr(member, prop))
+        logging.debug("Adding missing %s lookup for member %d." % \
+                      (prop, member.key().id()))
+        MemberLookup.get_or_insert(key_name, member_id=member.key().id())
+        for value in requested.get(key_name, []):
+          found[value] = member
+
+    return found
 
   """ Creates a new user.
   email: The user's email. This will be used as a unique ID.
@@ -1,24 +1,135 @@
 """ Manages different plans. """
 
 
-import datetime
 import logging
+import random
 
 from google.appengine.api import users
 from google.appengine.ext import db
 
 from config import Config
 import keymaster
-import membership
+
+
+""" One shard of a counter that keeps track of how many members are taking up
+space on a plan, (along with its legacy pair) so that checking whether a plan is
+full doesn't require counting members. Membership.put() keeps these up to date,
+and a cron job periodically reconciles them against the real numbers. """
+class PlanOccupancyShard(db.Model):
+  # How many shards each counter is split across.
+  NUM_SHARDS = 10
+  # How many times we recount a plan when the counter keeps changing while we
+  # are counting.
+  CORRECT_ATTEMPTS = 3
+
+  # The occupancy name of the plan that this shard counts members for.
+  plan = db.StringProperty(required=True)
+  count = db.IntegerProperty(default=0)
+  # Goes up every time the shard changes, so we can tell whether it did.
+  updates = db.IntegerProperty(default=0, indexed=False)
+
+  """ Gets the keys of all the shards for a particular plan.
+  plan: The occupancy name of the plan.
+  Returns: A list of shard keys. """
+  @classmethod
+  def _shard_keys(cls, plan):
+    return [db.Key.from_path(cls.kind(), "%s.%d" % (plan, i)) \
+            for i in range(cls.NUM_SHARDS)]
+
+  """ Gets the total number of members counted for a plan.
+  plan: The occupancy name of the plan.
+  Returns: The number of members. """
+  @classmethod
+  def get_count(cls, plan):
+    shards = db.get(cls._shard_keys(plan))
+    return sum([shard.count for shard in shards if shard])
+
+  """ Changes the counter for a plan by a certain amount. This should be run
+  inside a transaction.
+  plan: The occupancy name of the plan, or None, in which case nothing is done.
+  delta: How much to change the counter by. """
+  @classmethod
+  def adjust(cls, plan, delta):
+    if not plan:
+      return
+
+    key = random.choice(cls._shard_keys(plan))
+    shard = db.get(key)
+    if not shard:
+      shard = cls(key_name=key.name(), plan=plan)
+    shard.count += delta
+    shard.updates += 1
+    shard.put()
+
+  """ Fixes the counter for a plan if it has drifted from the real number of
+  members. Counting can't happen in a transaction, so we remember what the
+  shards looked like before we counted, and only fix the counter in a
+  transaction that makes sure that they still look the same. If anybody changed
+  the counter in the meantime, we don't know whether our count includes their
+  change, so we count again.
+  plan: The occupancy name of the plan.
+  count_members: A function that returns the real number of members on the
+  plan.
+  Returns: How much the counter was off by, or None if it kept changing while
+  we were counting. """
+  @classmethod
+  def correct(cls, plan, count_members):
+    keys = cls._shard_keys(plan)
+
+    """ Returns: Something that changes whenever any of the shards does. """
+    def state(shards):
+      return [(shard.count, shard.updates) if shard else None \
+              for shard in shards]
+
+    options = db.create_transaction_options(xg=True)
+    for i in range(0, cls.CORRECT_ATTEMPTS):
+      before = state(db.get(keys))
+      total = count_members()
+
+      """ Fixes the counter, if nobody changed it while we were counting.
+      Returns: How much it was off by, or None if somebody changed it. """
+      def set_count():
+        shards = db.get(keys)
+        if state(shards) != before:
+          return None
+
+        delta = total - sum([shard.count for shard in shards if shard])
+        if delta:
+          shard = shards[0] or cls(key_name=keys[0].name(), plan=plan)
+          shard.count += delta
+          shard.updates += 1
+          shard.put()
+        return delta
+
+      delta = db.run_in_transaction_options(options, set_count)
+      if delta != None:
+        logging.info("Plan %s has %d members." % (plan, total))
+        return delta
+      logging.info("Counter for plan %s changed while counting." % (plan))
+
+    return None
+
+  """ Gets the names of every plan that has a counter.
+  Returns: A set of occupancy names. """
+  @classmethod
+  def get_counted_plans(cls):
+    return set([shard.plan for shard in cls.all()])
 
 
 """ Represents a single subscription plan. """
-class Plan:
+class Plan(object):
   # A list of all the plans that have been created.
   all_plans = []
   # A list of pairs of plans and their legacy plans.
   legacy_pairs = set()
 
+  # Maps the names and aliases of all plans to the plans themselves.
+  _by_name = {}
+  # Maps plans to their legacy or non-legacy counterparts.
+  _counterparts = {}
+  # The all_plans list that the two indices above were built from.
+  _indexed_plans = None
+
   def __init__(self, name, price_per_month, description,
                human_name=None, aliases=[], signin_limit=None,
                member_limit=None, legacy=None, selectable=True, full=False,
@@ -40,7 +151,7 @@ class Plan:
     """ A description of the plan. """
     self.description = description
     """ Any other names that this plan could be referred to by. """
-    self.aliases = aliases
+    self._aliases = list(aliases)
 
     """ None if this is not a legacy plan, otherwise the non-legacy version of
     the plan. """
@@ -66,44 +177,68 @@ class Plan:
     self.member_limit = member_limit
 
     Plan.all_plans.append(self)
+    self.__register()
+
+  """ Any other names that this plan could be referred to by. """
+  @property
+  def aliases(self):
+    return self._aliases
+
+  @aliases.setter
+  def aliases(self, aliases):
+    by_name = self._get_name_index()
+    for alias in self._aliases:
+      if by_name.get(alias) is self:
+        del by_name[alias]
+
+    self._aliases = list(aliases)
+    for alias in self._aliases:
+      by_name.setdefault(alias, self)
 
-  """ Updates the availability status of plans by looking in the datastore. """
+  """ Adds this plan to the name and counterpart indices. """
+  def __register(self):
+    by_name = self._get_name_index()
+
+    # If two plans share a name, the first one wins, like it always has.
+    by_name.setdefault(self.name, self)
+    for alias in self._aliases:
+      by_name.setdefault(alias, self)
+
+    if self.legacy:
+      self._counterparts[self] = self.legacy
+      self._counterparts[self.legacy] = self
+
+  """ Gets the name index, rebuilding both indices first if all_plans has been
+  replaced since they were built. (The unit tests do this to get rid of the real
+  plans.)
+  Returns: The name index. """
+  @classmethod
+  def _get_name_index(cls):
+    if Plan._indexed_plans is not Plan.all_plans:
+      Plan._indexed_plans = Plan.all_plans
+      Plan._by_name = {}
+      Plan._counterparts = {}
+
+      for plan in Plan.all_plans:
+        Plan._by_name.setdefault(plan.name, plan)
+        for alias in plan.aliases:
+          Plan._by_name.setdefault(alias, plan)
+      for plan1, plan2 in Plan.legacy_pairs:
+        Plan._counterparts[plan1] = plan2
+        Plan._counterparts[plan2] = plan1
+
+    return Plan._by_name
+
+  """ Updates the availability status of plans by looking at the occupancy
+  counter. """
   def __update_availability(self):
     # There's no limit, so there's not point in doing this.
     if self.member_limit == None:
       return
 
-    # If this plan has a legacy version or is a legacy version of another plan,
-    # we combine the members on both versions.
-    counterpart = self.get_legacy_pair()
-    if counterpart:
-      logging.debug("Including members from legacy pair '%s'." % \
-                    (counterpart.name))
-      query_plan = "plan in ('%s', '%s')" % (self.name, counterpart.name)
-    else:
-      query_plan = "plan = '%s'" % (self.name)
-
-    last_month = datetime.datetime.now() - \
-        datetime.timedelta(days=Config().PLAN_USER_IGNORE_THRESHOLD)
-    # Do it this way to avoid circular imports.
-    Membership = membership.Membership
-    # We don't have an OR operator, so do two separate queries for suspended
-    # (or members who haven't yet created their accounts), and non-suspended
-    # members.
-    suspended_query = db.GqlQuery("SELECT * FROM Membership WHERE %s AND " \
-        " status in ('suspended', NULL) AND updated >" \
-        " DATETIME(%d, %d, %d, %d, %d, %d)" % \
-        (query_plan, last_month.year, last_month.month, last_month.day,
-         last_month.hour, last_month.minute, last_month.second))
-    active_query = db.GqlQuery("SELECT * FROM Membership WHERE %s" \
-        " AND status = 'active'" % (query_plan))
-    suspended_members = suspended_query.count()
-    active_members = active_query.count()
-    logging.debug("Found %d suspended members on plan %s." % \
-        (suspended_members, self.name))
-    logging.debug("Found %d active members on plan %s." % \
-        (active_members, self.name))
-    num_members = active_members + suspended_members
+    # The counter combines the members on this plan and its legacy pair.
+    num_members = PlanOccupancyShard.get_count(self.occupancy_name())
+    logging.debug("Found %d members on plan %s." % (num_members, self.name))
 
     if num_members >= self.member_limit:
       # This plan is full.
@@ -112,29 +247,51 @@ class Plan:
       # This plan has space.
       self.full = False
 
+  """ Returns the name of the occupancy counter for this plan. If this plan has
+  a legacy version or is a legacy version of another plan, they share a
+  counter, which is named after the non-legacy plan. """
+  def occupancy_name(self):
+    if self.legacy:
+      return self.legacy.name
+    return self.name
+
+  """ Gets the name of the occupancy counter for a plan name.
+  name: The name of the plan, which can also be an alias.
+  Returns: The name of the counter. Plans that we don't know about just use
+  their name. """
+  @classmethod
+  def occupancy_name_for(cls, name):
+    try:
+      return cls.get_by_name(name).occupancy_name()
+    except ValueError:
+      return name
+
   """ Returns the plan that is either the legacy or non-legacy version of this
   one. If that plan does not exist, it returns None. """
   def get_legacy_pair(self):
-    for pair in self.legacy_pairs:
-      # See if we are part of the pair.
-      plan1, plan2 = pair
-      if plan1 == self:
-        return plan2
-      if plan2 == self:
-        return plan1
-
-    return None
+    self._get_name_index()
+    return Plan._counterparts.get(self)
 
   """ Gets a plan object based on the name of the plan.
   name: The name of the plan.
   Returns: The plan object corresponding to the plan. """
   @classmethod
   def get_by_name(cls, name):
-    for plan in cls.all_plans:
-      if (plan.name == name or name in plan.aliases):
-        return plan
+    plan = cls._get_name_index().get(name)
+    if not plan:
+      raise ValueError("Could not find plan '%s'." % (name))
 
-    raise ValueError("Could not find plan '%s'." % (name))
+    return plan
+
+  """ Gets the plan objects for a lot of plan names at once. This is meant for
+  pages that list many members.
+  names: The names of the plans. These can also be aliases.
+  Returns: A list of the plans, in the same order as the names. Names that don't
+  correspond to a plan get None instead of raising an exception. """
+  @classmethod
+  def get_many(cls, names):
+    by_name = cls._get_name_index()
+    return [by_name.get(name) for name in names]
 
   """ Get a list of the plans to show on the selection page.
   Returns: A tuple. The first item is a list of the plans to show as selectable,
@@ -1,8 +1,9 @@
-import json
 import logging
 import os
+import tempfile
+import time
 
-from google.appengine.api import memcache, urlfetch, users
+from google.appengine.api import memcache, users
 
 import jinja2
 
@@ -11,10 +12,101 @@ import webapp2
 
 from config import Config
 import keymaster
+import username_directory
+
+
+""" Caches compiled templates in memcache, so that new instances don't have to
+compile them again. If a template isn't in memcache, it also tries the
+filesystem, where it can, before giving up and compiling it. """
+class TemplateBytecodeCache(jinja2.BytecodeCache):
+  # Prefix for the memcache entries.
+  _MEMCACHE_PREFIX = "jinja2/"
+  # How long compiled templates stay in memcache.
+  _CACHE_TIME = 60 * 60 * 24
+
+  """ directory: The directory to use for the filesystem cache. """
+  def __init__(self, directory=None):
+    self.__files = None
+    try:
+      if not directory:
+        directory = os.path.join(tempfile.gettempdir(), "signup_templates")
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      self.__files = jinja2.FileSystemBytecodeCache(directory)
+    except (OSError, IOError, NotImplementedError):
+      # A lot of the time, we can't write to the filesystem.
+      logging.debug("Not using filesystem template cache.")
+
+  def load_bytecode(self, bucket):
+    code = memcache.get(self._MEMCACHE_PREFIX + bucket.key)
+    if code is not None:
+      bucket.bytecode_from_string(code)
+    if (bucket.code is None and self.__files):
+      try:
+        self.__files.load_bytecode(bucket)
+      except (OSError, IOError):
+        return
+      if bucket.code is not None:
+        # Put it back in memcache for the other instances.
+        self.__dump_to_memcache(bucket)
+
+  def dump_bytecode(self, bucket):
+    self.__dump_to_memcache(bucket)
+    if self.__files:
+      try:
+        self.__files.dump_bytecode(bucket)
+      except (OSError, IOError):
+        logging.debug("Failed to write template cache file.")
+        self.__files = None
+
+  """ Puts a compiled template in memcache.
+  bucket: The jinja2 bucket with the compiled template. """
+  def __dump_to_memcache(self, bucket):
+    memcache.set(self._MEMCACHE_PREFIX + bucket.key,
+                 bucket.bytecode_to_string(), time=self._CACHE_TIME)
 
 
 JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)), autoescape=True)
+    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)), autoescape=True,
+    bytecode_cache=TemplateBytecodeCache())
+
+# How long it took to render each template the first time on this instance, in
+# seconds.
+cold_render_times = {}
+
+
+""" Sets the template globals that never change. This only needs to happen once
+per instance. """
+def _set_static_globals():
+  if JINJA_ENVIRONMENT.globals.get("org_name") != None:
+    return
+
+  conf = Config()
+  static_globals = {"is_prod": conf.is_prod, "org_name": conf.ORG_NAME,
+      "analytics_id": conf.GOOGLE_ANALYTICS_ID, "domain": conf.APPS_DOMAIN}
+  if conf.is_dev:
+    static_globals["dev_message"] = "You are using the dev version of Signup."
+  JINJA_ENVIRONMENT.globals.update(static_globals)
+
+
+""" Compiles all our templates, so that the first requests to a new instance
+don't have to.
+Returns: A dictionary mapping the path to each template to how long it took to
+load, in seconds. """
+def warm_templates():
+  _set_static_globals()
+
+  load_times = {}
+  directory = os.path.join(os.path.dirname(__file__), "templates")
+  for name in sorted(os.listdir(directory)):
+    path = "templates/%s" % (name)
+    start_time = time.time()
+    JINJA_ENVIRONMENT.get_template(path)
+    load_times[path] = time.time() - start_time
+
+  logging.info("Warmed up %d templates in %.3f seconds." % \
+               (len(load_times), sum(load_times.values())))
+  return load_times
 
 
 """ A generic superclass for all handlers. """
@@ -78,9 +170,9 @@ class ProjectHandler(webapp2.RequestHandler):
   values: Values to fill in the template with.
   These values can also be passed in as individual keyword arguments. """
   def render(self, path, values={}, **kwargs):
-    conf = Config()
-    template_vars = {"is_prod": conf.is_prod, "org_name": conf.ORG_NAME,
-        "analytics_id": conf.GOOGLE_ANALYTICS_ID, "domain": conf.APPS_DOMAIN}
+    _set_static_globals()
+
+    template_vars = {}
     # Add the request object if we have one.
     try:
       template_vars["request"] = self.request
@@ -90,50 +182,36 @@ class ProjectHandler(webapp2.RequestHandler):
     template_vars.update(values)
     template_vars.update(kwargs)
 
-    if conf.is_dev:
-        template_vars["dev_message"] = "You are using the dev version of \
-            Signup."
+    if path in cold_render_times:
+      template = JINJA_ENVIRONMENT.get_template(path)
+      return template.render(template_vars)
 
+    # Keep track of how long it takes the first time.
+    start_time = time.time()
     template = JINJA_ENVIRONMENT.get_template(path)
-    return template.render(template_vars)
-
-  """ Fetches all the usernames in the datastore.
-  use_cache: Whether or not to use a cached version of the usernames.
-  Returns: A list of the usernames, or None upon failure. """
-  def fetch_usernames(self, use_cache=True):
+    rendered = template.render(template_vars)
+    cold_render_times[path] = time.time() - start_time
+    logging.info("First render of %s took %.3f seconds." % \
+                 (path, cold_render_times[path]))
+    return rendered
+
+  """ Gets the directory of usernames that are taken on the domain app.
+  Returns: A UsernameDirectory, or None upon failure. """
+  def fetch_usernames(self):
     conf = Config()
 
     if conf.is_testing:
       logging.info("Using fake usernames: %s" % (self.testing_usernames))
-      return self.testing_usernames
-
-    usernames = memcache.get("usernames")
-    if usernames and use_cache:
-      return usernames
-    else:
-      resp = urlfetch.fetch("http://%s/users" % conf.DOMAIN_HOST, deadline=10,
-                            follow_redirects=False)
-      if resp.status_code == 200:
-          usernames = [m.lower() for m in json.loads(resp.content)]
-          if not memcache.set("usernames", usernames, 60*60*24):
-              logging.error("Memcache set failed.")
-          return usernames
-      else:
-        logging.critical("Failed to fetch list of users. (%d)" %
-            (resp.status_code))
+      return username_directory.UsernameDirectory(self.testing_usernames)
 
+    usernames = username_directory.get()
+    if usernames == None:
       # Render error page.
       error_page = self.render("templates/error.html",
           message="/users returned non-OK status.",
           internal=True)
       self.response.out.write(error_page)
-      return None
-
-  """ Marks the cached list of usernames as stale. """
-  def invalidate_cached_usernames(self):
-    # It doesn't throw an exception if the item does not exist.
-    logging.debug("Cached usernames are now stale.")
-    memcache.delete("usernames")
+    return usernames
 
   """ Shortcut to access the auth instance as a property. """
   @webapp2.cached_property
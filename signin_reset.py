@@ -0,0 +1,164 @@
+""" Rolls over everyone's unused signins at the start of the month. The work is
+done in small batches by a chain of tasks, and a ledger entity for each month
+keeps track of how far we've gotten, so that retried tasks and repeated cron
+runs never roll anyone over twice. """
+
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from config import Config
+from membership import Membership
+
+
+# How many members we do in each batch. A batch is written in one cross-group
+# transaction, which can touch at most 25 entity groups. Besides the ledger and
+# the members themselves, each member can touch up to two plan occupancy shards.
+BATCH_SIZE = 8
+# The filters for each shard of members. Datastore cursors don't work with
+# "!=", so we split "signins != 0" into two queries that we run one after the
+# other. Rolling someone over never increases their signins, so members we've
+# already done never show up again later in the shard we're working on, and
+# nobody moves into a shard that is already finished.
+SHARDS = (("signins <", 0), ("signins >", 0))
+
+
+""" Keeps track of the rollover for one month. """
+class SigninResetRun(db.Model):
+  # The shard that we're working on.
+  shard = db.IntegerProperty(default=0)
+  # Where the next batch in that shard starts.
+  cursor = db.TextProperty()
+  # How many batches and members we've done so far.
+  batches = db.IntegerProperty(default=0)
+  members = db.IntegerProperty(default=0)
+  # The usernames of the members that we need to restore when we're done.
+  restores = db.StringListProperty(indexed=False)
+  started = db.DateTimeProperty(auto_now_add=True)
+  # When we finished, or None if we're still going.
+  finished = db.DateTimeProperty()
+
+
+""" Gets the name of the ledger for a particular month.
+when: A datetime in the month. Defaults to now.
+Returns: The name of the ledger, e.g. "2014-03". """
+def month_name(when=None):
+  if not when:
+    when = datetime.datetime.now()
+  return when.strftime("%Y-%m")
+
+
+""" Queues the task that does a batch. This has to be called inside a
+transaction, so that the task only runs if the ledger was updated.
+month: The name of the month we are doing.
+shard: The index of the shard in SHARDS.
+cursor: The cursor to start the batch at, or None to start at the beginning of
+the shard. """
+def _queue_batch(month, shard, cursor=None):
+  params = {"month": month, "shard": shard}
+  if cursor:
+    params["cursor"] = cursor
+  taskqueue.add(url="/tasks/reset_signins", params=params, transactional=True)
+
+
+""" Starts the rollover for a month, unless it has already been started.
+month: The name of the month. Defaults to the current month.
+Returns: True if we started it, False if it had already been started. """
+def start(month=None):
+  if not month:
+    month = month_name()
+
+  """ Creates the ledger and queues the first batch atomically. """
+  def create_run():
+    if SigninResetRun.get_by_key_name(month):
+      return False
+    SigninResetRun(key_name=month).put()
+    _queue_batch(month, 0)
+    return True
+
+  started = db.run_in_transaction(create_run)
+  if started:
+    logging.info("Starting signin rollover for %s." % (month))
+  else:
+    logging.warning("Signin rollover for %s was already started." % (month))
+  return started
+
+
+""" Rolls over the signins for one member.
+member: The member to roll over.
+Returns: True if they need to be restored because they had run out of visits.
+"""
+def _roll_over(member):
+  # Signins should roll over to the next month if they are not used. The way
+  # this is implemented is by making signins negative to start if the user
+  # has signins rolling over from last month.
+  rollovers = max(0, Config().LITE_VISITS - member.signins)
+  member.signins = 0 - rollovers
+
+  if member.status == "no_visits":
+    logging.info("Restoring user that ran out of visits: %s" % \
+                 (member.username))
+    member.status = "active"
+    return True
+  return False
+
+
+""" Does one batch of the rollover and queues the next one. If this batch has
+already been done, it does nothing, so it is safe to retry.
+month: The name of the month we are doing.
+shard: The index of the shard in SHARDS.
+cursor: The cursor that the batch starts at. """
+def process_batch(month, shard, cursor=None):
+  query = Membership.all(keys_only=True).filter(*SHARDS[shard])
+  query.with_cursor(start_cursor=cursor)
+  keys = query.fetch(BATCH_SIZE)
+  next_cursor = query.cursor()
+
+  """ Writes the batch and moves the ledger forward atomically. """
+  def do_batch():
+    run = SigninResetRun.get_by_key_name(month)
+    if (not run or run.finished or run.shard != shard or \
+        run.cursor != cursor):
+      logging.info("Batch for %s was already done." % (month))
+      return
+
+    members = [member for member in db.get(keys) if member and member.signins]
+    for member in members:
+      if not _roll_over(member):
+        continue
+      if not member.username:
+        # They don't have an account on the other apps to restore.
+        logging.info("Not notifying apps about member %d with no username." % \
+                     (member.key().id()))
+      elif member.username not in run.restores:
+        # Everything here is read again if the transaction gets retried, but
+        # make sure that nobody gets restored twice regardless.
+        run.restores.append(member.username)
+    if members:
+      # This isn't a change that the member made, so leave their update time.
+      Membership.put_multi(members, skip_time_update=True)
+
+    run.batches += 1
+    run.members += len(members)
+    if len(keys) == BATCH_SIZE:
+      # There might be more in this shard.
+      run.cursor = next_cursor
+      _queue_batch(month, shard, next_cursor)
+    elif shard + 1 < len(SHARDS):
+      run.shard = shard + 1
+      run.cursor = None
+      _queue_batch(month, run.shard)
+    else:
+      run.cursor = None
+      run.finished = datetime.datetime.now()
+      if run.restores:
+        taskqueue.add(url="/tasks/restore_members", transactional=True,
+                      queue_name="status-notifications",
+                      params={"username": run.restores})
+    run.put()
+
+  options = db.create_transaction_options(xg=True)
+  db.run_in_transaction_options(options, do_batch)
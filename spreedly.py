@@ -1,4 +1,6 @@
-import urllib2, xml.dom.minidom, base64
+import urllib2, base64, random, socket, time
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
 
 __version__ = '0.1'
 
@@ -6,19 +8,48 @@ SITE_NAME = 'your-site'
 SPREEDLY_BASE_URL = 'https://subs.pinpayments.com/api/v4/%(site)s/'
 SPREEDLY_TOKEN = 'your-token'
 
+# How long each request can take, in seconds.
+TIMEOUT = 30
+# How many times we retry GET requests that fail for reasons that might go
+# away on their own.
+RETRIES = 3
+# The base delay between retries, in seconds. It doubles every time.
+BACKOFF = 0.5
 
-def remove_whitespace_nodes(node, unlink=True):
-    remove_list = set()
 
-    for child in node.childNodes:
-        if child.nodeType == child.TEXT_NODE and not child.data.strip():
-            remove_list.add(child)
-        elif child.hasChildNodes():
-            remove_whitespace_nodes(child, unlink)
+def to_dict(element):
+    """
+    Converts an element into nested dicts. Elements with no children
+    become their text, or None if they only contain whitespace.
+    """
+    children = list(element)
+
+    if not children:
+        if element.text is None or not element.text.strip():
+            return None
+        return element.text
+
+    block = dict()
+
+    for child in children:
+        block[child.tag] = to_dict(child)
+
+    return block
 
-    for node in remove_list:
-        node.parentNode.removeChild(node)
-        node.unlink()
+def backoff_delay(attempt):
+    """
+    Returns how long to wait before the given retry, counting from zero.
+    The delay is random, so that a lot of clients that fail at
+    the same time don't all retry at the same time too.
+    """
+    return random.uniform(0, BACKOFF * 2 ** attempt)
+
+def is_retryable(code):
+    """
+    Returns whether a request that failed with this status code might
+    work if we try it again.
+    """
+    return code >= 500
 
 def get_code(response):
     if hasattr(response, 'code'):
@@ -28,42 +59,46 @@ def get_code(response):
 
 
 class XMLReply(object):
-    def __init__(self, payload):
+    """
+    Parses a reply incrementally. Unless stream is set, the whole reply
+    gets converted into nested dicts right away. Otherwise, use
+    iterchildren() to go through the children of the root element one at
+    a time.
+    """
+    def __init__(self, payload, stream=False):
         self.raw_payload = payload
-        self.data = payload.read()
-        self.xml = None
-
-        dom = self.to_xml()
-        self.dict = self.to_dict(dom.documentElement)
-
-    def to_xml(self):
-        if self.xml is None:
-            self.xml = xml.dom.minidom.parseString(self.data)
-            remove_whitespace_nodes(self.xml.documentElement)
-        return self.xml
-
-    def to_dict(self, parent):
-        child = parent.firstChild
-
-        if not child:
-            return None
-        elif child.nodeType == child.TEXT_NODE:
-            return child.nodeValue
-
-        block = dict()
-
-        while child is not None:
-            if child.nodeType == child.ELEMENT_NODE:
-                block[child.tagName] = self.to_dict(child)
-
-            child = child.nextSibling
-
-        return block
+        self.root = None
+        self.dict = None
+
+        if not stream:
+            self.dict = dict(self.iterchildren()) or to_dict(self.root)
+
+    def iterchildren(self):
+        """
+        Yields a (tag, dict) pair for each child of the root element as
+        soon as it has been parsed. Children are thrown away after that,
+        so this uses constant memory no matter how long the reply is.
+        """
+        depth = 0
+
+        for event, element in ElementTree.iterparse(self.raw_payload,
+                                                    events=('start', 'end')):
+            if event == 'start':
+                if self.root is None:
+                    self.root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1:
+                yield element.tag, to_dict(element)
+                self.root.clear()
 
     # --
 
     def __repr__(self):
-        return '<XMLReply: data=%d bytes>' % len(self.data)
+        tag = self.root.tag if self.root is not None else None
+        return '<XMLReply: root=%s>' % tag
 
 class SpreedlyResponseError(Exception):
     def __init__(self, response):
@@ -86,28 +121,58 @@ class Spreedly(object):
     Stupid-simple Python library for talking
     to spreedly.com.
     """
-    def __init__(self, site=SITE_NAME, base_url=SPREEDLY_BASE_URL, token=SPREEDLY_TOKEN):
+    def __init__(self, site=SITE_NAME, base_url=SPREEDLY_BASE_URL, token=SPREEDLY_TOKEN,
+                 timeout=TIMEOUT, retries=RETRIES):
         self.site = site
         self.base_url = base_url
         self.token = token
+        self.timeout = timeout
+        self.retries = retries
+
+        # We send the credentials with every request instead of waiting to
+        # be asked for them, and we reuse the same opener for everything,
+        # so there is nothing to set up per request, and nothing global.
+        self.headers = {'Authorization': 'Basic %s' % \
+                        base64.b64encode('%s:X' % self.token)}
+        self.opener = urllib2.build_opener()
 
     def url(self, rel_url):
         return self.base_url % { 'site': self.site }+rel_url
 
-    def request(self, url, data=None):
-        auth_handler = urllib2.HTTPBasicAuthHandler()
-        auth_handler.add_password(realm='Web Password',
-          uri='https://subs.pinpayments.com/', user=self.token,
-          passwd='X')
-        opener = urllib2.build_opener(auth_handler)
-        urllib2.install_opener(opener)
+    def open(self, url, data=None):
+        """
+        Makes a request, and returns the response. GET requests that fail
+        because of network errors or server errors are retried.
+        """
+        headers = self.headers
+        if data is not None:
+            headers = dict(headers)
+            headers['Content-Type'] = 'application/xml'
+        request = urllib2.Request(self.url(url), data, headers)
+        retries = self.retries if data is None else 0
+
+        attempt = 0
+        while True:
+            try:
+                response = self.opener.open(request, timeout=self.timeout)
+            except urllib2.HTTPError as e:
+                if attempt >= retries or not is_retryable(e.code):
+                    raise SpreedlyResponseError(e)
+            except (urllib2.URLError, socket.error):
+                if attempt >= retries:
+                    raise
+            else:
+                if not 200 <= get_code(response) < 300:
+                    raise SpreedlyResponseError(response)
+                return response
+
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
 
-        return self.to_reply(opener.open(self.url(url), data))
+    def request(self, url, data=None):
+        return self.to_reply(self.open(url, data))
 
     def to_reply(self, response):
-        if not get_code(response) == 200:
-            raise SpreedlyResponseError(response)
-
         return XMLReply(response).dict
 
     def url_factory(url):
@@ -115,7 +180,31 @@ class Spreedly(object):
             return self.request(url % kwargs, data)
         return wrapped_request
 
-    subscribers = url_factory('subscribers.xml')
+    def subscribers(self):
+        """
+        Yields every subscriber, one at a time, without ever holding the
+        whole list in memory.
+        """
+        reply = XMLReply(self.open('subscribers.xml'), stream=True)
+
+        for tag, subscriber in reply.iterchildren():
+            yield subscriber
+
+    def create_subscriber(self, customer_id, email):
+        """
+        Creates a subscriber, and returns their details.
+        """
+        data = '<subscriber><customer-id>%d</customer-id>' \
+               '<email>%s</email></subscriber>' % (customer_id, escape(email))
+        return self.request('subscribers.xml', data)
+
+    def add_credit(self, sub_id, amount):
+        """
+        Adds store credit to a subscriber's account.
+        """
+        data = '<credit><amount>%.2f</amount></credit>' % amount
+        self.open('subscribers/%d/credits.xml' % sub_id, data).read()
+
     subscription_plans = url_factory('subscription_plans.xml')
     subscriber_details = url_factory('subscribers/%(sub_id)d.xml')
 
@@ -127,4 +216,4 @@ if __name__ == "__main__":
 
     print sp.subscription_plans()
     print sp.subscriber_details(sub_id=1)
-    print sp.subscribers()
+    print list(sp.subscribers())
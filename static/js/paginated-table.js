@@ -19,15 +19,10 @@ pagination.setBaseUri = function(baseUri) {
  */
 pagination.paginatedTable = function(baseUri) {
   this.baseUri = baseUri;
-  // An array containing page data that we have loaded, in order. (We always
-  // load each page in order, because that makes the datastore happy.)
-  this.loadedPages_ = [];
-  // The cursor we will use to fetch the next page.
-  this.pageCursor_ = 'start';
-  // Whether we are currently waiting on a page load.
-  this.isLoading_ = false;
-  // Callbacks for all the deferred page load requests.
-  this.deferred_ = [];
+  // An object mapping page numbers to page data that we have loaded.
+  this.loadedPages_ = {};
+  // How many pages in a row we have loaded, starting from the first one.
+  this.preloadedPages_ = 0;
   // The currently active page marker.
   this.activePage_ = null;
 
@@ -96,63 +91,37 @@ pagination.paginatedTable = function(baseUri) {
     var renderFunction = function() {
       $('#loading-bar').hide();
 
-      var pageData = outer_this.loadedPages_[page - 1];
+      var pageData = outer_this.loadedPages_[page];
 
       // Display the page.
       $('#page-content').html(pageData);
     };
 
     // Check to see if this page is cached.
-    var loaderFunction = function() {
-      if (page > outer_this.loadedPages_.length) {
-        // We need to fetch more pages first.
-        outer_this.loadPage_(loaderFunction);
-      } else {
-        // We have the data we need to render the page.
-        renderFunction();
-      }
-    };
-    loaderFunction();
+    if (this.loadedPages_[page] === undefined) {
+      this.loadPage_(page, renderFunction);
+    } else {
+      renderFunction();
+    }
   };
 
-  /** Loads data for the next page.
+  /** Loads data for a page. The backend remembers where each page starts, so
+   * we can load them in any order.
    * @private
+   * @param {Number} page: The page number to load.
    * @param {Object} callback: Function to call after the page is loaded.
    */
-  this.loadPage_ = function(callback) {
+  this.loadPage_ = function(page, callback) {
     var outer_this = this;
 
-    var doLoad = function(callback) {
-      outer_this.isLoading_ = true;
-
-      // Perform an AJAX request to get the page content.
-      $.get(this.baseUri, {'page': outer_this.pageCursor_}, function(data) {
-        // Save the page data.
-        var pageData = JSON.parse(data);
-        outer_this.pageCursor_ = pageData['nextPage'];
-        outer_this.loadedPages_.push(pageData['html']);
-
-        // If we have any deferred calls, run it again.
-        if (outer_this.deferred_.length) {
-          var deferredCallback = outer_this.deferred_.shift();
-          doLoad(deferredCallback);
-        } else {
-          // Nothing to run.
-          outer_this.isLoading_ = false;
-        }
+    // Perform an AJAX request to get the page content.
+    $.get(this.baseUri, {'page_number': page}, function(data) {
+      // Save the page data.
+      var pageData = JSON.parse(data);
+      outer_this.loadedPages_[page] = pageData['html'];
 
-        callback();
-      });
-    };
-
-    // Because of the way the cursor-based pagination system works, we have to
-    // serialize all these AJAX requests. Otherwise, it's entirely possible that
-    // it will start two requests using the same cursor.
-    if (this.isLoading_) {
-      this.deferred_.push(callback);
-    } else {
-      doLoad(callback);
-    }
+      callback();
+    });
   };
 
   /** Preemtively loads all the pages so they can be ready when we need them.
@@ -161,9 +130,19 @@ pagination.paginatedTable = function(baseUri) {
   this.preloadPages_ = function() {
     var outer_this = this;
 
+    // We load them one at a time, so the backend can remember where each page
+    // starts as it goes.
     var loaderFunction = function() {
-      if (outer_this.loadedPages_.length < outer_this.totalPages_) {
-        outer_this.loadPage_(loaderFunction);
+      outer_this.preloadedPages_ += 1;
+      var page = outer_this.preloadedPages_;
+      if (page > outer_this.totalPages_) {
+        return;
+      }
+
+      if (outer_this.loadedPages_[page] === undefined) {
+        outer_this.loadPage_(page, loaderFunction);
+      } else {
+        loaderFunction();
       }
     };
 
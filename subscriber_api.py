@@ -1,73 +1,133 @@
 from datetime import datetime, date, time, timedelta
 import logging
+import StringIO
+import time as time_module
 import urllib
 
 from google.appengine.api import mail, urlfetch, taskqueue
+from google.appengine.ext import db
 
 import dateutil.parser
 
 from config import Config
+from membership import Membership
 import keymaster
 import plans
 import spreedly
 
-""" Suspend the requested user.
-username: The username of the user to suspend. """
-def suspend(username):
+
+# The properties of a member that data from PinPayments can change.
+_SUBSCRIBER_PROPERTIES = ("status", "plan", "spreedly_token",
+                          "unsubscribe_reason", "domain_user")
+
+# The PinPayments client that we reuse for every request, along with the API
+# key that it was made with.
+_api = {"token": None, "client": None}
+
+
+""" Gets the shared PinPayments client.
+Returns: The client. """
+def get_api():
   conf = Config()
-  if conf.is_testing:
-    # Don't do this if we're testing.
-    return
+  token = conf.get_api_key()
+  if _api["token"] != token:
+    _api["client"] = spreedly.Spreedly(conf.SPREEDLY_ACCOUNT, token=token)
+    _api["token"] = token
+  return _api["client"]
 
-  resp = urlfetch.fetch("http://%s/suspend/%s" % \
-      (conf.DOMAIN_HOST, username),
-      method="POST", deadline=10,
-      payload=urllib.urlencode({"secret": keymaster.get("api")}),
-      follow_redirects=False)
 
-  if resp.status_code != 200:
-    # The domain app will handle retrying for us, so we don't block the queue.
-    logging.error("User suspension failed with status %d." % \
-                  (resp.status_code))
+""" The result of notifying the domain and events apps about a change in a
+user's status. Both requests are made concurrently. """
+class StatusChangeFuture(object):
+  """ domain_rpc: The RPC for the request to the domain app.
+  events_rpc: The RPC for the request to the events app.
+  status: The new status of the user. """
+  def __init__(self, domain_rpc, events_rpc, status):
+    self.domain_rpc = domain_rpc
+    self.events_rpc = events_rpc
+    self.status = status
 
-  # Alert the events app that the user's status has changed.
-  query = {"username": username, "status": "suspended"}
-  response = urlfetch.fetch("http://%s/api/v1/status_change" % \
-                            (conf.EVENTS_HOST), method="POST",
-                            payload=urllib.urlencode(query),
-                            follow_redirects=False)
+  """ Waits for both requests to finish.
+  Returns: False if either of the apps didn't get the change. """
+  def get_result(self):
+    succeeded = True
+    if self.domain_rpc:
+      resp = self.domain_rpc.get_result()
+      if resp.status_code != 200:
+        logging.error("Changing user status to %s failed with status %d." % \
+                      (self.status, resp.status_code))
+        succeeded = False
 
-  if response.status_code != 200:
-    logging.warning("Notifying events app failed.")
+    if self.events_rpc:
+      response = self.events_rpc.get_result()
+      if response.status_code != 200:
+        logging.warning("Notifying events app failed.")
+        succeeded = False
 
-""" Restore the requested user.
-username: The username of the user to restore. """
-def restore(username):
+    return succeeded
+
+""" Starts notifying the domain and events apps about a change in a user's
+status.
+username: The username of the user.
+action: The domain app action to perform, either 'suspend' or 'restore'.
+status: The new status to tell the events app about.
+Returns: A StatusChangeFuture for the requests. """
+def _change_status_async(username, action, status):
   conf = Config()
   if conf.is_testing:
     # Don't do this if we're testing.
-    return
+    return StatusChangeFuture(None, None, status)
 
-  resp = urlfetch.fetch("http://%s/restore/%s" % \
-      (conf.DOMAIN_HOST, username),
-      method="POST", deadline=10,
+  domain_rpc = urlfetch.create_rpc(deadline=10)
+  urlfetch.make_fetch_call(domain_rpc, "http://%s/%s/%s" % \
+      (conf.DOMAIN_HOST, action, username),
+      method="POST",
       payload=urllib.urlencode({"secret": keymaster.get("api")}),
       follow_redirects=False)
 
-  if resp.status_code != 200:
-    # The domain app will handle retrying for us, so we don't block the queue.
-    logging.error("User restoration failed with status %d." % \
-                  (resp.status_code))
-
   # Alert the events app that the user's status has changed.
-  query = {"username": username, "status": "active"}
-  response = urlfetch.fetch("http://%s/api/v1/status_change" % \
-                            (conf.EVENTS_HOST), method="POST",
-                            payload=urllib.urlencode(query),
-                            follow_redirects=False)
+  events_rpc = urlfetch.create_rpc()
+  query = {"username": username, "status": status}
+  urlfetch.make_fetch_call(events_rpc, "http://%s/api/v1/status_change" % \
+                           (conf.EVENTS_HOST), method="POST",
+                           payload=urllib.urlencode(query),
+                           follow_redirects=False)
+
+  return StatusChangeFuture(domain_rpc, events_rpc, status)
+
+""" Starts suspending the requested user.
+username: The username of the user to suspend.
+Returns: A StatusChangeFuture. """
+def suspend_async(username):
+  return _change_status_async(username, "suspend", "suspended")
 
-  if response.status_code != 200:
-    logging.warning("Notifying events app failed.")
+""" Starts restoring the requested user.
+username: The username of the user to restore.
+Returns: A StatusChangeFuture. """
+def restore_async(username):
+  return _change_status_async(username, "restore", "active")
+
+""" Suspend the requested user.
+username: The username of the user to suspend.
+Returns: False if either of the apps didn't get the change. """
+def suspend(username):
+  return suspend_async(username).get_result()
+
+""" Restore the requested user.
+username: The username of the user to restore.
+Returns: False if either of the apps didn't get the change. """
+def restore(username):
+  return restore_async(username).get_result()
+
+""" Suspends or restores a user from a task, so that whoever is calling this
+doesn't have to wait for the other apps to respond. If this is called in a
+transaction, the task only gets queued if the transaction commits.
+username: The username of the user.
+status: Either 'suspended' or 'active'. """
+def queue_status_change(username, status):
+  taskqueue.add(url="/tasks/status_change", queue_name="status-notifications",
+                params={"username": username, "status": status},
+                transactional=db.is_in_transaction())
 
 """ Handle PinPayments XML data for a particular subscriber, updating the
 corresponding membership instance to be on the proper plan and have the
@@ -112,28 +172,36 @@ def update_plan(subscriber, member):
                      " it was cancelled." % (member.username))
         member.plan = plan.get_legacy_pair().name
 
-""" Gets the data from PinPayments for a particular subscriber and updates
-their status accordingly.
-member: The Membership object we are updating.
-Returns: True if the member is active,
-    False otherwise, and the plan of the member. """
-def update_subscriber(member):
-  if not member:
-    return
+""" Applies the data from PinPayments for a particular subscriber to their
+membership object. This only changes fields. It doesn't write the member, send
+any email, or notify any other apps.
+subscriber: The subscriber data from PinPayments.
+member: The Membership object we are updating. """
+def _apply_subscriber(subscriber, member):
+  logging.debug("subscriber_info: %s" % (subscriber))
+
+  update_plan(subscriber, member)
+
+  if member.status in ("active", "no_visits") and member.unsubscribe_reason:
+    member.unsubscribe_reason = None
+
+  member.spreedly_token = subscriber["token"]
+  member.plan = subscriber["feature-level"] or member.plan
 
+""" Does the things besides updating fields that have to happen when PinPayments
+tells us about a subscriber: asking for PayPal subscriptions to be cancelled,
+and creating domain accounts. This doesn't write the member.
+member: The Membership object, after _apply_subscriber().
+old_status: The status the member had before _apply_subscriber(). """
+def _subscriber_side_effects(member, old_status):
   conf = Config()
-  api = spreedly.Spreedly(conf.SPREEDLY_ACCOUNT, token=conf.get_api_key())
-  subscriber = api.subscriber_details(sub_id=int(member.key().id()))
-  logging.debug("subscriber_info: %s" % (subscriber))
 
-  if member.status == "paypal":
+  if old_status == "paypal":
     mail.send_mail(sender=conf.EMAIL_FROM,
     to=conf.PAYPAL_EMAIL,
     subject="Please cancel PayPal subscription for %s" % member.full_name(),
     body=member.email)
 
-  update_plan(subscriber, member)
-
   if (member.status in ("active", "no_visits") and not member.domain_user):
     if not member.password:
       # In this case, it pulled an old datastore entry and updated the schema,
@@ -152,22 +220,266 @@ def update_subscriber(member):
                             "password": member.password},
                     countdown=3)
 
-  if member.status in ("active", "no_visits") and member.unsubscribe_reason:
-    member.unsubscribe_reason = None
+""" The result of getting the data from PinPayments for a lot of subscribers at
+once. All the requests are made concurrently, and the ones that fail for
+reasons that might go away on their own are retried together. """
+class SubscriberDetailsFuture(object):
+  """ subscriber_ids: The PinPayments IDs of the subscribers. (These are the
+  same as the IDs of the members.) """
+  def __init__(self, subscriber_ids):
+    self.__api = get_api()
+    self.__subscribers = {}
+    self.__attempt = 0
+    self.__rpcs = self.__start(subscriber_ids)
 
-  member.spreedly_token = subscriber["token"]
-  member.plan = subscriber["feature-level"] or member.plan
+  """ Starts requests for a set of subscribers.
+  subscriber_ids: The IDs of the subscribers.
+  Returns: A dictionary mapping subscriber IDs to RPCs. """
+  def __start(self, subscriber_ids):
+    rpcs = {}
+    for subscriber_id in subscriber_ids:
+      rpc = urlfetch.create_rpc(deadline=self.__api.timeout)
+      urlfetch.make_fetch_call(rpc,
+          self.__api.url("subscribers/%d.xml" % (subscriber_id)),
+          headers=self.__api.headers, follow_redirects=False)
+      rpcs[subscriber_id] = rpc
+    return rpcs
+
+  """ Waits for all the requests to finish.
+  Returns: A dictionary mapping subscriber IDs to subscriber data. Subscribers
+  that we couldn't get data for are left out. """
+  def get_result(self):
+    while self.__rpcs:
+      retry = []
+      for subscriber_id, rpc in self.__rpcs.iteritems():
+        try:
+          response = rpc.get_result()
+        except urlfetch.Error as e:
+          logging.warning("Fetching subscriber %d failed: %s" % \
+                          (subscriber_id, e))
+          retry.append(subscriber_id)
+          continue
+
+        if response.status_code != 200:
+          logging.warning("Fetching subscriber %d failed with status %d." % \
+                          (subscriber_id, response.status_code))
+          if spreedly.is_retryable(response.status_code):
+            retry.append(subscriber_id)
+          continue
+
+        self.__subscribers[subscriber_id] = \
+            spreedly.XMLReply(StringIO.StringIO(response.content)).dict
+
+      self.__rpcs = {}
+      if not retry:
+        break
+      if self.__attempt >= self.__api.retries:
+        logging.error("Giving up on %d subscriber(s)." % (len(retry)))
+        break
+
+      time_module.sleep(spreedly.backoff_delay(self.__attempt))
+      self.__attempt += 1
+      self.__rpcs = self.__start(retry)
+
+    return self.__subscribers
+
+
+""" Starts getting the data from PinPayments for a lot of subscribers at once.
+subscriber_ids: The PinPayments IDs of the subscribers.
+Returns: A SubscriberDetailsFuture. """
+def fetch_subscriber_details_async(subscriber_ids):
+  return SubscriberDetailsFuture(subscriber_ids)
+
+""" Gets the data from PinPayments for a lot of subscribers at once.
+subscriber_ids: The PinPayments IDs of the subscribers.
+Returns: A dictionary mapping subscriber IDs to subscriber data. Subscribers that
+we couldn't get data for are left out. """
+def fetch_subscriber_details(subscriber_ids):
+  return fetch_subscriber_details_async(subscriber_ids).get_result()
+
+""" Applies the data from PinPayments to a lot of members at once, and works out
+what changed for each of them. Nothing gets written.
+pairs: A list of (subscriber data, member) tuples.
+only_changed: If True, the side effects in _subscriber_side_effects() only
+happen for members whose status or plan changed. The webhook wants them every
+time, but reconciling runs every night for every member.
+Returns: A list of (member, changes) tuples for the members that changed, where
+changes maps property names to (old value, new value) tuples. """
+def _apply_subscribers(pairs, only_changed=False):
+  changed_members = []
+  for subscriber, member in pairs:
+    old_values = [getattr(member, name) for name in _SUBSCRIBER_PROPERTIES]
+    old_status = member.status
+    old_plan = member.plan
+    _apply_subscriber(subscriber, member)
+    if (not only_changed or member.status != old_status or \
+        member.plan != old_plan):
+      _subscriber_side_effects(member, old_status)
+
+    changes = {}
+    for name, old_value in zip(_SUBSCRIBER_PROPERTIES, old_values):
+      new_value = getattr(member, name)
+      if new_value != old_value:
+        changes[name] = (old_value, new_value)
+    if changes:
+      changed_members.append((member, changes))
+
+  return changed_members
+
+""" Saves members, and tells the other apps about the ones whose status changed.
+Each of those gets written in its own transaction, along with the task that
+notifies the other apps, so the notification gets sent if and only if the new
+status was saved, and it keeps getting retried until the other apps get it.
+members: All the members to save.
+changed_members: The changed members, as returned by _apply_subscribers().
+Returns: The members that we queued notifications for. """
+def _save_and_notify(members, changed_members):
+  notify = {}
+  for member, changes in changed_members:
+    if ("status" not in changes or not member.domain_user):
+      continue
+    if member.status in ("active", "suspended"):
+      notify[member.key()] = member
+
+  others = [member for member in members if member.key() not in notify]
+  if others:
+    Membership.put_multi(others)
+
+  options = db.create_transaction_options(xg=True)
+  for member in notify.values():
+    if member.status == "active":
+      logging.info("Restoring User: %s" % (member.username))
+    else:
+      logging.info("Suspending User: %s" % (member.username))
+
+    """ Writes the member and queues the notification atomically. """
+    def put_and_notify(member=member):
+      member.put()
+      queue_status_change(member.username, member.status)
+
+    db.run_in_transaction_options(options, put_and_notify)
+
+  return notify.values()
+
+""" Updates a lot of subscribers at once with their data from PinPayments. The
+members are fetched and written in batches, and other apps are only notified
+about members whose status actually changed.
+member_ids: The IDs of the members to update.
+Returns: A list of the IDs that we couldn't update because fetching them from
+PinPayments failed. """
+def update_subscribers(member_ids):
+  keys = [db.Key.from_path("Membership", member_id) \
+          for member_id in member_ids]
+  members = [member for member in db.get(keys) if member]
+  if len(members) != len(keys):
+    logging.warning("Ignoring %d nonexistent members." % \
+                    (len(keys) - len(members)))
+
+  subscribers = fetch_subscriber_details([member.key().id() \
+                                          for member in members])
+
+  pairs = []
+  failed = []
+  for member in members:
+    subscriber = subscribers.get(member.key().id())
+    if not subscriber:
+      failed.append(member.key().id())
+      continue
+    pairs.append((subscriber, member))
+
+  changed_members = _apply_subscribers(pairs)
+  _save_and_notify([member for subscriber, member in pairs], changed_members)
+
+  return failed
+
+
+""" A summary of what a reconciliation with PinPayments did. """
+class ReconcileReport(object):
+  def __init__(self):
+    # How many subscribers PinPayments told us about.
+    self.subscribers = 0
+    # The customer IDs of subscribers that we don't have a member for.
+    self.unknown = []
+    # A list of (member ID, name, changes) tuples for every member we changed.
+    self.changes = []
+    # The IDs of the members whose status change we queued notifications for.
+    self.notified = []
+
+  """ Returns: A readable version of the report. """
+  def __str__(self):
+    lines = ["Checked %d subscriber(s), changed %d member(s)." % \
+             (self.subscribers, len(self.changes)),
+             "Queued status notifications for %d member(s)." % \
+             (len(self.notified))]
+
+    for member_id, name, changes in self.changes:
+      lines.append("")
+      lines.append("%s (%d):" % (name, member_id))
+      for prop in sorted(changes.keys()):
+        old_value, new_value = changes[prop]
+        lines.append("  %s: %s -> %s" % (prop, old_value, new_value))
+
+    if self.unknown:
+      lines.append("")
+      lines.append("Subscribers with no member: %s" % \
+                   (", ".join([str(customer_id) \
+                               for customer_id in self.unknown])))
+
+    return "\n".join(lines)
+
+
+""" Reconciles one batch of subscribers with their members.
+subscribers: The subscriber data for the batch.
+report: The ReconcileReport to add to. """
+def _reconcile_batch(subscribers, report):
+  report.subscribers += len(subscribers)
+
+  keys = []
+  known = []
+  for subscriber in subscribers:
+    customer_id = subscriber.get("customer-id")
+    try:
+      keys.append(db.Key.from_path("Membership", int(customer_id)))
+    except (TypeError, ValueError):
+      report.unknown.append(customer_id)
+      continue
+    known.append(subscriber)
+
+  pairs = []
+  for subscriber, member in zip(known, db.get(keys)):
+    if not member:
+      report.unknown.append(subscriber["customer-id"])
+      continue
+    pairs.append((subscriber, member))
+
+  changed_members = _apply_subscribers(pairs, only_changed=True)
+  if not changed_members:
+    return
+
+  # The notifications are queued in the same transactions as the writes, so
+  # these are the ones that will definitely get sent.
+  notified = _save_and_notify([member for member, changes in changed_members],
+                              changed_members)
+  report.notified.extend([member.key().id() for member in notified])
+
+  for member, changes in changed_members:
+    report.changes.append((member.key().id(), member.full_name(), changes))
 
-  member.put()
+""" Makes every member match their PinPayments subscription, in case we missed
+some updates. We go through the whole subscriber list once, get the matching
+members in batches, and only write the ones that changed.
+batch_size: How many subscribers to handle at once.
+Returns: A ReconcileReport. """
+def reconcile_subscribers(batch_size=200):
+  report = ReconcileReport()
 
-  # TODO: After a few months (now() = 06.13.2011), only suspend/restore if
-  # status CHANGED. As of right now, we can't trust previous status, so lets
-  # take action on each call to /update
-  if member.status == "active" and member.domain_user:
-    logging.info("Restoring User: %s" % (member.username))
-    restore(member.username)
-  if member.status == "suspended" and member.domain_user:
-    logging.info("Suspending User: %s" % (member.username))
-    suspend(member.username)
+  batch = []
+  for subscriber in get_api().subscribers():
+    batch.append(subscriber)
+    if len(batch) >= batch_size:
+      _reconcile_batch(batch, report)
+      batch = []
+  if batch:
+    _reconcile_batch(batch, report)
 
-  return ((member.status in ("active", "no_visits")), member.plan)
+  return report
@@ -8,8 +8,12 @@ from google.appengine.api import mail, taskqueue, urlfetch
 
 from config import Config
 from main import SuccessHandler
-from membership import Membership
+from membership import Membership, UsernameReservation
 from project_handler import ProjectHandler, BaseApp
+import gift_codes
+import signin_reset
+import subscriber_api
+import username_directory
 
 
 """ Superclass for all taskqueue handlers. """
@@ -125,8 +129,10 @@ class CreateUserTask(QueueHandlerBase):
         # I want to see what query string it would have used.
         self.response.out.write(payload)
 
-      # Invalidate the current cached usernames, since we added a new one.
-      self.invalidate_cached_usernames()
+      # Put the new username in the directory right away, and make sure
+      # nobody else can reserve it.
+      username_directory.add(username)
+      UsernameReservation.confirm(username, membership)
 
       membership.domain_user = True
       # We'll never use the password again, and there's no sense in
@@ -159,6 +165,10 @@ class AreYouStillThereMail(QueueHandlerBase):
       # Don't change the status, because we don't want it to try the request
       # again.
       return
+    if user.unsubscribe_reason:
+      logging.info("Not sending email to %s, who unsubscribed." % \
+                   (user.username))
+      return
 
     logging.info("Sending email to %s %s." % \
                   (user.first_name, user.last_name))
@@ -224,8 +234,168 @@ class CleanupTask(QueueHandlerBase):
     user.delete()
 
 
+""" Updates a chunk of subscribers after PinPayments tells us that they
+changed. """
+class UpdateSubscribersTask(QueueHandlerBase):
+  """ Parameters:
+  subscriber_ids: A comma-separated list of the IDs of the subscribers.
+  retries: How many times we've retried this already. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    subscriber_ids = [int(id) for id in \
+                      self.request.get("subscriber_ids").split(",")]
+    failed = subscriber_api.update_subscribers(subscriber_ids)
+    if not failed:
+      return
+
+    # Try again later with only the ones that failed.
+    retries = int(self.request.get("retries", 0)) + 1
+    if retries > 5:
+      logging.error("Giving up on updating subscribers %s." % (failed))
+      return
+    failed = ",".join([str(id) for id in failed])
+    taskqueue.add(url="/tasks/update_subscribers",
+                  queue_name="subscriber-updates", countdown=60 * retries,
+                  params={"subscriber_ids": failed, "retries": retries})
+
+
+""" Tells the domain and events apps that a user has been suspended or
+restored. """
+class StatusChangeTask(QueueHandlerBase):
+  """ Parameters:
+  username: The username of the user.
+  status: The new status of the user, either 'suspended' or 'active'. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    username = self.request.get("username")
+    status = self.request.get("status")
+
+    if status == "suspended":
+      succeeded = subscriber_api.suspend(username)
+    elif status == "active":
+      succeeded = subscriber_api.restore(username)
+    else:
+      logging.error("Got invalid status '%s' for %s." % (status, username))
+      # Don't change the status, because retrying won't help.
+      return
+
+    if not succeeded:
+      # Make the queue try again later.
+      self.response.set_status(500)
+
+
+""" Does one batch of the monthly signin rollover. """
+class ResetSigninsTask(QueueHandlerBase):
+  """ Parameters:
+  month: The name of the month we are doing.
+  shard: Which shard of members the batch is in.
+  cursor: Where the batch starts. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    month = self.request.get("month")
+    shard = int(self.request.get("shard"))
+    cursor = self.request.get("cursor", None)
+
+    signin_reset.process_batch(month, shard, cursor)
+
+
+""" Restores everyone who ran out of visits last month, once the rollover is
+done. Each restore gets its own StatusChangeTask, so that the ones that fail get
+retried on their own. """
+class RestoreMembersTask(QueueHandlerBase):
+  """ Parameters:
+  username: The username of a member to restore. Can be specified multiple
+  times. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    usernames = self.request.get_all("username")
+    logging.info("Restoring %d member(s)." % (len(usernames)))
+
+    restores = [taskqueue.Task(url="/tasks/status_change",
+                               params={"username": username,
+                                       "status": "active"}) \
+                for username in usernames]
+    # We can add at most 100 tasks at once. If this fails partway through and
+    # gets retried, restoring someone twice doesn't hurt.
+    queue = taskqueue.Queue("status-notifications")
+    for i in range(0, len(restores), 100):
+      queue.add(restores[i:i + 100])
+
+
+""" Does the things that have to happen once after every deploy. The first
+instance of each new version starts this when it warms up. """
+class AfterDeployTask(QueueHandlerBase):
+  """ Parameters:
+  version: The version that was deployed, in a form that can go in a task name.
+  """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    # Members from before we had sort keys don't show up on the lists that are
+    # sorted by them, so start fixing them first. The name keeps us from doing
+    # it twice if this gets retried.
+    try:
+      version = self.request.get("version")
+      taskqueue.add(url="/tasks/backfill_sort_keys",
+                    name="backfill-sort-keys-%s" % (version))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.info("Sort key backfill was already started.")
+
+    # Members from before we had occupancy counters aren't counted anywhere
+    # until this runs, so plan limits wouldn't be enforced until the next
+    # nightly reconciliation.
+    Membership.reconcile_occupancy()
+
+
+""" Fixes the sort keys of every member, one batch at a time. The occupancy
+reconciliation cron job starts this when it finds any that are out of date. """
+class BackfillSortKeysTask(QueueHandlerBase):
+  # How many members to do in each task.
+  _BATCH_SIZE = 200
+
+  """ Parameters:
+  cursor: Where this batch starts. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    query = Membership.all()
+    cursor = self.request.get("cursor", None)
+    if cursor:
+      query.with_cursor(start_cursor=cursor)
+    members = query.fetch(self._BATCH_SIZE)
+
+    fixed = 0
+    for member in members:
+      # Only members whose copy here is stale can need fixing, and those get
+      # read again before they are written.
+      if (member.update_sort_keys() and \
+          Membership.fix_sort_keys(member.key())):
+        fixed += 1
+    logging.info("Fixed sort keys for %d member(s)." % (fixed))
+
+    if len(members) == self._BATCH_SIZE:
+      taskqueue.add(url="/tasks/backfill_sort_keys",
+                    params={"cursor": query.cursor()})
+
+
+""" Gives someone their PinPayments credit for a gift code. """
+class CreditGiftCodeTask(QueueHandlerBase):
+  """ Parameters:
+  used_code: The key of the UsedCode record of the redemption. """
+  @QueueHandlerBase.taskqueue_only
+  def post(self):
+    if not gift_codes.apply_credit(self.request.get("used_code")):
+      # The queue will try again later.
+      self.response.set_status(500)
+
+
 app = BaseApp([
     ("/tasks/create_user", CreateUserTask),
     ("/tasks/clean_row", CleanupTask),
     ("/tasks/areyoustillthere_mail", AreYouStillThereMail),
+    ("/tasks/update_subscribers", UpdateSubscribersTask),
+    ("/tasks/status_change", StatusChangeTask),
+    ("/tasks/reset_signins", ResetSigninsTask),
+    ("/tasks/restore_members", RestoreMembersTask),
+    ("/tasks/credit_gift_code", CreditGiftCodeTask),
+    ("/tasks/backfill_sort_keys", BackfillSortKeysTask),
+    ("/tasks/after_deploy", AfterDeployTask),
     ], debug=True)
@@ -0,0 +1,199 @@
+""" A fake PinPayments server that runs locally, for tests and benchmarks. It
+serves subscriber details and the subscriber list out of memory, lets you create
+subscribers and give them credit, and it can be told to fail or slow down
+requests. Run it directly to serve a lot of made-up subscribers:
+
+  python tests/fake_pinpayments.py 5000
+"""
+
+
+import BaseHTTPServer
+import re
+import SocketServer
+import sys
+import threading
+import time
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+
+""" Converts a dictionary into PinPayments-style XML.
+tag: The tag of the element.
+value: A dictionary of child elements, a string, or None.
+Returns: The XML. """
+def to_xml(tag, value):
+  if value == None:
+    return "<%s nil=\"true\"></%s>" % (tag, tag)
+  if isinstance(value, dict):
+    children = [to_xml(child, value[child]) for child in sorted(value.keys())]
+    return "<%s>%s</%s>" % (tag, "".join(children), tag)
+  return "<%s>%s</%s>" % (tag, escape(unicode(value).encode("utf-8")), tag)
+
+
+""" A threaded HTTP server, so that concurrent requests really are handled
+concurrently. """
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+""" Handles requests to the fake server. """
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # The paths that we know about.
+  _PATH_RE = re.compile(r"^/api/v4/[^/]+/subscribers(?:/(\d+))?\.xml$")
+  _CREDITS_RE = re.compile(r"^/api/v4/[^/]+/subscribers/(\d+)/credits\.xml$")
+
+  def do_GET(self):
+    if not self.__start_request():
+      return
+    fake = self.server.fake
+
+    match = self._PATH_RE.match(self.path)
+    if not match:
+      self.__respond(404)
+      return
+
+    if match.group(1) == None:
+      # Stream out the whole list, like the real thing.
+      self.send_response(200)
+      self.send_header("Content-Type", "application/xml")
+      self.end_headers()
+      self.wfile.write("<subscribers type=\"array\">")
+      for subscriber_id in sorted(fake.subscribers.keys()):
+        self.wfile.write(to_xml("subscriber", fake.subscribers[subscriber_id]))
+      self.wfile.write("</subscribers>")
+      return
+
+    subscriber = fake.subscribers.get(int(match.group(1)))
+    if subscriber == None:
+      self.__respond(404)
+      return
+    self.__respond(200, to_xml("subscriber", subscriber))
+
+  def do_POST(self):
+    if not self.__start_request():
+      return
+    fake = self.server.fake
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    data = ElementTree.fromstring(body)
+
+    if self._PATH_RE.match(self.path):
+      # Create a subscriber.
+      subscriber_id = int(data.findtext("customer-id"))
+      with fake.lock:
+        if subscriber_id in fake.subscribers:
+          self.__respond(403)
+          return
+        fake.add_subscriber(subscriber_id, email=data.findtext("email"),
+                            active="false")
+      self.__respond(201, to_xml("subscriber",
+                                 fake.subscribers[subscriber_id]))
+      return
+
+    match = self._CREDITS_RE.match(self.path)
+    if not match:
+      self.__respond(404)
+      return
+    with fake.lock:
+      subscriber = fake.subscribers.get(int(match.group(1)))
+      if subscriber == None:
+        self.__respond(404)
+        return
+      credit = float(subscriber["store-credit"])
+      credit += float(data.findtext("amount"))
+      subscriber["store-credit"] = str(credit)
+    self.__respond(201)
+
+  """ Does the things that every request needs to do first.
+  Returns: False if we already answered the request. """
+  def __start_request(self):
+    fake = self.server.fake
+    fake.requests.append(self.path)
+    if fake.delay:
+      time.sleep(fake.delay)
+
+    if not self.headers.get("Authorization"):
+      self.__respond(401)
+      return False
+    with fake.lock:
+      if fake.failures:
+        fake.failures -= 1
+        self.__respond(503)
+        return False
+    return True
+
+  """ Sends a complete response.
+  status: The status code.
+  body: The body of the response. """
+  def __respond(self, status, body=""):
+    self.send_response(status)
+    self.send_header("Content-Type", "application/xml")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    # Keep test output clean.
+    pass
+
+
+""" The fake server itself. """
+class FakePinPayments(object):
+  """ port: The port to listen on. By default, we pick a free one. """
+  def __init__(self, port=0):
+    # Maps subscriber IDs to dictionaries of subscriber data.
+    self.subscribers = {}
+    # How many of the next requests should fail with a 503.
+    self.failures = 0
+    # How long to wait before answering each request, in seconds.
+    self.delay = 0
+    # The paths of all the requests that we got.
+    self.requests = []
+    self.lock = threading.Lock()
+
+    self.__server = _Server(("localhost", port), _Handler)
+    self.__server.fake = self
+    self.__thread = None
+
+    # This is what to pass as the base_url for spreedly.Spreedly.
+    self.base_url = "http://localhost:%d/api/v4/%%(site)s/" % \
+        (self.__server.server_address[1])
+
+  """ Adds a subscriber.
+  subscriber_id: The ID of the subscriber.
+  fields: Any fields to set in the subscriber data. """
+  def add_subscriber(self, subscriber_id, **fields):
+    subscriber = {"customer-id": str(subscriber_id), "active": "true",
+                  "feature-level": "full", "store-credit": "0.0",
+                  "token": "token%d" % (subscriber_id)}
+    subscriber.update(fields)
+    self.subscribers[subscriber_id] = subscriber
+
+  """ Starts serving requests in the background. """
+  def start(self):
+    self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                     kwargs={"poll_interval": 0.05})
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  """ Stops serving requests. """
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
+    self.__thread.join()
+
+
+if __name__ == "__main__":
+  subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  port = int(sys.argv[2]) if len(sys.argv) > 2 else 8089
+
+  fake = FakePinPayments(port=port)
+  for subscriber_id in range(1, subscribers + 1):
+    fake.add_subscriber(subscriber_id)
+  fake.start()
+
+  print "Serving %d subscribers at %s" % (subscribers, fake.base_url)
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    fake.stop()
@@ -26,6 +26,7 @@ class BaseTest(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
     self.testbed.init_user_stub()
 
     # Make some testing plans.
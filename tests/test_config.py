@@ -0,0 +1,42 @@
+""" Tests for config.py. """
+
+
+# We need our external modules.
+import appengine_config
+
+import unittest
+
+from config import Config
+
+
+""" Tests that the Config singleton behaves itself. """
+class ConfigTest(unittest.TestCase):
+  def tearDown(self):
+    Config.reset()
+
+  """ Tests that we always get the same instance back. """
+  def test_singleton(self):
+    self.assertIs(Config(), Config())
+
+    # Resetting it should give us a new one.
+    old_conf = Config()
+    Config.reset()
+    self.assertIsNot(old_conf, Config())
+
+  """ Tests that we can't modify the configuration. """
+  def test_immutable(self):
+    conf = Config()
+
+    with self.assertRaises(AttributeError):
+      conf.LITE_VISITS = 100
+    with self.assertRaises(AttributeError):
+      del conf.LITE_VISITS
+    self.assertEqual(5, conf.LITE_VISITS)
+
+  """ Tests that the environment flags are still set correctly. """
+  def test_environment_flags(self):
+    conf = Config()
+
+    self.assertTrue(conf.is_testing)
+    self.assertFalse(conf.is_dev)
+    self.assertFalse(conf.is_prod)
@@ -3,16 +3,25 @@
 # We need our external modules.
 import appengine_config
 
+import datetime
+import json
+import os
 import unittest
 
 import webtest
 
+from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 from config import Config
 from membership import Membership
-from plans import Plan
+from plans import Plan, PlanOccupancyShard
+from tests.fake_pinpayments import FakePinPayments
 import cron
+import signin_reset
+import spreedly
+import subscriber_api
+import tasks
 
 
 """ Tests for the signin reset cron job. """
@@ -20,30 +29,92 @@ class ResetSigninHandlerTest(unittest.TestCase):
   def setUp(self):
     # Set up testing application.
     self.test_app = webtest.TestApp(cron.app)
+    self.tasks_app = webtest.TestApp(tasks.app)
 
     # Set up datastore for testing.
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    # It needs queue.yaml to know about our queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
 
     # Add a user to the datastore.
     self.user = Membership(first_name="Testy", last_name="Testerson",
                            email="ttesterson@gmail.com")
     self.user.put()
 
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Runs the rollover tasks until there aren't any left.
+  Returns: How many batches were run. """
+  def _run_batches(self):
+    batches = 0
+    while True:
+      tasks = self.taskqueue_stub.get_filtered_tasks(url="/tasks/reset_signins")
+      if not tasks:
+        return batches
+      self.taskqueue_stub.FlushQueue("default")
+
+      for task in tasks:
+        response = self.tasks_app.post("/tasks/reset_signins", task.payload)
+        self.assertEqual(200, response.status_int)
+        batches += 1
+
   """ Tests that the cron job restores users properly. """
   def test_user_restore(self):
     self.user.signins = Config().LITE_VISITS + 2
     self.user.status = "no_visits"
+    self.user.username = "testy.testerson"
     self.user.put()
 
     response = self.test_app.get("/cron/reset_signins")
     self.assertEqual(200, response.status_int)
+    self._run_batches()
 
     user = Membership.get_by_email("ttesterson@gmail.com")
     self.assertEqual(0, user.signins)
     self.assertEqual("active", user.status)
 
+    # The restore should have been queued once we were done.
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/restore_members", queue_names=["status-notifications"])
+    self.assertEqual(1, len(tasks))
+    self.assertEqual("username=testy.testerson", tasks[0].payload)
+
+    # That should queue a status change, which gets retried on its own.
+    response = self.tasks_app.post("/tasks/restore_members", tasks[0].payload)
+    self.assertEqual(200, response.status_int)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/status_change", queue_names=["status-notifications"])
+    self.assertEqual(1, len(tasks))
+    self.assertIn("username=testy.testerson", tasks[0].payload)
+    self.assertIn("status=active", tasks[0].payload)
+
+  """ Tests that members without usernames still get restored, but that we
+  don't try to tell the other apps about them. """
+  def test_restore_without_username(self):
+    self.user.signins = Config().LITE_VISITS + 2
+    self.user.status = "no_visits"
+    self.user.put()
+
+    response = self.test_app.get("/cron/reset_signins")
+    self.assertEqual(200, response.status_int)
+    self._run_batches()
+
+    user = Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual("active", user.status)
+
+    run = signin_reset.SigninResetRun.get_by_key_name(
+        signin_reset.month_name())
+    self.assertEqual([], run.restores)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/restore_members", queue_names=["status-notifications"])
+    self.assertEqual(0, len(tasks))
+
   """ Tests that unused signins rollover properly. """
   def test_rollover(self):
     self.user.signins = Config().LITE_VISITS - 2
@@ -52,6 +123,7 @@ class ResetSigninHandlerTest(unittest.TestCase):
 
     response = self.test_app.get("/cron/reset_signins")
     self.assertEqual(200, response.status_int)
+    self._run_batches()
 
     user = Membership.get_by_email("ttesterson@gmail.com")
     self.assertEqual(-2, user.signins)
@@ -63,3 +135,381 @@ class ResetSigninHandlerTest(unittest.TestCase):
     user.plan = "test_lite"
     remaining = Plan.signins_remaining(user)
     self.assertEqual(Config().LITE_VISITS + 2, remaining)
+
+  """ Tests that it does everyone when there are several batches. """
+  def test_batches(self):
+    for i in range(0, signin_reset.BATCH_SIZE * 2 + 1):
+      user = Membership(first_name="Testy%d" % (i), last_name="Testerson",
+                        email="ttesterson%d@gmail.com" % (i),
+                        signins=Config().LITE_VISITS, status="active")
+      user.put()
+
+    response = self.test_app.get("/cron/reset_signins")
+    self.assertEqual(200, response.status_int)
+    # One for the empty first shard, and three for the second one.
+    self.assertEqual(4, self._run_batches())
+
+    for user in Membership.all():
+      self.assertEqual(0, user.signins)
+
+    run = signin_reset.SigninResetRun.get_by_key_name(
+        signin_reset.month_name())
+    self.assertNotEqual(None, run.finished)
+    self.assertEqual(signin_reset.BATCH_SIZE * 2 + 1, run.members)
+
+  """ Tests that running it again in the same month doesn't do anything. """
+  def test_rerun(self):
+    self.user.signins = Config().LITE_VISITS - 2
+    self.user.put()
+
+    response = self.test_app.get("/cron/reset_signins")
+    self.assertEqual(200, response.status_int)
+    self._run_batches()
+
+    response = self.test_app.get("/cron/reset_signins")
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(0, self._run_batches())
+
+    user = Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual(-2, user.signins)
+
+  """ Tests that a retried batch doesn't roll anyone over twice. """
+  def test_retried_batch(self):
+    self.user.signins = Config().LITE_VISITS - 2
+    self.user.put()
+
+    response = self.test_app.get("/cron/reset_signins")
+    self.assertEqual(200, response.status_int)
+    task = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/reset_signins")[0]
+
+    for i in range(0, 2):
+      response = self.tasks_app.post("/tasks/reset_signins", task.payload)
+      self.assertEqual(200, response.status_int)
+
+    user = Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual(-2, user.signins)
+
+
+""" Tests for the plan occupancy reconciliation cron job. """
+class ReconcileOccupancyHandlerTest(unittest.TestCase):
+  def setUp(self):
+    # Set up testing application.
+    self.test_app = webtest.TestApp(cron.app)
+
+    # Set up datastore for testing.
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    self.user = Membership(first_name="Testy", last_name="Testerson",
+                           email="ttesterson@gmail.com", plan="newfull",
+                           status="active")
+    self.user.put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that it fixes counters that have drifted. """
+  def test_reconcile(self):
+    db.run_in_transaction(PlanOccupancyShard.adjust, "newfull", 4)
+    db.run_in_transaction(PlanOccupancyShard.adjust, "lite", 3)
+
+    # Simulate a write that didn't go through put().
+    self.user.status = "no_visits"
+    db.put(self.user)
+
+    response = self.test_app.get("/cron/reconcile_occupancy")
+    self.assertEqual(200, response.status_int)
+
+    self.assertEqual(0, PlanOccupancyShard.get_count("newfull"))
+    self.assertEqual(0, PlanOccupancyShard.get_count("lite"))
+    user = Membership.get_by_id(self.user.key().id())
+    self.assertEqual(None, user.counted_plan)
+
+    # Now the counter should keep working normally.
+    user.status = "active"
+    user.put()
+    self.assertEqual(1, PlanOccupancyShard.get_count("newfull"))
+
+  """ Tests that fixing a member doesn't undo changes made after we read them.
+  """
+  def test_no_stale_writes(self):
+    # Simulate a write that didn't go through put().
+    self.user.status = "no_visits"
+    db.put(self.user)
+    stale = Membership.get_by_id(self.user.key().id())
+
+    # Someone signs in after the cron job read the member.
+    user = Membership.get_by_id(self.user.key().id())
+    user.signins = 3
+    db.put(user)
+
+    self.assertTrue(Membership.fix_counted_plan(stale.key()))
+    user = Membership.get_by_id(self.user.key().id())
+    self.assertEqual(3, user.signins)
+    self.assertEqual(None, user.counted_plan)
+    self.assertEqual(0, PlanOccupancyShard.get_count("newfull"))
+
+  """ Tests that stale sort keys get fixed by a separate task. """
+  def test_sort_keys(self):
+    # Simulate a member from before we had sort keys.
+    self.user.last_name_lower = None
+    db.put(self.user)
+
+    response = self.test_app.get("/cron/reconcile_occupancy")
+    self.assertEqual(200, response.status_int)
+    # The cron job itself shouldn't write it.
+    user = Membership.get_by_id(self.user.key().id())
+    self.assertEqual(None, user.last_name_lower)
+
+    queued = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/backfill_sort_keys")
+    self.assertEqual(1, len(queued))
+
+    task_app = webtest.TestApp(tasks.app)
+    response = task_app.post("/tasks/backfill_sort_keys")
+    self.assertEqual(200, response.status_int)
+    user = Membership.get_by_id(self.user.key().id())
+    self.assertEqual("testerson", user.last_name_lower)
+
+
+""" Tests for the PinPayments reconciliation cron job. """
+class ReconcileSubscribersHandlerTest(unittest.TestCase):
+  def setUp(self):
+    # Set up testing application.
+    self.test_app = webtest.TestApp(cron.app)
+
+    # Set up datastore for testing.
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_mail_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+
+    # This member is up to date.
+    self.current = Membership(first_name="Testy", last_name="Testerson",
+                              email="ttesterson@gmail.com", plan="newfull",
+                              status="active", domain_user=True)
+    self.current.put()
+    # This member stopped paying, but we missed the update.
+    self.lapsed = Membership(first_name="Lapsed", last_name="Member",
+                             email="lmember@gmail.com", plan="newfull",
+                             status="active", username="lapsed.member",
+                             domain_user=True)
+    self.lapsed.put()
+
+    self.fake = FakePinPayments()
+    self.fake.add_subscriber(self.current.key().id(),
+                             **{"feature-level": "newfull"})
+    self.fake.add_subscriber(self.lapsed.key().id(), active="false",
+                             **{"feature-level": "newfull",
+                                "ready-to-renew": "false"})
+    self.fake.add_subscriber(self.lapsed.key().id() + 1000)
+    self.fake.start()
+
+    # Point the shared client at the fake server.
+    self.old_api = subscriber_api._api.copy()
+    subscriber_api._api["client"] = spreedly.Spreedly("hackerdojotest",
+        base_url=self.fake.base_url, token="testapikey")
+    subscriber_api._api["token"] = "testapikey"
+
+    self.current.spreedly_token = \
+        self.fake.subscribers[self.current.key().id()]["token"]
+    self.current.put()
+
+  def tearDown(self):
+    subscriber_api._api.update(self.old_api)
+    self.fake.stop()
+    self.testbed.deactivate()
+
+  """ Tests that only the members that are wrong get fixed. """
+  def test_reconcile(self):
+    current_updated = self.current.updated
+
+    response = self.test_app.get("/cron/reconcile_subscribers")
+    self.assertEqual(200, response.status_int)
+
+    # We should have gotten the whole list once.
+    self.assertEqual(1, len(self.fake.requests))
+
+    current = Membership.get_by_id(self.current.key().id())
+    self.assertEqual("active", current.status)
+    self.assertEqual(current_updated, current.updated)
+
+    lapsed = Membership.get_by_id(self.lapsed.key().id())
+    self.assertEqual("suspended", lapsed.status)
+    self.assertEqual("token%d" % (lapsed.key().id()), lapsed.spreedly_token)
+
+    # We should have gotten a report about it.
+    messages = self.mail_stub.get_sent_messages()
+    self.assertEqual(1, len(messages))
+    body = messages[0].body.decode()
+    self.assertIn("Lapsed Member", body)
+    self.assertIn("status: active -> suspended", body)
+    self.assertIn(str(self.lapsed.key().id() + 1000), body)
+    self.assertNotIn("Testy Testerson", body)
+    self.assertIn("Queued status notifications for 1 member(s).", body)
+
+    # The other apps should get told about the suspension.
+    taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskqueue_stub.get_filtered_tasks(
+        url="/tasks/status_change", queue_names=["status-notifications"])
+    self.assertEqual(1, len(tasks))
+    self.assertIn("username=lapsed.member", tasks[0].payload)
+    self.assertIn("status=suspended", tasks[0].payload)
+
+  """ Tests that members who haven't changed don't get emailed about or have
+  domain accounts created for them again. """
+  def test_no_side_effects_for_unchanged(self):
+    # PayPal members keep their status while PinPayments says they're active.
+    paypal = Membership(first_name="Paypal", last_name="Member",
+                        email="pmember@gmail.com", plan="newfull",
+                        status="paypal")
+    paypal.put()
+    # This one is still waiting for their domain account.
+    waiting = Membership(first_name="Waiting", last_name="Member",
+                         email="wmember@gmail.com", plan="newfull",
+                         status="active", username="waiting.member",
+                         password="notasecret")
+    waiting.put()
+    for member in (paypal, waiting):
+      self.fake.add_subscriber(member.key().id(),
+                               **{"feature-level": "newfull"})
+      member.spreedly_token = self.fake.subscribers[member.key().id()]["token"]
+      member.put()
+
+    response = self.test_app.get("/cron/reconcile_subscribers")
+    self.assertEqual(200, response.status_int)
+
+    # The only email should be the report.
+    messages = self.mail_stub.get_sent_messages()
+    self.assertEqual(1, len(messages))
+    self.assertNotIn("PayPal", messages[0].subject)
+
+    taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskqueue_stub.get_filtered_tasks(url="/tasks/create_user")
+    self.assertEqual(0, len(tasks))
+
+
+""" Tests for the dev side of the data sync cron job. """
+class DataSyncHandlerTest(unittest.TestCase):
+  def setUp(self):
+    # Set up testing application.
+    self.test_app = webtest.TestApp(cron.app)
+
+    # Set up datastore for testing.
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+    # Pretend we're the dev app.
+    Config.is_dev = True
+
+    self.user = Membership(first_name="Testy", last_name="Testerson",
+                           email="ttesterson@gmail.com", status="active")
+    self.user.put()
+
+  def tearDown(self):
+    Config.is_dev = False
+    self.testbed.deactivate()
+
+  """ Tests that a batch replaces existing members and adds new ones. """
+  def test_upsert(self):
+    entries = [{"first_name": "Testy", "last_name": "Testerson",
+                "email": "ttesterson@gmail.com", "status": "suspended",
+                "created": "2014-03-01T12:30:00.123456"},
+               {"first_name": "Other", "last_name": "Person",
+                "email": "operson@gmail.com", "status": "active",
+                "created": "2014-03-02T08:00:00"}]
+    response = self.test_app.post("/cron/datasync",
+                                  json.dumps({"members": entries}))
+    self.assertEqual(200, response.status_int)
+
+    self.assertEqual(2, Membership.all().count())
+    user = Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual(self.user.key(), user.key())
+    self.assertEqual("suspended", user.status)
+    self.assertEqual(datetime.datetime(2014, 3, 1, 12, 30, 0, 123456),
+                     user.created)
+
+    other = Membership.get_by_email("operson@gmail.com")
+    self.assertEqual("Person", other.last_name)
+    self.assertEqual(datetime.datetime(2014, 3, 2, 8), other.created)
+
+
+""" Tests for the cron jobs that queue up emails. """
+class MailQueueingTest(unittest.TestCase):
+  def setUp(self):
+    # Set up testing application.
+    self.test_app = webtest.TestApp(cron.app)
+
+    # Set up datastore for testing.
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that the cleanup job only picks up old, unfinished signups, and
+  doesn't queue them twice. """
+  def test_cleanup(self):
+    old = datetime.datetime.now() - datetime.timedelta(days=3)
+    old_user = Membership(first_name="Testy", last_name="Testerson",
+                          email="ttesterson@gmail.com", created=old)
+    old_user.put()
+    Membership(first_name="New", last_name="Person",
+               email="nperson@gmail.com").put()
+    Membership(first_name="Active", last_name="Person",
+               email="aperson@gmail.com", status="active", created=old).put()
+
+    for i in range(0, 2):
+      response = self.test_app.get("/cron/cleanup")
+      self.assertEqual(200, response.status_int)
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(url="/tasks/clean_row")
+    self.assertEqual(1, len(tasks))
+    self.assertEqual("user=%d" % (old_user.key().id()), tasks[0].payload)
+
+  """ Tests that the "are you still there" job picks the right people, and
+  doesn't queue them twice. """
+  def test_are_you_still_there(self):
+    user = Membership(first_name="Testy", last_name="Testerson",
+                      email="ttesterson@gmail.com", status="suspended",
+                      spreedly_token="notatoken")
+    user.put()
+    Membership(first_name="No", last_name="Token",
+               email="ntoken@gmail.com", status="suspended").put()
+    Membership(first_name="Do", last_name="Not Disturb",
+               email="dnd@gmail.com", status="suspended",
+               spreedly_token="notatoken", extra_dnd=True).put()
+    Membership(first_name="Testy", last_name="Deleted",
+               email="deleted@gmail.com", status="suspended",
+               spreedly_token="notatoken").put()
+    # Older members don't have extra_dnd set at all.
+    legacy_user = Membership(first_name="Old", last_name="Member",
+                             email="omember@gmail.com", status="suspended",
+                             spreedly_token="notatoken", extra_dnd=None)
+    legacy_user.put()
+
+    for i in range(0, 2):
+      response = self.test_app.get("/cron/areyoustillthere")
+      self.assertEqual(200, response.status_int)
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/areyoustillthere_mail")
+    self.assertEqual(2, len(tasks))
+    payloads = set([task.payload for task in tasks])
+    self.assertEqual(set(["user=%d" % (user.key().id()),
+                          "user=%d" % (legacy_user.key().id())]), payloads)
@@ -0,0 +1,78 @@
+""" Tests for keymaster.py. """
+
+
+# We need our external modules.
+import appengine_config
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from keymaster import Keymaster, KeymasterError
+import keymaster
+
+
+""" Tests that secrets get cached and invalidated properly. """
+class KeymasterTest(unittest.TestCase):
+  def setUp(self):
+    # Set up datastore for testing.
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+    keymaster.clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that we can get a secret we stored. """
+  def test_get(self):
+    Keymaster.encrypt("test:key", "notasecret")
+    self.assertEqual("notasecret", keymaster.get("test:key"))
+
+    with self.assertRaises(KeymasterError):
+      keymaster.get("test:badkey")
+
+  """ Tests that a cached secret survives the datastore entity going away. """
+  def test_instance_cache(self):
+    Keymaster.encrypt("test:key", "notasecret")
+    keymaster.get("test:key")
+
+    # Remove it from both the datastore and memcache.
+    Keymaster.get_by_key_name("test:key").delete()
+    memcache.flush_all()
+
+    self.assertEqual("notasecret", keymaster.get("test:key"))
+
+  """ Tests that memcache is used when the instance cache is cold. """
+  def test_memcache(self):
+    Keymaster.encrypt("test:key", "notasecret")
+    keymaster.get("test:key")
+
+    Keymaster.get_by_key_name("test:key").delete()
+    keymaster.clear_cache()
+
+    self.assertEqual("notasecret", keymaster.get("test:key"))
+
+  """ Tests that changing a secret invalidates the cached version. """
+  def test_invalidation(self):
+    Keymaster.encrypt("test:key", "notasecret")
+    self.assertEqual("notasecret", keymaster.get("test:key"))
+
+    Keymaster.encrypt("test:key", "newsecret")
+    self.assertEqual("newsecret", keymaster.get("test:key"))
+
+  """ Tests that changing a secret on one instance invalidates the version that
+  other instances have cached. """
+  def test_other_instance(self):
+    Keymaster.encrypt("test:key", "notasecret")
+    self.assertEqual("notasecret", keymaster.get("test:key"))
+    # Pretend that this is another instance, which still has the old secret.
+    other_cache = keymaster._secret_cache.copy()
+
+    Keymaster.encrypt("test:key", "newsecret")
+    keymaster._secret_cache.update(other_cache)
+
+    self.assertEqual("newsecret", keymaster.get("test:key"))
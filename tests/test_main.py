@@ -4,8 +4,10 @@
 # We need our external modules.
 import appengine_config
 
+import datetime
 import hashlib
 import json
+import os
 import re
 import unittest
 import urllib
@@ -18,9 +20,10 @@ from google.appengine.ext import testbed
 
 from config import Config
 from keymaster import Keymaster
-from membership import Membership
+from membership import Membership, UsernameReservation
 from plans import Plan
 from project_handler import ProjectHandler
+import gift_codes
 import main
 
 
@@ -35,7 +38,9 @@ class BaseTest(unittest.TestCase):
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
-    self.testbed.init_taskqueue_stub()
+    # It needs queue.yaml to know about our queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
     self.testbed.init_user_stub()
 
   def tearDown(self):
@@ -330,6 +335,52 @@ class AccountHandlerTest(AccountHandlerBase):
     # We shouldn't have a domain account yet.
     self.assertFalse(user.domain_user)
 
+  """ Tests that it won't give us a username that someone else has. """
+  def test_taken_username(self):
+    # Someone else with a domain account has it.
+    ProjectHandler.add_username("testy.testerson")
+
+    query = urllib.urlencode(self._TEST_PARAMS)
+    response = self.test_app.post("/account/" + self.user_hash, query,
+                                  expect_errors=True)
+    self.assertEqual(422, response.status_int)
+    self.assertIn("already taken", response.body)
+
+    user = Membership.get_by_hash(self.user_hash)
+    self.assertEqual(None, user.username)
+
+  """ Tests that a reserved username can only be taken once the reservation
+  runs out. """
+  def test_reserved_username(self):
+    other_user = Membership(first_name="Other", last_name="Person",
+                            email="operson@gmail.com")
+    other_user.put()
+    UsernameReservation.claim("testy.testerson", other_user)
+    other_user.username = "testy.testerson"
+    other_user.put()
+
+    query = urllib.urlencode(self._TEST_PARAMS)
+    response = self.test_app.post("/account/" + self.user_hash, query,
+                                  expect_errors=True)
+    self.assertEqual(422, response.status_int)
+    self.assertIn("already taken", response.body)
+
+    # The other person never finished signing up.
+    reservation = UsernameReservation.get_by_key_name("testy.testerson")
+    reservation.expires = datetime.datetime.now() - datetime.timedelta(hours=1)
+    reservation.put()
+
+    response = self.test_app.post("/account/" + self.user_hash, query)
+    self.assertEqual(302, response.status_int)
+
+    user = Membership.get_by_hash(self.user_hash)
+    self.assertEqual("testy.testerson", user.username)
+    other_user = Membership.get_by_id(other_user.key().id())
+    self.assertEqual(None, other_user.username)
+
+    reservation = UsernameReservation.get_by_key_name("testy.testerson")
+    self.assertEqual(user.key().id(), reservation.member_id)
+
   """ Tests that it fails if the required fields are invalid. """
   def test_requirements(self):
     # Giving it passwords that don't match should be a problem.
@@ -412,6 +463,8 @@ class GiftCodeTest(AccountHandlerBase):
     # Create the a keymaster key for a valid code.
     self.code = "eulalie"
     Keymaster.encrypt("code:hash", self.code)
+    # Hand out some codes.
+    gift_codes.generate(1670, 1680)
 
   """ Tests that if we give it a correct code, it gives us a discount, and that
   if we give it twice, it doesn't. """
@@ -440,6 +493,15 @@ class GiftCodeTest(AccountHandlerBase):
       self.assertEqual(gift_code, code.code)
       self.assertEqual("ttesterson@gmail.com", code.email)
       self.assertEqual("OK", code.extra)
+      # Their credit should be waiting to be applied.
+      self.assertEqual(user.key().id(), code.member_id)
+      self.assertTrue(code.credit_pending)
+
+      taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+      tasks = taskqueue_stub.get_filtered_tasks(url="/tasks/credit_gift_code",
+                                                queue_names=["gift-codes"])
+      self.assertEqual(1, len(tasks))
+      self.assertIn(urllib.quote(str(code.key())), tasks[0].payload)
 
     user = Membership.get_by_hash(self.user_hash)
     user.username = None
@@ -495,6 +557,80 @@ class GiftCodeTest(AccountHandlerBase):
     self.assertEqual(422, response.status_int)
     self.assertIn("code was invalid", response.body)
 
+  """ Tests that a code from a card that was printed before we had GiftCodes
+  still works, and can only be used once. """
+  def test_legacy_code(self):
+    code = gift_codes.code_for_serial(1680, self.code)
+
+    user = Membership.get_by_hash(self.user_hash)
+    user.referrer = code
+    user.put()
+
+    response = self.test_app.post("/account/" + self.user_hash,
+                                  self._TEST_PARAMS)
+    self.assertEqual(302, response.status_int)
+
+    gift_code = gift_codes.GiftCode.get_by_key_name(code)
+    self.assertEqual(1680, gift_code.serial)
+    self.assertEqual("ttesterson@gmail.com", gift_code.email)
+    self.assertTrue(gift_code.redeemed)
+
+    self.assertRaises(gift_codes.UsedCodeError, gift_codes.redeem, code,
+                      "ttesterson@gmail.com")
+
+  """ Tests that an old code that was used before we had GiftCodes can't be
+  used again. """
+  def test_legacy_used_code(self):
+    code = gift_codes.code_for_serial(1690, self.code)
+    main.UsedCode(code=code, email="ttesterson@gmail.com", extra="OK").put()
+
+    self.assertRaises(gift_codes.UsedCodeError, gift_codes.redeem, code,
+                      "ttesterson@gmail.com")
+    # It shouldn't have made a bogus GiftCode either.
+    self.assertRaises(gift_codes.InvalidCodeError, gift_codes.redeem,
+                      code[:-1] + str((int(code[-1]) + 1) % 10),
+                      "ttesterson@gmail.com")
+    self.assertEqual(11, gift_codes.GiftCode.all().count())
+
+  """ Tests that generating codes doesn't touch ones that already exist, and
+  that it remembers codes that were used before we had GiftCodes. """
+  def test_generate(self):
+    used = gift_codes.code_for_serial(1685, self.code)
+    main.UsedCode(code=used, email="ttesterson@gmail.com", extra="OK").put()
+    gift_codes.redeem(gift_codes.code_for_serial(1675, self.code),
+                      "ttesterson@gmail.com")
+
+    self.assertEqual(10, gift_codes.generate(1675, 1690))
+    self.assertEqual(0, gift_codes.generate(1670, 1690))
+    self.assertEqual(20, gift_codes.GiftCode.all().count())
+
+    # Both used codes should still be used.
+    for serial in (1675, 1685):
+      code = gift_codes.code_for_serial(serial, self.code)
+      self.assertRaises(gift_codes.UsedCodeError, gift_codes.redeem, code,
+                        "ttesterson@gmail.com")
+
+  """ Tests that admins can export the codes. """
+  def test_export(self):
+    self.testbed.setup_env(user_email="ttesterson@gmail.com", user_is_admin="1",
+                           overwrite=True)
+    code = gift_codes.code_for_serial(1670, self.code)
+    gift_codes.redeem(code, "ttesterson@gmail.com")
+
+    response = self.test_app.get("/giftcodes")
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("text/csv", response.content_type)
+
+    rows = response.body.strip().split("\r\n")
+    self.assertEqual(11, len(rows))
+    self.assertEqual("serial,code,redeemed,email", rows[0])
+    serial, pretty, redeemed, email = rows[1].split(",")
+    self.assertEqual("1670", serial)
+    self.assertEqual(code, pretty.replace(" ", ""))
+    self.assertTrue(redeemed)
+    self.assertEqual("ttesterson@gmail.com", email)
+    self.assertEqual("", rows[2].split(",")[3])
+
 
 """ Base class for testing plan selection handlers. """
 class PlanSelectionTestBase(BaseTest):
@@ -696,3 +832,104 @@ class MemberListHandlerTest(BaseTest):
 
     self.assertNotEqual(response["nextPage"], new_response["nextPage"])
     self.assertNotEqual(response["html"], new_response["html"])
+
+  """ Tests that we can jump straight to a page by number. """
+  def test_page_numbers(self):
+    query_str = urllib.urlencode({"page": "start"})
+    first_page = json.loads(self.test_app.get("/memberlist?" + query_str).body)
+    query_str = urllib.urlencode({"page": first_page["nextPage"]})
+    second_page = json.loads(self.test_app.get("/memberlist?" + query_str).body)
+
+    # Jumping straight to the second page should give us the same thing.
+    query_str = urllib.urlencode({"page_number": 2})
+    response = self.test_app.get("/memberlist?" + query_str)
+    self.assertEqual(200, response.status_int)
+    response = json.loads(response.body)
+    self.assertEqual(2, response["page"])
+    self.assertEqual(second_page["html"], response["html"])
+
+    # And so should going back to the first page.
+    query_str = urllib.urlencode({"page_number": 1})
+    response = json.loads(self.test_app.get("/memberlist?" + query_str).body)
+    self.assertEqual(first_page["html"], response["html"])
+
+    # Pages that don't exist shouldn't work.
+    query_str = urllib.urlencode({"page_number": 3})
+    response = self.test_app.get("/memberlist?" + query_str,
+                                 expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
+  """ Tests that the page count gets updated when someone's status changes. """
+  def test_count_invalidation(self):
+    response = self.test_app.get("/memberlist/total_pages")
+    self.assertEqual(2, int(response.body))
+
+    user = Membership.create_user("ttesterson50@gmail.com", "notasecret",
+                                  first_name="Testy50",
+                                  last_name="Testerson", status="active")
+
+    response = self.test_app.get("/memberlist/total_pages")
+    self.assertEqual(3, int(response.body))
+
+    user = Membership.get_by_email("ttesterson50@gmail.com")
+    user.status = "suspended"
+    user.put()
+
+    response = self.test_app.get("/memberlist/total_pages")
+    self.assertEqual(2, int(response.body))
+
+  """ Tests that the user list is sorted without caring about case. """
+  def test_user_list_sorting(self):
+    Membership.create_user("aardvark@gmail.com", "notasecret",
+                           first_name="Testy", last_name="aardvark")
+    Membership.create_user("abbott@gmail.com", "notasecret",
+                           first_name="Testy", last_name="Abbott")
+
+    query_str = urllib.urlencode({"page_number": 1})
+    response = self.test_app.get("/userlist?" + query_str)
+    self.assertEqual(200, response.status_int)
+    html = json.loads(response.body)["html"]
+
+    self.assertLess(html.index("aardvark"), html.index("Abbott"))
+    self.assertLess(html.index("Abbott"), html.index("Testerson"))
+
+
+  """ Tests that the suspended list summary only counts the members that it
+  shows. """
+  def test_suspended_summary(self):
+    for i, (token, last_name, reason) in enumerate([
+        ("token", "Testerson", "Moving away."),
+        ("token", "Testerson", None),
+        ("token", "Deleted", "Moving away."),
+        (None, "Testerson", "Moving away.")]):
+      Membership.create_user("suspended%d@gmail.com" % (i), "notasecret",
+                             first_name="Suspended%d" % (i),
+                             last_name=last_name, status="suspended",
+                             spreedly_token=token, unsubscribe_reason=reason)
+
+    response = self.test_app.get("/suspended")
+    self.assertEqual(200, response.status_int)
+    self.assertIn("Total Suspended: 2", response.body)
+    self.assertIn("With Reasons: 1", response.body)
+
+
+""" Tests that UpdateHandler works. """
+class UpdateHandlerTest(BaseTest):
+  """ Tests that it splits the subscribers up into tasks. """
+  def test_chunking(self):
+    ids = [str(i) for i in range(1, 26)]
+    response = self.test_app.post("/update",
+                                  {"subscriber_ids": ",".join(ids + ["bad"])})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("ok", response.body)
+
+    taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskqueue_stub.get_filtered_tasks(
+        url="/tasks/update_subscribers", queue_names=["subscriber-updates"])
+    self.assertEqual(3, len(tasks))
+
+    queued_ids = []
+    for task in tasks:
+      params = urllib.unquote(task.payload.split("=")[1])
+      queued_ids.extend(params.split(","))
+    self.assertEqual(sorted(ids), sorted(queued_ids))
@@ -23,6 +23,9 @@ class BaseTest(unittest.TestCase):
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
 
+    # Don't use revocations from other tests.
+    membership.TokenGeneration._local_cache.clear()
+
   def tearDown(self):
     self.testbed.deactivate()
 
@@ -64,6 +67,50 @@ class UserTokenTest(BaseTest):
     self.assertEqual(token.key, new_token.key)
     self.assertEqual(token.token, new_token.token)
 
+  """ Tests that signed tokens can be checked without saving them. """
+  def test_signed_token(self):
+    token = membership.UserToken.create_signed(1337, "auth")
+    self.assertTrue(membership.UserToken.is_signed(token.token))
+
+    new_token = membership.UserToken.verify_signed(1337, "auth", token.token)
+    self.assertEqual(token.token, new_token.token)
+    self.assertEqual(token.timestamp, new_token.timestamp)
+
+    # It shouldn't work for anyone else, or for anything else.
+    self.assertEqual(None,
+        membership.UserToken.verify_signed(1338, "auth", token.token))
+    self.assertEqual(None,
+        membership.UserToken.verify_signed(1337, "signup", token.token))
+
+    # Messing with it should break the signature.
+    prefix, payload, signature = token.token.split(".")
+    last = "B" if payload[-1] == "A" else "A"
+    forged = "%s.%s.%s" % (prefix, payload[:-1] + last, signature)
+    self.assertEqual(None,
+        membership.UserToken.verify_signed(1337, "auth", forged))
+
+  """ Tests that signed tokens expire. """
+  def test_signed_token_expiry(self):
+    token = membership.UserToken.create_signed(1337, "auth", expires=-1)
+    self.assertEqual(None,
+        membership.UserToken.verify_signed(1337, "auth", token.token))
+
+  """ Tests that we can revoke signed tokens. """
+  def test_signed_token_revocation(self):
+    token = membership.UserToken.create_signed(1337, "auth")
+    membership.TokenGeneration.revoke(1337)
+
+    self.assertEqual(None,
+        membership.UserToken.verify_signed(1337, "auth", token.token))
+    # We can still choose not to check.
+    self.assertNotEqual(None, membership.UserToken.verify_signed(1337, "auth",
+        token.token, check_revoked=False))
+
+    # New tokens should work.
+    token = membership.UserToken.create_signed(1337, "auth")
+    self.assertNotEqual(None,
+        membership.UserToken.verify_signed(1337, "auth", token.token))
+
 """ Tests that the Membership class works. """
 class MembershipTest(BaseTest):
   def setUp(self):
@@ -94,6 +141,18 @@ class MembershipTest(BaseTest):
     self.assertEqual(None, user)
     self.assertEqual(None, timestamp)
 
+  """ Tests that put() keeps the sort keys up to date. """
+  def test_sort_keys(self):
+    self.assertEqual("testerson", self.user.last_name_lower)
+
+    self.user.last_name = "McTesterson"
+    self.user.put()
+    user = membership.Membership.get_by_id(self.user_id)
+    self.assertEqual("mctesterson", user.last_name_lower)
+
+    # If nothing changed, it shouldn't say it did.
+    self.assertFalse(user.update_sort_keys())
+
   """ Tests that the password verification works correctly. """
   def test_password_auth(self):
     # Give the user a password.
@@ -113,3 +172,77 @@ class MembershipTest(BaseTest):
     # Try with the wrong email altogether.
     with self.assertRaises(auth.InvalidAuthIdError):
       membership.Membership.get_by_auth_password("bademail", password)
+
+  """ Tests that we can find users by their unique properties. """
+  def test_lookups(self):
+    self.user.hash = "notahash"
+    self.user.username = "testy.testerson"
+    self.user.put()
+
+    user = membership.Membership.get_by_email("testy.testerson@gmail.com")
+    self.assertEqual(self.user_id, user.key().id())
+    user = membership.Membership.get_by_email("Testy.Testerson@gmail.com ")
+    self.assertEqual(self.user_id, user.key().id())
+    user = membership.Membership.get_by_hash("notahash")
+    self.assertEqual(self.user_id, user.key().id())
+    user = membership.Membership.get_by_username("testy.testerson")
+    self.assertEqual(self.user_id, user.key().id())
+    user = membership.Membership.get_by_email(
+        "testy.testerson@hackerdojo.com")
+    self.assertEqual(self.user_id, user.key().id())
+
+    # Changing the email should change the lookup.
+    self.user.email = "ttesterson@gmail.com"
+    self.user.put()
+
+    self.assertEqual(None,
+        membership.Membership.get_by_email("testy.testerson@gmail.com"))
+    user = membership.Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual(self.user_id, user.key().id())
+
+    # Deleting the user should remove them.
+    self.user.delete()
+    self.assertEqual(None,
+        membership.Membership.get_by_email("ttesterson@gmail.com"))
+    self.assertEqual(None, membership.Membership.get_by_hash("notahash"))
+
+  """ Tests that users without lookups can still be found. """
+  def test_missing_lookup(self):
+    membership.MemberLookup.get_by_key_name(
+        "email:testy.testerson@gmail.com").delete()
+
+    user = membership.Membership.get_by_email("testy.testerson@gmail.com")
+    self.assertEqual(self.user_id, user.key().id())
+    # It should have added the lookup.
+    self.assertNotEqual(None, membership.MemberLookup.get_by_key_name(
+        "email:testy.testerson@gmail.com"))
+
+  """ Tests that users without lookups can still be found in batches, and that
+  we get them back under the values that we asked for. """
+  def test_missing_lookup_multi(self):
+    self.user.email = "Testy.Testerson@gmail.com"
+    self.user.put()
+    membership.MemberLookup.get_by_key_name(
+        "email:testy.testerson@gmail.com").delete()
+
+    values = ["Testy.Testerson@gmail.com", "nobody@gmail.com"]
+    found = membership.Membership.get_by_unique_multi("email", values)
+    self.assertEqual(["Testy.Testerson@gmail.com"], found.keys())
+    self.assertEqual(self.user_id,
+                     found["Testy.Testerson@gmail.com"].key().id())
+    # It should have added the lookup.
+    self.assertNotEqual(None, membership.MemberLookup.get_by_key_name(
+        "email:testy.testerson@gmail.com"))
+
+  """ Tests that two users can't have the same unique properties. """
+  def test_duplicates(self):
+    user = membership.Membership(email="testy.testerson@gmail.com",
+                                 first_name="Testy", last_name="Testerson2")
+    with self.assertRaises(membership.DuplicateMemberError):
+      user.put()
+
+    # It should work once the old user is gone.
+    self.user.delete()
+    user.put()
+    found = membership.Membership.get_by_email("testy.testerson@gmail.com")
+    self.assertEqual(user.key().id(), found.key().id())
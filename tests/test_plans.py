@@ -4,11 +4,11 @@
 import datetime
 import unittest
 
-from google.appengine.ext import testbed
+from google.appengine.ext import db, testbed
 
 from config import Config
 from membership import Membership
-from plans import Plan
+from plans import Plan, PlanOccupancyShard
 
 
 """ Test case for the Plan class """
@@ -19,6 +19,7 @@ class PlanTests(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
 
     # Clear all the real plans.
     Plan.all_plans = []
@@ -127,9 +128,9 @@ class PlanTests(unittest.TestCase):
   """ Tests that it correctly fails to include members who have been suspended
   for too long when it checks if a plan is full. """
   def test_ignore_long_suspensions(self):
-    # Ensure that we have a known value for when we start ignoring plans.
-    conf = Config()
-    conf.PLAN_USER_IGNORE_THRESHOLD = 30
+    # The rest of this test assumes this value for when we start ignoring
+    # plans. (Config is immutable, so we can't just set it.)
+    self.assertEqual(30, Config().PLAN_USER_IGNORE_THRESHOLD)
 
     self.plan1.member_limit = 1
 
@@ -161,6 +162,67 @@ class PlanTests(unittest.TestCase):
     user.put(skip_time_update=True)
     self.assertFalse(self.plan1.is_full())
 
+  """ Tests that the occupancy counters follow members around. """
+  def test_occupancy_counter(self):
+    user = Membership(first_name="Testy", last_name="Testerson",
+                      email="ttesterson@gmail.com", plan="plan1",
+                      status="active")
+    user.put()
+    self.assertEqual(1, PlanOccupancyShard.get_count("plan1"))
+
+    # Moving to the legacy version of the plan shouldn't change anything.
+    user.plan = "plan4"
+    user.put()
+    self.assertEqual(1, PlanOccupancyShard.get_count("plan1"))
+
+    # Moving to a different plan should.
+    user.plan = "plan2"
+    user.put()
+    self.assertEqual(0, PlanOccupancyShard.get_count("plan1"))
+    self.assertEqual(1, PlanOccupancyShard.get_count("plan2"))
+
+    # Members who ran out of visits don't count.
+    user.status = "no_visits"
+    user.put()
+    self.assertEqual(0, PlanOccupancyShard.get_count("plan2"))
+
+    user.status = "active"
+    user.put()
+    self.assertEqual(1, PlanOccupancyShard.get_count("plan2"))
+
+    # Deleting them should remove them.
+    user.delete()
+    self.assertEqual(0, PlanOccupancyShard.get_count("plan2"))
+
+  """ Tests that fixing a counter doesn't get confused by changes that happen
+  while we're counting. """
+  def test_correct(self):
+    db.run_in_transaction(PlanOccupancyShard.adjust, "plan1", 5)
+
+    counts = []
+    """ Counts the members, while somebody joins the first time around. """
+    def count_members():
+      if not counts:
+        db.run_in_transaction(PlanOccupancyShard.adjust, "plan1", 1)
+        # Our count didn't see them yet.
+        counts.append(0)
+      else:
+        counts.append(1)
+      return counts[-1]
+
+    self.assertEqual(-5, PlanOccupancyShard.correct("plan1", count_members))
+    self.assertEqual(1, PlanOccupancyShard.get_count("plan1"))
+    self.assertEqual([0, 1], counts)
+
+    """ Counts the members, while somebody else always changes the counter. """
+    def count_busy():
+      db.run_in_transaction(PlanOccupancyShard.adjust, "plan1", 1)
+      return 0
+
+    self.assertEqual(None, PlanOccupancyShard.correct("plan1", count_busy))
+    self.assertEqual(1 + PlanOccupancyShard.CORRECT_ATTEMPTS,
+                     PlanOccupancyShard.get_count("plan1"))
+
   """ Tests that plan aliases work as expected. """
   def test_aliases(self):
     self.plan1.aliases = ["alias"]
@@ -168,6 +230,19 @@ class PlanTests(unittest.TestCase):
     plan1 = Plan.get_by_name("alias")
     self.assertEqual(self.plan1, plan1)
 
+  """ Tests that we can look up a bunch of plans at once. """
+  def test_get_many(self):
+    self.plan2.aliases = ["alias"]
+
+    found = Plan.get_many(["plan1", "alias", "badplan", "plan1"])
+    self.assertEqual([self.plan1, self.plan2, None, self.plan1], found)
+
+  """ Tests that we can find the legacy pair of a plan from either side. """
+  def test_get_legacy_pair(self):
+    self.assertEqual(self.plan1, self.plan4.get_legacy_pair())
+    self.assertEqual(self.plan4, self.plan1.get_legacy_pair())
+    self.assertEqual(None, self.plan2.get_legacy_pair())
+
   """ Tests that we can get all the plan ids as expected. """
   def test_get_all_plan_ids(self):
     ids = Plan.get_all_plan_ids()
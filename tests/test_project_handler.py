@@ -4,6 +4,7 @@
 import os
 import unittest
 
+from google.appengine.api import memcache
 from google.appengine.ext import testbed
 
 import webapp2
@@ -19,6 +20,7 @@ class ProjectHandlerTests(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_user_stub()
+    self.testbed.init_memcache_stub()
 
     self.handler = project_handler.ProjectHandler()
 
@@ -50,6 +52,37 @@ class ProjectHandlerTests(unittest.TestCase):
                                    value2="world")
     self.assertEqual(response.encode("ascii"), "hello world")
 
+  """ Tests that compiled templates get shared through memcache. """
+  def test_bytecode_cache(self):
+    cache = project_handler.TemplateBytecodeCache()
+    environment = project_handler.JINJA_ENVIRONMENT
+    source = open("test_template.html").read()
+
+    bucket = cache.get_bucket(environment, "test_template.html", None, source)
+    bucket.code = environment.compile(source, "test_template.html")
+    cache.set_bucket(bucket)
+    self.assertNotEqual(None,
+        memcache.get(project_handler.TemplateBytecodeCache._MEMCACHE_PREFIX + \
+                     bucket.key))
+
+    # Another instance should be able to get it.
+    other_cache = project_handler.TemplateBytecodeCache()
+    bucket = other_cache.get_bucket(environment, "test_template.html", None,
+                                    source)
+    self.assertNotEqual(None, bucket.code)
+
+  """ Tests that we keep track of how long the first render takes. """
+  def test_cold_render_times(self):
+    self.handler.render("test_template.html", value1="hello", value2="world")
+    self.assertIn("test_template.html", project_handler.cold_render_times)
+
+  """ Tests that warming up loads all the templates. """
+  def test_warm_templates(self):
+    load_times = project_handler.warm_templates()
+
+    self.assertIn("templates/base.html", load_times)
+    self.assertEqual(len(os.listdir("templates")), len(load_times))
+
   """ Tests that the admin_only decorator works. """
   def test_admin_only(self):
     """ A function that we can decorate with it for testing purposes. (The
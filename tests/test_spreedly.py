@@ -0,0 +1,125 @@
+""" Tests for the PinPayments XML parsing in spreedly.py. """
+
+
+# Has to go at the top so that we have all our externals.
+import appengine_config
+
+import StringIO
+import unittest
+
+from tests.fake_pinpayments import FakePinPayments
+import spreedly
+
+
+""" Tests that XMLReply parses replies properly. """
+class XMLReplyTest(unittest.TestCase):
+  # A reply for a single subscriber.
+  _SUBSCRIBER = """<?xml version="1.0" encoding="UTF-8"?>
+<subscriber>
+  <active type="boolean">true</active>
+  <feature-level>full</feature-level>
+  <grace-until type="datetime" nil="true"></grace-until>
+  <invoices type="array">
+    <invoice>
+      <price>$100.00</price>
+    </invoice>
+  </invoices>
+</subscriber>
+"""
+
+  """ Tests that a whole reply gets converted to nested dictionaries. """
+  def test_dict(self):
+    reply = spreedly.XMLReply(StringIO.StringIO(self._SUBSCRIBER))
+
+    self.assertEqual({"active": "true", "feature-level": "full",
+                      "grace-until": None,
+                      "invoices": {"invoice": {"price": "$100.00"}}},
+                     reply.dict)
+
+  """ Tests that we can go through a list one item at a time. """
+  def test_stream(self):
+    subscribers = ["<subscriber><customer-id>%d</customer-id></subscriber>" % \
+                   (i) for i in range(0, 100)]
+    payload = StringIO.StringIO("<subscribers>%s</subscribers>" % \
+                                ("\n".join(subscribers)))
+
+    reply = spreedly.XMLReply(payload, stream=True)
+    self.assertEqual(None, reply.dict)
+
+    customer_ids = []
+    for tag, subscriber in reply.iterchildren():
+      self.assertEqual("subscriber", tag)
+      customer_ids.append(int(subscriber["customer-id"]))
+
+    self.assertEqual(range(0, 100), customer_ids)
+    # We shouldn't be keeping the ones we already went through.
+    self.assertEqual(0, len(reply.root))
+
+
+""" Tests that the client talks to PinPayments properly. """
+class SpreedlyTest(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakePinPayments()
+    self.fake.add_subscriber(1, **{"feature-level": "hive"})
+    self.fake.add_subscriber(2)
+    self.fake.start()
+
+    self.api = spreedly.Spreedly("hackerdojotest", base_url=self.fake.base_url,
+                                 token="testapikey")
+
+    # Don't actually wait between retries.
+    self.old_backoff = spreedly.BACKOFF
+    spreedly.BACKOFF = 0
+
+  def tearDown(self):
+    spreedly.BACKOFF = self.old_backoff
+    self.fake.stop()
+
+  """ Tests that we can get a subscriber. """
+  def test_subscriber_details(self):
+    subscriber = self.api.subscriber_details(sub_id=1)
+    self.assertEqual("hive", subscriber["feature-level"])
+    self.assertEqual(1, len(self.fake.requests))
+
+  """ Tests that we can get all the subscribers. """
+  def test_subscribers(self):
+    subscribers = list(self.api.subscribers())
+    self.assertEqual(["1", "2"],
+                     [subscriber["customer-id"] for subscriber in subscribers])
+
+  """ Tests that failed requests get retried, up to a point. """
+  def test_retry(self):
+    self.fake.failures = spreedly.RETRIES
+    subscriber = self.api.subscriber_details(sub_id=2)
+    self.assertEqual("2", subscriber["customer-id"])
+    self.assertEqual(spreedly.RETRIES + 1, len(self.fake.requests))
+
+    self.fake.failures = spreedly.RETRIES + 1
+    with self.assertRaises(spreedly.SpreedlyResponseError) as error:
+      self.api.subscriber_details(sub_id=2)
+    self.assertEqual(503, error.exception.code)
+
+  """ Tests that requests that can't work aren't retried. """
+  def test_no_retry(self):
+    with self.assertRaises(spreedly.SpreedlyResponseError) as error:
+      self.api.subscriber_details(sub_id=3)
+    self.assertEqual(404, error.exception.code)
+    self.assertEqual(1, len(self.fake.requests))
+
+  """ Tests that we can create subscribers and give them credit. """
+  def test_create_and_credit(self):
+    subscriber = self.api.create_subscriber(3, "ttesterson@gmail.com")
+    self.assertEqual("3", subscriber["customer-id"])
+    self.assertEqual("ttesterson@gmail.com", subscriber["email"])
+
+    self.api.add_credit(3, 95)
+    self.assertEqual("95.0", self.fake.subscribers[3]["store-credit"])
+
+  """ Tests that POST requests are never retried, since they might have worked
+  even if we didn't hear back. """
+  def test_no_post_retry(self):
+    self.fake.failures = 1
+    with self.assertRaises(spreedly.SpreedlyResponseError) as error:
+      self.api.add_credit(2, 95)
+    self.assertEqual(503, error.exception.code)
+    self.assertEqual(1, len(self.fake.requests))
@@ -5,12 +5,15 @@
 import appengine_config
 
 import datetime
+import os
 import unittest
 
-from google.appengine.ext import testbed
+from google.appengine.ext import db, testbed
 
 from membership import Membership
+from tests.fake_pinpayments import FakePinPayments
 import plans
+import spreedly
 import subscriber_api
 
 
@@ -224,3 +227,84 @@ class UpdateTests(unittest.TestCase):
     subscriber_api.update_plan(member_info, self.test_member)
     self.assertEqual("suspended", self.test_member.status)
     self.assertEqual("normal", self.test_member.plan)
+
+
+""" Tests that we can get data for a lot of subscribers at once. """
+class FetchSubscriberDetailsTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_urlfetch_stub()
+
+    self.fake = FakePinPayments()
+    for subscriber_id in range(1, 11):
+      self.fake.add_subscriber(subscriber_id)
+    self.fake.start()
+
+    # Point the shared client at the fake server.
+    self.old_api = subscriber_api._api.copy()
+    subscriber_api._api["client"] = spreedly.Spreedly("hackerdojotest",
+        base_url=self.fake.base_url, token="testapikey")
+    subscriber_api._api["token"] = "testapikey"
+
+    # Don't actually wait between retries.
+    self.old_backoff = spreedly.BACKOFF
+    spreedly.BACKOFF = 0
+
+  def tearDown(self):
+    spreedly.BACKOFF = self.old_backoff
+    subscriber_api._api.update(self.old_api)
+    self.fake.stop()
+    self.testbed.deactivate()
+
+  """ Tests that we get everyone who exists. """
+  def test_fetch(self):
+    subscribers = subscriber_api.fetch_subscriber_details(range(1, 12))
+
+    self.assertEqual(range(1, 11), sorted(subscribers.keys()))
+    for subscriber_id, subscriber in subscribers.iteritems():
+      self.assertEqual(str(subscriber_id), subscriber["customer-id"])
+    # The one that doesn't exist shouldn't have been retried.
+    self.assertEqual(11, len(self.fake.requests))
+
+  """ Tests that requests that fail get retried. """
+  def test_retry(self):
+    self.fake.failures = 3
+    future = subscriber_api.fetch_subscriber_details_async(range(1, 11))
+    subscribers = future.get_result()
+
+    self.assertEqual(range(1, 11), sorted(subscribers.keys()))
+    self.assertEqual(13, len(self.fake.requests))
+
+
+""" Tests that status changes get queued correctly. """
+class QueueStatusChangeTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    # It needs queue.yaml to know about our queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that a change queued in a transaction only happens if the
+  transaction commits. """
+  def test_transactional(self):
+    """ Queues a change and then fails. """
+    def queue_and_fail():
+      subscriber_api.queue_status_change("testy.testerson", "suspended")
+      raise db.Rollback()
+
+    db.run_in_transaction(queue_and_fail)
+    tasks = self.taskqueue_stub.get_filtered_tasks(url="/tasks/status_change")
+    self.assertEqual(0, len(tasks))
+
+    db.run_in_transaction(subscriber_api.queue_status_change,
+                          "testy.testerson", "suspended")
+    subscriber_api.queue_status_change("testy.testerson", "active")
+    tasks = self.taskqueue_stub.get_filtered_tasks(url="/tasks/status_change")
+    self.assertEqual(2, len(tasks))
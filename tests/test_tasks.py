@@ -4,6 +4,7 @@
 # We need our external modules.
 import appengine_config
 
+import os
 import unittest
 
 from google.appengine.ext import testbed
@@ -11,7 +12,12 @@ from google.appengine.ext import db
 
 import webtest
 
+from gift_codes import UsedCode
 from membership import Membership
+from plans import PlanOccupancyShard
+from tests.fake_pinpayments import FakePinPayments
+import spreedly
+import subscriber_api
 import tasks
 
 
@@ -25,7 +31,10 @@ class BaseTest(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
-    self.testbed.init_taskqueue_stub()
+    # It needs queue.yaml to know about our queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
     self.testbed.init_mail_stub()
     self.testbed.init_memcache_stub()
 
@@ -157,3 +166,186 @@ class CleanupTaskTest(BaseTest):
     # No email should have gotten sent.
     messages = self.mail_stub.get_sent_messages(to=self.user.email)
     self.assertEqual(0, len(messages))
+
+
+""" Tests that StatusChangeTask works correctly. """
+class StatusChangeTaskTest(BaseTest):
+  """ Tests that it accepts valid statuses. """
+  def test_status_change(self):
+    for status in ("suspended", "active"):
+      response = self.test_app.post("/tasks/status_change",
+          {"username": "testy.testerson", "status": status})
+      self.assertEqual(200, response.status_int)
+
+  """ Tests that it doesn't make the task retry for a bad status. """
+  def test_bad_status(self):
+    response = self.test_app.post("/tasks/status_change",
+        {"username": "testy.testerson", "status": "bad"})
+    self.assertEqual(200, response.status_int)
+
+
+""" Tests that UpdateSubscribersTask works correctly. """
+class UpdateSubscribersTaskTest(BaseTest):
+  def setUp(self):
+    super(UpdateSubscribersTaskTest, self).setUp()
+    self.testbed.init_urlfetch_stub()
+
+    self.user.status = "suspended"
+    self.user.domain_user = True
+    self.user.put()
+    self.user_id = self.user.key().id()
+
+    self.fake = FakePinPayments()
+    self.fake.add_subscriber(self.user_id)
+    self.fake.start()
+
+    # Point the shared client at the fake server.
+    self.old_api = subscriber_api._api.copy()
+    subscriber_api._api["client"] = spreedly.Spreedly("hackerdojotest",
+        base_url=self.fake.base_url, token="testapikey")
+    subscriber_api._api["token"] = "testapikey"
+
+  def tearDown(self):
+    subscriber_api._api.update(self.old_api)
+    self.fake.stop()
+    super(UpdateSubscribersTaskTest, self).tearDown()
+
+  """ Tests that the other apps get told about status changes, and only once.
+  """
+  def test_status_change(self):
+    for i in range(0, 2):
+      response = self.test_app.post("/tasks/update_subscribers",
+                                    {"subscriber_ids": str(self.user_id)})
+      self.assertEqual(200, response.status_int)
+
+    self.assertEqual("active", Membership.get_by_id(self.user_id).status)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/status_change", queue_names=["status-notifications"])
+    self.assertEqual(1, len(tasks))
+    self.assertIn("status=active", tasks[0].payload)
+    self.assertIn("username=testy.testerson", tasks[0].payload)
+
+
+""" Tests that AfterDeployTask works correctly. """
+class AfterDeployTaskTest(BaseTest):
+  """ Tests that members from before we had occupancy counters get counted. """
+  def test_count_members(self):
+    # Simulate a member from before we had counters.
+    member = Membership(first_name="Old", last_name="Member",
+                        email="omember@gmail.com", plan="newfull",
+                        status="active")
+    db.put(member)
+    self.assertEqual(0, PlanOccupancyShard.get_count("newfull"))
+
+    response = self.test_app.post("/tasks/after_deploy", {"version": "4-1"})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(1, PlanOccupancyShard.get_count("newfull"))
+
+  """ Tests that it starts backfilling sort keys, but only once. """
+  def test_sort_keys(self):
+    for i in range(0, 2):
+      response = self.test_app.post("/tasks/after_deploy", {"version": "4-1"})
+      self.assertEqual(200, response.status_int)
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url="/tasks/backfill_sort_keys")
+    self.assertEqual(1, len(tasks))
+
+
+""" Tests that CreditGiftCodeTask works correctly. """
+class CreditGiftCodeTaskTest(BaseTest):
+  def setUp(self):
+    super(CreditGiftCodeTaskTest, self).setUp()
+    self.testbed.init_urlfetch_stub()
+
+    self.fake = FakePinPayments()
+    self.fake.start()
+
+    # Point the shared client at the fake server.
+    self.old_api = subscriber_api._api.copy()
+    subscriber_api._api["client"] = spreedly.Spreedly("hackerdojotest",
+        base_url=self.fake.base_url, token="testapikey")
+    subscriber_api._api["token"] = "testapikey"
+
+    # Don't actually wait between retries.
+    self.old_backoff = spreedly.BACKOFF
+    spreedly.BACKOFF = 0
+
+    self.user_id = self.user.key().id()
+    self.used_code = UsedCode(code="1337167801234567",
+                              email=self.user.email, extra="OK",
+                              member_id=self.user_id, credit_pending=True)
+    self.used_code.put()
+    self.params = {"used_code": str(self.used_code.key())}
+
+  def tearDown(self):
+    spreedly.BACKOFF = self.old_backoff
+    subscriber_api._api.update(self.old_api)
+    self.fake.stop()
+    super(CreditGiftCodeTaskTest, self).tearDown()
+
+  """ Tests that it creates the subscriber and gives them credit, and that
+  running it again doesn't give them more. """
+  def test_credit(self):
+    for i in range(0, 2):
+      response = self.test_app.post("/tasks/credit_gift_code", self.params)
+      self.assertEqual(200, response.status_int)
+
+    subscriber = self.fake.subscribers[self.user_id]
+    self.assertEqual(self.user.email, subscriber["email"])
+    self.assertEqual("95.0", subscriber["store-credit"])
+
+    used_code = UsedCode.get(self.used_code.key())
+    self.assertFalse(used_code.credit_pending)
+    self.assertNotEqual(None, used_code.completed)
+
+  """ Tests that it adds to the credit of subscribers that already exist. """
+  def test_existing_subscriber(self):
+    self.fake.add_subscriber(self.user_id, **{"store-credit": "5.0"})
+
+    response = self.test_app.post("/tasks/credit_gift_code", self.params)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("100.0",
+                     self.fake.subscribers[self.user_id]["store-credit"])
+
+  """ Pretends that an earlier try asked for the credit, but never heard back.
+  credit: How much credit the subscriber has now. """
+  def __interrupted_attempt(self, credit):
+    self.fake.add_subscriber(self.user_id, **{"store-credit": credit})
+    used_code = UsedCode.get(self.used_code.key())
+    used_code.credit_before = 0.0
+    used_code.credit_attempt = "earlierattempt"
+    used_code.put()
+
+  """ Tests that it fails so the queue retries, and that a retry doesn't give
+  them credit twice when the first try got further than we know. """
+  def test_retry(self):
+    self.fake.failures = spreedly.RETRIES + 1
+    response = self.test_app.post("/tasks/credit_gift_code", self.params,
+                                  expect_errors=True)
+    self.assertEqual(500, response.status_int)
+    self.assertTrue(UsedCode.get(self.used_code.key()).credit_pending)
+
+    self.__interrupted_attempt("95.0")
+
+    response = self.test_app.post("/tasks/credit_gift_code", self.params)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("95.0",
+                     self.fake.subscribers[self.user_id]["store-credit"])
+    used_code = UsedCode.get(self.used_code.key())
+    self.assertFalse(used_code.credit_pending)
+    self.assertNotEqual(None, used_code.completed)
+
+  """ Tests that a retry doesn't give them credit again when they spent some
+  of it before we could check. """
+  def test_retry_after_spending(self):
+    self.__interrupted_attempt("20.0")
+
+    response = self.test_app.post("/tasks/credit_gift_code", self.params)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("20.0",
+                     self.fake.subscribers[self.user_id]["store-credit"])
+    used_code = UsedCode.get(self.used_code.key())
+    self.assertFalse(used_code.credit_pending)
+    # We don't know that they got it.
+    self.assertEqual(None, used_code.completed)
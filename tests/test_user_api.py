@@ -5,12 +5,15 @@
 import appengine_config
 
 import cPickle as pickle
+import datetime
 import json
+import os
 import unittest
 import urllib
 
 import webtest
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 
@@ -18,6 +21,8 @@ from config import Config
 from keymaster import Keymaster
 from membership import Membership
 from plans import Plan
+import change_log
+import maglock
 import user_api
 
 
@@ -31,6 +36,10 @@ class ApiTest(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    # It needs queue.yaml to know about our queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
 
     # Create a new plan for testing.
     Plan.all_plans = []
@@ -137,6 +146,198 @@ class UserHandlerTest(ApiTest):
     self.assertEqual(self.user.created, got_created)
 
 
+""" Tests that UsersHandler works properly. """
+class UsersHandlerTest(ApiTest):
+  def setUp(self):
+    super(UsersHandlerTest, self).setUp()
+
+    self.other_user = Membership(first_name="Testy", last_name="Testerson",
+        email="ttesterson@gmail.com", plan="test", status="suspended")
+    self.other_user.put()
+
+  """ Tests that we can get a lot of users at once by email and ID. """
+  def test_batch(self):
+    query = urllib.urlencode({"email[]": ["djpetti@gmail.com",
+                                          "daniel.petti@hackerdojo.com",
+                                          "nobody@gmail.com"],
+                              "id": [self.other_user.key().id(), 12345],
+                              "properties[]": ["first_name", "status"]}, True)
+    response = self.test_app.get("/api/v1/users?" + query)
+    self.assertEqual(200, response.status_int)
+    result = json.loads(response.body)
+
+    expected = {"first_name": "Daniel", "status": "active"}
+    self.assertEqual(expected, result["emails"]["djpetti@gmail.com"])
+    self.assertEqual(expected,
+                     result["emails"]["daniel.petti@hackerdojo.com"])
+    self.assertEqual(None, result["emails"]["nobody@gmail.com"])
+
+    other_id = str(self.other_user.key().id())
+    self.assertEqual({"first_name": "Testy", "status": "suspended"},
+                     result["ids"][other_id])
+    self.assertEqual(None, result["ids"]["12345"])
+
+  """ Tests that datetimes are sent in a readable format. """
+  def test_datetimes(self):
+    query = urllib.urlencode({"email": "djpetti@gmail.com",
+                              "properties": "created"})
+    response = self.test_app.get("/api/v1/users?" + query)
+    result = json.loads(response.body)["emails"]["djpetti@gmail.com"]
+    self.assertEqual(self.user.created.isoformat(), result["created"])
+
+    response = self.test_app.get("/api/v1/users?" + query + "&datetimes=epoch")
+    result = json.loads(response.body)["emails"]["djpetti@gmail.com"]
+    got_created = datetime.datetime.utcfromtimestamp(result["created"])
+    self.assertLess(abs(self.user.created - got_created),
+                    datetime.timedelta(milliseconds=1))
+
+  """ Tests that we don't send the same data twice. """
+  def test_etag(self):
+    query = urllib.urlencode({"email": "djpetti@gmail.com",
+                              "properties": "status"})
+    response = self.test_app.get("/api/v1/users?" + query)
+    etag = response.headers["ETag"]
+
+    response = self.test_app.get("/api/v1/users?" + query,
+                                 headers={"If-None-Match": etag})
+    self.assertEqual(304, response.status_int)
+    self.assertEqual("", response.body)
+
+    # If something changes, we should get new data.
+    self.user.status = "suspended"
+    self.user.put()
+    response = self.test_app.get("/api/v1/users?" + query,
+                                 headers={"If-None-Match": etag})
+    self.assertEqual(200, response.status_int)
+    self.assertNotEqual(etag, response.headers["ETag"])
+
+  """ Tests that bad requests fail. """
+  def test_bad_requests(self):
+    queries = [{"properties": "status"},
+               {"email": "djpetti@gmail.com", "properties": "notaproperty"},
+               {"id": "notanid", "properties": "status"},
+               {"email": "djpetti@gmail.com", "properties": "created",
+                "datetimes": "pickle"}]
+    for query in queries:
+      response = self.test_app.get("/api/v1/users?" + urllib.urlencode(query),
+                                   expect_errors=True)
+      self.assertIn(response.status_int, (400, 422))
+
+
+""" Tests that ChangesHandler works properly. """
+class ChangesHandlerTest(ApiTest):
+  """ Gets changes from the handler.
+  since: The version to get changes since.
+  limit: The most changes to get.
+  Returns: The decoded response, with each change converted to a dictionary. """
+  def __get_changes(self, since, limit=100):
+    # Changes don't get versions until the cron job runs.
+    change_log.assign_versions()
+
+    query = urllib.urlencode({"since": since, "limit": limit})
+    response = self.test_app.get("/api/v1/changes?" + query)
+    self.assertEqual(200, response.status_int)
+
+    result = json.loads(response.body)
+    result["changes"] = [dict(zip(result["fields"], change)) \
+                         for change in result["changes"]]
+    return result
+
+  """ Tests that only changes to the properties we track get logged. """
+  def test_changes(self):
+    result = self.__get_changes(0)
+    self.assertEqual(1, len(result["changes"]))
+    first = result["changes"][0]
+    self.assertEqual(self.user.key().id(), first["id"])
+    self.assertEqual("active", first["status"])
+    self.assertEqual("daniel.petti", first["username"])
+    self.assertFalse(result["more"])
+
+    # This shouldn't show up.
+    self.user.first_name = "Dan"
+    self.user.put()
+    self.user.status = "suspended"
+    self.user.put()
+
+    result = self.__get_changes(result["version"])
+    self.assertEqual(1, len(result["changes"]))
+    self.assertEqual("suspended", result["changes"][0]["status"])
+    self.assertEqual(first["version"] + 1, result["version"])
+
+    # If nothing changed, we shouldn't get anything.
+    result = self.__get_changes(result["version"])
+    self.assertEqual([], result["changes"])
+
+  """ Tests that changes come in batches. """
+  def test_limit(self):
+    for i in range(0, 3):
+      self.user.rfid_tag = str(i)
+      self.user.put()
+      change_log.assign_versions()
+    self.user.delete()
+
+    result = self.__get_changes(0, limit=3)
+    self.assertEqual(3, len(result["changes"]))
+    self.assertTrue(result["more"])
+    self.assertEqual([1, 2, 3],
+                     [change["version"] for change in result["changes"]])
+
+    result = self.__get_changes(result["version"], limit=3)
+    self.assertEqual(2, len(result["changes"]))
+    self.assertFalse(result["more"])
+    self.assertEqual("2", result["changes"][0]["rfid_tag"])
+    self.assertTrue(result["changes"][1]["deleted"])
+
+  """ Tests that a member who changes more than once before the cron job runs
+  only gets their newest values logged. """
+  def test_collapsed(self):
+    result = self.__get_changes(0)
+
+    self.user.status = "suspended"
+    self.user.put()
+    self.user.rfid_tag = "42"
+    self.user.put()
+
+    result = self.__get_changes(result["version"])
+    self.assertEqual(1, len(result["changes"]))
+    self.assertEqual("suspended", result["changes"][0]["status"])
+    self.assertEqual("42", result["changes"][0]["rfid_tag"])
+
+  """ Tests that a change that got logged, but whose token never got cleared,
+  doesn't get logged again. """
+  def test_idempotent(self):
+    self.user.status = "suspended"
+    self.user.put()
+    token = self.user.change_token
+    change_log.assign_versions()
+    version = change_log.ChangeLogRoot.all().get().version
+
+    # Pretend that clearing the token failed.
+    user = Membership.get_by_id(self.user.key().id())
+    user.change_token = token
+    db.Model.put(user)
+
+    self.assertEqual(1, change_log.assign_versions())
+    self.assertEqual(version, change_log.ChangeLogRoot.all().get().version)
+    user = Membership.get_by_id(self.user.key().id())
+    self.assertEqual(None, user.change_token)
+
+  """ Tests that asking for changes we've thrown away fails. """
+  def test_pruned(self):
+    change_log.assign_versions()
+    change_log.MemberChange.all().get().delete()
+    root = change_log.ChangeLogRoot.all().get()
+    root.pruned_version = 1
+    root.put()
+
+    response = self.test_app.get("/api/v1/changes?since=0",
+                                 expect_errors=True)
+    self.assertEqual(410, response.status_int)
+
+    response = self.test_app.get("/api/v1/changes?since=1")
+    self.assertEqual(200, response.status_int)
+
+
 """ Tests that the signin handler works properly. """
 class SigninHandlerTest(ApiTest):
   def setUp(self):
@@ -208,6 +409,14 @@ class SigninHandlerTest(ApiTest):
     self.assertEqual(Config().LITE_VISITS, user.signins)
     self.assertEqual("no_visits", user.status)
 
+    # It should have queued the suspension instead of doing it inline.
+    taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskqueue_stub.get_filtered_tasks(url="/tasks/status_change",
+        queue_names=["status-notifications"])
+    self.assertEqual(1, len(tasks))
+    self.assertIn("username=daniel.petti", tasks[0].payload)
+    self.assertIn("status=suspended", tasks[0].payload)
+
   """ Tests that it doesn't count new signins that occur on the same day. """
   def test_one_signin_per_day(self):
     params = {"email": "djpetti@gmail.com"}
@@ -225,6 +434,96 @@ class SigninHandlerTest(ApiTest):
     self.assertEqual(Config().LITE_VISITS - 1, result["visits_remaining"])
 
 
+""" Tests that the batch signin handler works properly. """
+class BatchSigninHandlerTest(ApiTest):
+  def setUp(self):
+    super(BatchSigninHandlerTest, self).setUp()
+
+    self.user.signins = 0
+    self.user.rfid_tag = "1337"
+    self.user.put()
+
+    self.user2 = Membership(first_name="Testy", last_name="Testerson",
+        email="ttesterson@gmail.com", plan="test", username="testy.testerson",
+        status="active")
+    self.user2.put()
+
+  """ Posts a list of signins.
+  signins: The list of signins to send.
+  Returns: The response. """
+  def _post_signins(self, signins, **kwargs):
+    return self.test_app.post("/api/v1/signin/batch",
+                              json.dumps({"signins": signins}), **kwargs)
+
+  """ Tests that we can sign in a bunch of people at once. """
+  def test_batch_signin(self):
+    # Two days apart, so they both count.
+    response = self._post_signins([
+        {"email": "djpetti@gmail.com", "timestamp": 1444748400},
+        {"id": "1337", "timestamp": 1444921200},
+        {"email": "testy.testerson@hackerdojo.com"},
+        {"email": "bad_email@gmail.com"}])
+    self.assertEqual(200, response.status_int)
+
+    results = json.loads(response.body)["results"]
+    self.assertEqual(4, len(results))
+    self.assertEqual(Config().LITE_VISITS - 1, results[0]["visits_remaining"])
+    self.assertEqual(Config().LITE_VISITS - 2, results[1]["visits_remaining"])
+    self.assertEqual(Config().LITE_VISITS - 1, results[2]["visits_remaining"])
+    self.assertIn("Could not find", results[3]["error"])
+
+    user = Membership.get_by_email("djpetti@gmail.com")
+    self.assertEqual(2, user.signins)
+    user = Membership.get_by_email("ttesterson@gmail.com")
+    self.assertEqual(1, user.signins)
+
+  """ Tests that signins on the same day only count once. """
+  def test_same_day(self):
+    response = self._post_signins([
+        {"email": "djpetti@gmail.com", "timestamp": 1444748400},
+        {"id": "1337", "timestamp": 1444752000}])
+    self.assertEqual(200, response.status_int)
+
+    user = Membership.get_by_email("djpetti@gmail.com")
+    self.assertEqual(1, user.signins)
+
+  """ Tests that it suspends users who run out of visits. """
+  def test_user_suspending(self):
+    self.user.signins = Config().LITE_VISITS - 1
+    self.user.put()
+
+    response = self._post_signins([{"id": "1337"}])
+    results = json.loads(response.body)["results"]
+    self.assertEqual(0, results[0]["visits_remaining"])
+
+    user = Membership.get_by_email("djpetti@gmail.com")
+    self.assertEqual("no_visits", user.status)
+
+  """ Tests that it rejects malformed requests. """
+  def test_bad_request(self):
+    response = self.test_app.post("/api/v1/signin/batch", "notjson",
+                                  expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
+    # A bad item should only fail that item.
+    response = self._post_signins([{"timestamp": "bad", "id": "1337"},
+                                   {}])
+    results = json.loads(response.body)["results"]
+    self.assertIn("timestamp", results[0]["error"])
+    self.assertIn("email or id", results[1]["error"])
+
+    # So should an email or id that isn't a string.
+    response = self._post_signins([{"email": 1337}, {"id": ["1337"]},
+                                   {"email": None},
+                                   {"email": "djpetti@gmail.com"}])
+    self.assertEqual(200, response.status_int)
+    results = json.loads(response.body)["results"]
+    self.assertIn("must be strings", results[0]["error"])
+    self.assertIn("must be strings", results[1]["error"])
+    self.assertIn("email or id", results[2]["error"])
+    self.assertEqual(Config().LITE_VISITS - 1, results[3]["visits_remaining"])
+
+
 """ Tests that the RFID handler works properly. """
 class RfidHandlerTest(ApiTest):
   def setUp(self):
@@ -307,6 +606,7 @@ class MaglockHandlerTest(ApiTest):
     # Set rfid tag.
     self.user.rfid_tag = "1337"
     self.user.put()
+    change_log.assign_versions()
 
     # Add the keymaster key we need.
     Keymaster.encrypt("maglock:key", "notasecret")
@@ -332,6 +632,7 @@ class MaglockHandlerTest(ApiTest):
     # No RFID tag.
     self.user.rfid_tag = None
     self.user.put()
+    change_log.assign_versions()
 
     response = self.test_app.get("/api/v1/maglock/notasecret")
     self.assertEqual(200, response.status_int)
@@ -341,7 +642,145 @@ class MaglockHandlerTest(ApiTest):
     self.user.rfid_tag = "1337"
     self.user.status = "suspended"
     self.user.put()
+    change_log.assign_versions()
 
     response = self.test_app.get("/api/v1/maglock/notasecret")
     self.assertEqual(200, response.status_int)
     self.assertEqual([], json.loads(response.body))
+
+  """ Tests that it gives us a 304 if the list hasn't changed. """
+  def test_etag(self):
+    response = self.test_app.get("/api/v1/maglock/notasecret")
+    etag = response.headers["ETag"]
+
+    response = self.test_app.get("/api/v1/maglock/notasecret",
+                                 headers={"If-None-Match": etag})
+    self.assertEqual(304, response.status_int)
+
+    # Changing the list should change the ETag.
+    self.user.rfid_tag = "42"
+    self.user.put()
+    change_log.assign_versions()
+
+    response = self.test_app.get("/api/v1/maglock/notasecret",
+                                 headers={"If-None-Match": etag})
+    self.assertEqual(200, response.status_int)
+    self.assertNotEqual(etag, response.headers["ETag"])
+    self.assertEqual([{"username": "daniel.petti", "rfid_tag": "42"}],
+                     json.loads(response.body))
+
+  """ Tests that an older list never replaces a newer one in memcache, and that
+  changes are worked out from the datastore, not the cached copy. """
+  def test_stale_cache(self):
+    old_snapshot = maglock.get_snapshot()
+
+    self.user.rfid_tag = "42"
+    self.user.put()
+    change_log.assign_versions()
+    new_snapshot = maglock.get_snapshot()
+    self.assertGreater(new_snapshot["version"], old_snapshot["version"])
+
+    # A slow update finishing late shouldn't put the old list back.
+    maglock._cache(old_snapshot)
+    self.assertEqual(new_snapshot, maglock.get_snapshot())
+
+    # Even if the cache is wrong, changes should still get made.
+    memcache.set(maglock._MEMCACHE_KEY, old_snapshot)
+    self.user.rfid_tag = "1337"
+    self.user.put()
+    change_log.assign_versions()
+    memcache.delete(maglock._MEMCACHE_KEY)
+    self.assertEqual([["1337", "daniel.petti"]],
+                     maglock.get_snapshot()["entries"].values())
+
+  """ Tests that a member write that gets rolled back doesn't change the list.
+  """
+  def test_rollback(self):
+    maglock.get_snapshot()
+
+    """ Changes the tag, and then fails. """
+    def change_and_fail():
+      user = Membership.get(self.user.key())
+      user.rfid_tag = "42"
+      user.put()
+      raise db.Rollback()
+
+    db.run_in_transaction(change_and_fail)
+    change_log.assign_versions()
+    self.assertEqual([["1337", "daniel.petti"]],
+                     maglock.get_snapshot()["entries"].values())
+
+  """ Tests that rebuilding the list doesn't undo changes that haven't been
+  applied yet, and removes people who shouldn't be there. """
+  def test_rebuild(self):
+    maglock.get_snapshot()
+    user2 = Membership(first_name="Testy", last_name="Testerson",
+        email="ttesterson@gmail.com", plan="test", username="testy.testerson",
+        status="active", rfid_tag="9000")
+    user2.put()
+    change_log.assign_versions()
+
+    self.user.rfid_tag = "42"
+    self.user.put()
+    user2.delete()
+    snapshot = maglock.rebuild()
+    self.assertEqual([["1337", "daniel.petti"]], snapshot["entries"].values())
+
+    change_log.assign_versions()
+    self.assertEqual([["42", "daniel.petti"]],
+                     maglock.get_snapshot()["entries"].values())
+
+  """ Tests that we can get just the changes since a particular version. """
+  def test_delta(self):
+    response = self.test_app.get("/api/v1/maglock/notasecret?since=0")
+    result = json.loads(response.body)
+    version = result["version"]
+    self.assertEqual([{"username": "daniel.petti", "rfid_tag": "1337"}],
+                     result["added"])
+
+    # If we ask for a version that doesn't exist, we should get everything.
+    response = self.test_app.get("/api/v1/maglock/notasecret?since=%d" % \
+                                 (version + 10))
+    result = json.loads(response.body)
+    self.assertTrue(result["full"])
+    self.assertEqual([{"username": "daniel.petti", "rfid_tag": "1337"}],
+                     result["added"])
+
+    # Nothing has changed.
+    response = self.test_app.get("/api/v1/maglock/notasecret?since=%d" % \
+                                 (version))
+    result = json.loads(response.body)
+    self.assertFalse(result["full"])
+    self.assertEqual([], result["added"])
+    self.assertEqual([], result["removed"])
+
+    # Change the tag, and add someone new.
+    self.user.rfid_tag = "42"
+    self.user.put()
+    change_log.assign_versions()
+    user2 = Membership(first_name="Testy", last_name="Testerson",
+        email="ttesterson@gmail.com", plan="test", username="testy.testerson",
+        status="active", rfid_tag="9000")
+    user2.put()
+    change_log.assign_versions()
+
+    response = self.test_app.get("/api/v1/maglock/notasecret?since=%d" % \
+                                 (version))
+    result = json.loads(response.body)
+    self.assertFalse(result["full"])
+    self.assertEqual([{"username": "daniel.petti", "rfid_tag": "42"},
+                      {"username": "testy.testerson", "rfid_tag": "9000"}],
+                     result["added"])
+    self.assertEqual(["1337"], result["removed"])
+    version = result["version"]
+
+    # Suspend someone.
+    user2.status = "suspended"
+    user2.put()
+    change_log.assign_versions()
+
+    response = self.test_app.get("/api/v1/maglock/notasecret?since=%d" % \
+                                 (version))
+    result = json.loads(response.body)
+    self.assertEqual([], result["added"])
+    self.assertEqual(["9000"], result["removed"])
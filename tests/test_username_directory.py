@@ -0,0 +1,132 @@
+""" Tests for username_directory.py. """
+
+
+# We need our external modules.
+import appengine_config
+
+import datetime
+import unittest
+
+from google.appengine.ext import testbed
+
+from username_directory import UsernameDirectory
+import username_directory
+
+
+""" Tests that UsernameDirectory finds free usernames properly. """
+class UsernameDirectoryTest(unittest.TestCase):
+  """ Tests that it knows which usernames are taken. """
+  def test_contains(self):
+    directory = UsernameDirectory(["Testy.Testerson", "ttesterson"])
+
+    self.assertIn("testy.testerson", directory)
+    self.assertIn("TTesterson", directory)
+    self.assertNotIn("ttesterson1", directory)
+    self.assertEqual(2, len(directory))
+
+  """ Tests that it picks the next number after the largest one. """
+  def test_next_free(self):
+    directory = UsernameDirectory(["ttesterson", "ttesterson1", "ttesterson5"])
+
+    self.assertEqual("someoneelse", directory.next_free("someoneelse"))
+    self.assertEqual("ttesterson6", directory.next_free("ttesterson"))
+
+    directory.add("ttesterson6")
+    self.assertEqual("ttesterson7", directory.next_free("TTesterson"))
+
+  """ Tests that it still works when the base ends in a number. """
+  def test_next_free_number_base(self):
+    directory = UsernameDirectory(["tester2", "tester21", "tester22"])
+
+    self.assertEqual("tester23", directory.next_free("tester2"))
+
+
+""" Tests that the directory gets cached and synced properly. """
+class SyncTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+    self.old_chunk_size = username_directory._CHUNK_SIZE
+    self.old_fetch = username_directory._fetch
+
+    # Pretend to be the domain app.
+    self.domain_users = ["testy.testerson"]
+    self.since = []
+    def fetch(since=None):
+      self.since.append(since)
+      return self.domain_users
+    username_directory._fetch = fetch
+
+  def tearDown(self):
+    username_directory._CHUNK_SIZE = self.old_chunk_size
+    username_directory._fetch = self.old_fetch
+    self.testbed.deactivate()
+
+  """ Tests that a big directory gets split up and put back together. """
+  def test_chunks(self):
+    username_directory._CHUNK_SIZE = 100
+    self.domain_users = ["user%d" % (i) for i in range(0, 100)]
+
+    username_directory.get()
+    # Make sure we're not just getting this instance's copy.
+    username_directory._local["version"] = None
+
+    directory = username_directory.get()
+    self.assertEqual(100, len(directory))
+    self.assertEqual("user100", directory.next_free("user"))
+    self.assertEqual([None], self.since)
+
+  """ Tests that syncing only asks for new users, and that users we create show
+  up right away. """
+  def test_delta_sync(self):
+    directory = username_directory.get()
+    self.assertIn("testy.testerson", directory)
+    self.assertNotIn("ttesterson", directory)
+
+    username_directory.add("ttesterson")
+    self.assertIn("ttesterson", username_directory.get())
+
+    self.domain_users = ["new.user"]
+    directory = username_directory.sync()
+    self.assertIn("testy.testerson", directory)
+    self.assertIn("ttesterson", directory)
+    self.assertIn("new.user", directory)
+
+    self.assertEqual(2, len(self.since))
+    self.assertEqual(None, self.since[0])
+    self.assertTrue(isinstance(self.since[1], datetime.datetime))
+
+  """ Tests that a full sync drops users that are gone. """
+  def test_full_sync(self):
+    username_directory.get()
+
+    self.domain_users = ["new.user"]
+    directory = username_directory.sync(full=True)
+    self.assertIn("new.user", directory)
+    self.assertNotIn("testy.testerson", directory)
+
+  """ Tests that two threads changing the directory at once don't lose each
+  other's changes. """
+  def test_concurrent_add(self):
+    username_directory.get()
+
+    """ Adds a user, while somebody else adds one the first time around. """
+    def add_during(latest, raced):
+      if not raced:
+        username_directory.add("other.user")
+      directory = username_directory.UsernameDirectory(latest.usernames(),
+                                                       latest.synced)
+      directory.add("ttesterson")
+      return directory
+
+    username_directory._update(add_during)
+    # Make sure we're not just getting this instance's copy.
+    username_directory._local["version"] = None
+
+    directory = username_directory.get()
+    self.assertIn("testy.testerson", directory)
+    self.assertIn("other.user", directory)
+    self.assertIn("ttesterson", directory)
+    self.assertEqual([None], self.since)
@@ -2,11 +2,13 @@
 """
 
 
+import calendar
 import cPickle as pickle
 import datetime
 import hashlib
 import json
 import logging
+import time
 
 from google.appengine.ext import db
 
@@ -16,7 +18,9 @@ import pytz
 
 from config import Config
 from membership import Membership
+import change_log
 import keymaster
+import maglock
 import plans
 import subscriber_api
 
@@ -24,32 +28,37 @@ import subscriber_api
 """ Increments the number of signins for a user. Also suspends the user if they
 are out of visits.
 user: The user to increment signins for.
+when: When the signin happened, as a naive UTC datetime. Defaults to now.
+save: Whether to write the user and suspend them if needed. If this is False,
+the caller is responsible for doing both.
 Returns: The number of visits remaining for a user. """
-def _increment_signins(user):
+def _increment_signins(user, when=None, save=True):
+  if not when:
+    when = datetime.datetime.now()
+
   # Time-dependent checks don't play well with unit tests...
   if not Config().is_testing:
     # The weekends and after-hours don't count.
     timezone = pytz.timezone("America/Los_Angeles")
-    now = datetime.datetime.now(timezone)
-    day = now.weekday()
+    local_time = pytz.utc.localize(when).astimezone(timezone)
+    day = local_time.weekday()
     if day in (5, 6):
       logging.info("Not incrementing singin counter because it is a weekend.")
       return plans.Plan.signins_remaining(user)
-    hour = now.hour
+    hour = local_time.hour
     logging.debug("Hour: %d" % (hour))
     if (hour < Config().COUNT_VISITS[0] or hour >= Config().COUNT_VISITS[1]):
       logging.info("Not incrementing signin counter because it is after-hours.")
       return plans.Plan.signins_remaining(user)
 
   # Don't increment it if they already signed in today.
-  if (user.last_signin and \
-      datetime.datetime.now().day == user.last_signin.day):
+  if (user.last_signin and when.day == user.last_signin.day):
     logging.info("This is not their first signin today.")
     return plans.Plan.signins_remaining(user)
 
   # Increment signins.
   user.signins += 1
-  user.last_signin = datetime.datetime.now()
+  user.last_signin = when
 
   remaining = plans.Plan.signins_remaining(user)
   logging.info("Visits remaining for %s: %s" % \
@@ -58,9 +67,14 @@ def _increment_signins(user):
   if remaining == 0:
     # No more visits left. Suspend the user.
     user.status = "no_visits"
-    subscriber_api.suspend(user.username)
 
-  user.put()
+  if save:
+    user.put()
+    if remaining == 0:
+      # Don't make the person at the door wait for the other apps. We only do
+      # this once the status is saved, so that the apps can't get told about a
+      # suspension that never happened.
+      subscriber_api.queue_status_change(user.username, "suspended")
   return remaining
 
 
@@ -196,6 +210,173 @@ class UserHandler(ApiHandlerBase):
     self.response.out.write(response)
 
 
+""" Handler for getting data for a lot of users at once. """
+class UsersHandler(ApiHandlerBase):
+  # The most users we'll look up in one request.
+  _MAX_USERS = 500
+
+  """ Properties for this request:
+  email: A list of emails of users we are getting data for.
+  id: A list of IDs of users we are getting data for. There has to be at least
+  one email or ID in total.
+  properties: A list of property names we want for each user. Only these get
+  sent.
+  datetimes: How to send datetimes. This is either 'iso' (the default) for ISO
+  8601 strings, or 'epoch' for seconds since the epoch. Either way, they're in
+  UTC.
+  Returns: A json object with an 'emails' object mapping each email to a
+  dictionary of each property and its value for that user, and an 'ids' object
+  that does the same for IDs. Users that we couldn't find are null. The ETag
+  header is a hash of the response, so an If-None-Match header can be used to
+  avoid getting the same data twice. """
+  @ApiHandlerBase.restricted
+  def get(self):
+    emails = self.__get_list("email")
+    ids = self.__get_list("id")
+    properties = self._get_parameters("properties")
+    if not properties:
+      return
+    if type(properties) is unicode:
+      # A singleton property.
+      properties = [properties]
+
+    if not (emails or ids):
+      self._rest_error("InvalidParameters", "Expected an email or id.", 400)
+      return
+    if len(emails) + len(ids) > self._MAX_USERS:
+      self._rest_error("InvalidParameters",
+                       "Can't get more than %d users at once." % \
+                       (self._MAX_USERS), 400)
+      return
+    try:
+      ids = [int(member_id) for member_id in ids]
+    except ValueError:
+      self._rest_error("InvalidParameters", "IDs must be integers.", 400)
+      return
+
+    datetimes = self.request.get("datetimes", "iso")
+    if datetimes not in ("iso", "epoch"):
+      self._rest_error("InvalidParameters",
+                       "'datetimes' must be 'iso' or 'epoch'.", 400)
+      return
+
+    all_properties = Membership.properties()
+    for prop in properties:
+      if prop not in all_properties:
+        self._rest_error("InvalidParameters", "User has no property '%s'." % \
+                         (prop), 422)
+        return
+
+    # Find everyone at once.
+    by_email = Membership.get_by_emails(emails)
+    by_id = dict(zip(ids, Membership.get_by_id(ids)))
+
+    response = {"emails": {}, "ids": {}}
+    for email in emails:
+      response["emails"][email] = self.__serialize(by_email.get(email),
+                                                   properties, datetimes)
+    for member_id in ids:
+      response["ids"][str(member_id)] = self.__serialize(by_id[member_id],
+                                                         properties, datetimes)
+    response = json.dumps(response, sort_keys=True)
+
+    etag = hashlib.md5(response).hexdigest()
+    self.response.headers["ETag"] = '"%s"' % (etag)
+    if etag in self.request.if_none_match:
+      # It already has this data.
+      self.response.set_status(304)
+      return
+
+    self.response.out.write(response)
+
+  """ Gets a parameter that can be specified more than once.
+  name: The name of the parameter.
+  Returns: A list of the values, which can be empty. """
+  def __get_list(self, name):
+    values = self.request.get_all(name) + self.request.get_all(name + "[]")
+    return [value for value in values if value]
+
+  """ Gets some properties of a user, in a form that can be sent as json.
+  member: The user.
+  properties: The names of the properties to get.
+  datetimes: How to send datetimes, either 'iso' or 'epoch'.
+  Returns: A dictionary mapping each property to its value, or None if there is
+  no user. """
+  def __serialize(self, member, properties, datetimes):
+    if not member:
+      return None
+
+    values = {}
+    for prop in properties:
+      value = getattr(member, prop)
+      if type(value) == datetime.datetime:
+        if datetimes == "epoch":
+          value = calendar.timegm(value.utctimetuple()) + \
+                  value.microsecond / 1000000.0
+        else:
+          value = value.isoformat()
+
+      values[prop] = value
+
+    return values
+
+
+""" Handler for getting changes to members. """
+class ChangesHandler(ApiHandlerBase):
+  # How many changes we send by default.
+  _DEFAULT_LIMIT = 100
+  # The most changes we'll send at once.
+  _MAX_LIMIT = 1000
+
+  """ Properties for this request:
+  since: The version that the caller already has. Defaults to 0, which gets
+  everything we still have.
+  limit: The most changes to send.
+  Response: A json object with the 'fields' of each change, and a list of
+  'changes', each of which is a list of the values of those fields, in order of
+  version. 'version' is the version that the caller has after applying them,
+  and 'more' is set if there are more changes after that. If we don't remember
+  that far back, it fails with a 410, and the caller has to get everything again
+  some other way. """
+  @ApiHandlerBase.restricted
+  def get(self):
+    try:
+      since = int(self.request.get("since", 0))
+      limit = int(self.request.get("limit", self._DEFAULT_LIMIT))
+    except ValueError:
+      self._rest_error("InvalidParameters",
+                       "'since' and 'limit' must be integers.", 400)
+      return
+    if (limit < 1 or limit > self._MAX_LIMIT):
+      self._rest_error("InvalidParameters",
+                       "'limit' must be between 1 and %d." % \
+                       (self._MAX_LIMIT), 400)
+      return
+
+    # Get one extra, so we know whether there are more.
+    changes = change_log.changes_since(since, limit + 1)
+    if changes == None:
+      self._rest_error("ExpiredVersion",
+                       "Changes since version %d are gone." % (since), 410)
+      return
+
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    fields = ("version", "id") + change_log.TRACKED_PROPERTIES + ("deleted",)
+    rows = []
+    for change in changes:
+      rows.append([change.version, change.member_id] + \
+                  [getattr(change, prop) \
+                   for prop in change_log.TRACKED_PROPERTIES] + \
+                  [change.deleted])
+
+    version = changes[-1].version if changes else since
+    response = {"version": version, "more": more, "fields": fields,
+                "changes": rows}
+    self.response.out.write(json.dumps(response, separators=(",", ":")))
+
+
 """ Handles user signin events. """
 class SigninHandler(ApiHandlerBase):
   """ Called when a particular user signs in using their email.
@@ -223,6 +404,130 @@ class SigninHandler(ApiHandlerBase):
     response = json.dumps({"visits_remaining": remaining})
     self.response.out.write(response)
 
+""" Handles a lot of signins at once. The signin kiosk uses this to replay
+signins that it buffered while it couldn't reach us. """
+class BatchSigninHandler(ApiHandlerBase):
+  # The most signins we'll accept in one request.
+  _MAX_SIGNINS = 500
+  # The most values we can give to an IN filter in one query.
+  _MAX_IN_VALUES = 30
+
+  """ Signs in a list of people by email or RFID tag.
+  The request body is a json object with a 'signins' list. Each element is an
+  object with either an 'email' or an 'id' (RFID tag) string, and optionally a
+  'timestamp' key, which is the time of the signin in seconds since the epoch.
+  Response: A json object with a 'results' list, in the same order as the
+  signins. Each element has a 'visits_remaining' key, which means the same thing
+  as for SigninHandler.post, or an 'error' key if that signin failed. """
+  @ApiHandlerBase.restricted
+  def post(self):
+    try:
+      signins = json.loads(self.request.body)["signins"]
+    except (ValueError, KeyError, TypeError):
+      self._rest_error("InvalidParameters",
+                       "Expected a json object with a 'signins' list.", 400)
+      return
+    if (type(signins) is not list or len(signins) > self._MAX_SIGNINS):
+      self._rest_error("InvalidParameters",
+                       "'signins' must be a list of at most %d items." % \
+                       (self._MAX_SIGNINS), 400)
+      return
+
+    results = [None] * len(signins)
+    # Figure out who we need to look up.
+    emails = set()
+    tags = set()
+    to_process = []
+    for i, signin in enumerate(signins):
+      if type(signin) is not dict:
+        results[i] = {"error": "Expected an object."}
+        continue
+
+      try:
+        when = datetime.datetime.utcfromtimestamp(
+            float(signin.get("timestamp", time.time())))
+      except (ValueError, TypeError):
+        results[i] = {"error": "Invalid timestamp."}
+        continue
+
+      email = signin.get("email")
+      rfid = signin.get("id")
+      if ((email and not isinstance(email, basestring)) or
+          (rfid and not isinstance(rfid, basestring))):
+        results[i] = {"error": "The email and id must be strings."}
+        continue
+      if email:
+        emails.add(email)
+      elif rfid:
+        tags.add(rfid)
+      else:
+        results[i] = {"error": "Expected an email or id."}
+        continue
+
+      to_process.append((when, i, email, rfid))
+
+    # Find everyone at once. The same member can turn up by both email and tag,
+    # so we keep one copy of each member, and count all their signins on it.
+    members = {}
+    by_email = Membership.get_by_emails(emails)
+    by_tag = self.__fetch_by_tag(tags)
+    for found in (by_email, by_tag):
+      for value, member in found.items():
+        found[value] = members.setdefault(member.key(), member)
+
+    # Process signins in the order they happened, so they get counted the same
+    # way they would have been originally.
+    to_process.sort()
+    changed = {}
+    suspended = []
+    for when, i, email, rfid in to_process:
+      if email:
+        member = by_email.get(email)
+      else:
+        member = by_tag.get(rfid)
+
+      if (not member or member.status not in ("active", "no_visits")):
+        results[i] = {"error": "Could not find an active user."}
+        continue
+
+      old_status = member.status
+      old_signins = member.signins
+      remaining = _increment_signins(member, when=when, save=False)
+      results[i] = {"visits_remaining": remaining,
+                    "username": member.username, "email": member.email}
+
+      if member.signins != old_signins:
+        changed[member.key()] = member
+      if (member.status == "no_visits" and old_status != "no_visits"):
+        suspended.append(member.username)
+
+    if changed:
+      Membership.put_multi(changed.values())
+    for username in suspended:
+      subscriber_api.queue_status_change(username, "suspended")
+
+    self.response.out.write(json.dumps({"results": results}))
+
+  """ Looks up a lot of members by RFID tag at once. Tags don't have lookup
+  entities, so this has to use queries.
+  tags: The tags that we want.
+  Returns: A dictionary mapping tags to Membership objects. """
+  def __fetch_by_tag(self, tags):
+    tags = list(tags)
+    found = {}
+    for i in range(0, len(tags), self._MAX_IN_VALUES):
+      chunk = tags[i:i + self._MAX_IN_VALUES]
+      query = Membership.all().filter("rfid_tag IN", chunk)
+      for member in query.run(batch_size=len(chunk)):
+        value = member.rfid_tag
+        # Prefer members who can actually sign in if there are duplicates.
+        if (value not in found or \
+            member.status in ("active", "no_visits")):
+          found[value] = member
+
+    return found
+
+
 """ Handles RFID tag events. """
 class RfidHandler(ApiHandlerBase):
   """ Signs in people using their RFID tag.
@@ -264,8 +569,15 @@ class RfidHandler(ApiHandlerBase):
 class MaglockHandler(ApiHandlerBase):
   """ Handler for getting a list of people who can unlock maglocks.
   key: The key for the maglock that authenticates this request.
+  since: Optional parameter with the version of the list that the maglock
+  already has.
   Response: A json object containing a list of users. Each element contains a
-  username and a corresponding RFID key. """
+  username and a corresponding RFID key. If since was specified, it is instead
+  an object with the current version, and lists of the tags that were added and
+  removed since that version. If we can't figure out what changed, 'full' is
+  set, and everything is in the added list. The ETag header contains the version
+  of the list, so an If-None-Match header can be used to avoid getting the same
+  list twice. """
   def get(self, key):
     logging.debug("Getting list of users for maglock.")
 
@@ -275,19 +587,44 @@ class MaglockHandler(ApiHandlerBase):
       return
 
     # Our key is valid. Give it the list.
-    query = db.GqlQuery("SELECT * FROM Membership WHERE rfid_tag != NULL" \
-                        " AND status IN ('active', 'no_visits')")
+    snapshot = maglock.get_snapshot()
+
+    etag = "acl-%d" % (snapshot["version"])
+    self.response.headers["ETag"] = '"%s"' % (etag)
+    if etag in self.request.if_none_match:
+      # It already has the current list.
+      self.response.set_status(304)
+      return
+
+    since = self.request.get("since")
+    if not since:
+      self.response.out.write(json.dumps(maglock.full_list(snapshot)))
+      return
+
+    try:
+      since = int(since)
+    except ValueError:
+      self._rest_error("InvalidParameters", "'since' must be an integer.", 400)
+      return
 
-    response = []
-    for member in query.run():
-      response.append({"rfid_tag": member.rfid_tag,
-                       "username": member.username})
+    response = {"version": snapshot["version"], "full": False}
+    changes = maglock.changes_since(snapshot, since)
+    if changes:
+      response["added"], response["removed"] = changes
+    else:
+      # We don't know what changed, so just send everything.
+      response["full"] = True
+      response["added"] = maglock.full_list(snapshot)
+      response["removed"] = []
     self.response.out.write(json.dumps(response))
 
 
 app = webapp2.WSGIApplication([
     ("/api/v1/user", UserHandler),
+    ("/api/v1/users", UsersHandler),
+    ("/api/v1/changes", ChangesHandler),
     ("/api/v1/signin", SigninHandler),
+    ("/api/v1/signin/batch", BatchSigninHandler),
     ("/api/v1/rfid", RfidHandler),
     ("/api/v1/maglock/(.+)", MaglockHandler)],
     debug=True)
@@ -0,0 +1,251 @@
+""" Keeps track of which usernames are taken on the domain app, so that we can
+suggest free ones without asking it every time. The directory lives in
+memcache, and we keep it up to date by adding the users we create ourselves and
+periodically asking the domain app for anyone created since the last sync. """
+
+
+import cPickle as pickle
+import datetime
+import json
+import logging
+import re
+import urllib
+import uuid
+
+from google.appengine.api import memcache, urlfetch
+
+from config import Config
+
+
+# The memcache key for the directory header.
+_HEADER_KEY = "usernames"
+# Memcache values can't be bigger than 1 MB, so we split the directory up into
+# chunks that are a bit smaller than that.
+_CHUNK_SIZE = 900000
+# How long the directory stays in memcache.
+_CACHE_TIME = 60 * 60 * 24
+# How many times we try to update the directory when other threads keep
+# changing it under us.
+_CAS_RETRIES = 5
+# How far back we go before the last sync when asking for new users, in case
+# our clock and the domain app's disagree.
+_SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+# Splits a username into a base and a numeric suffix.
+_SUFFIX_RE = re.compile(r"^(.*?)(\d+)$")
+
+# The last version of the directory that this instance loaded.
+_local = {"version": None, "directory": None}
+
+
+""" A set of usernames, with an index of the largest numeric suffix used with
+each base username. """
+class UsernameDirectory(object):
+  """ usernames: The usernames to start with.
+  synced: When we last got new usernames from the domain app. """
+  def __init__(self, usernames=(), synced=None):
+    self.synced = synced
+    self.__names = set()
+    self.__suffixes = {}
+    for username in usernames:
+      self.add(username)
+
+  def __contains__(self, username):
+    return username.lower() in self.__names
+
+  def __len__(self):
+    return len(self.__names)
+
+  """ Adds a username to the directory.
+  username: The username to add. """
+  def add(self, username):
+    username = username.lower()
+    self.__names.add(username)
+
+    match = _SUFFIX_RE.match(username)
+    if match:
+      base, suffix = match.group(1), int(match.group(2))
+      if suffix > self.__suffixes.get(base, 0):
+        self.__suffixes[base] = suffix
+
+  """ Finds a free username that starts with base. If base itself isn't taken,
+  we use that. Otherwise, we add a number to the end.
+  base: The username that we want.
+  Returns: A username that isn't in the directory. """
+  def next_free(self, base):
+    base = base.lower()
+    if base not in self.__names:
+      return base
+
+    suffix = self.__suffixes.get(base, 0) + 1
+    username = "%s%d" % (base, suffix)
+    # This can only happen if base itself ends in a number.
+    while username in self.__names:
+      suffix += 1
+      username = "%s%d" % (base, suffix)
+    return username
+
+  """ Returns: The usernames in the directory. """
+  def usernames(self):
+    return list(self.__names)
+
+
+""" Saves a directory to memcache, unless somebody else changed it since we
+loaded it.
+directory: The directory to save.
+client: The memcache client that loaded the header with gets().
+header: The header that we loaded, or None if there wasn't one.
+Returns: True if it was saved, False if somebody else got there first or
+memcache failed. """
+def _save(directory, client, header):
+  data = pickle.dumps((directory.usernames(), directory.synced),
+                      pickle.HIGHEST_PROTOCOL)
+  version = uuid.uuid4().hex
+
+  # Each version gets its own chunks, so a reader can never get a mix of chunks
+  # from two versions. Old ones just expire.
+  chunks = {}
+  for i in range(0, len(data), _CHUNK_SIZE):
+    chunks["%s.%s.%d" % (_HEADER_KEY, version, i / _CHUNK_SIZE)] = \
+        data[i:i + _CHUNK_SIZE]
+  if memcache.set_multi(chunks, time=_CACHE_TIME):
+    logging.error("Memcache set failed.")
+    return False
+
+  new_header = {"version": version, "chunks": len(chunks)}
+  if header == None:
+    saved = client.add(_HEADER_KEY, new_header, time=_CACHE_TIME)
+  else:
+    saved = client.cas(_HEADER_KEY, new_header, time=_CACHE_TIME)
+  if not saved:
+    logging.info("Username directory changed while we were updating it.")
+    return False
+
+  _local["version"] = version
+  _local["directory"] = directory
+  return True
+
+
+""" Loads the directory from memcache.
+header: The directory header from memcache, or None if there isn't one.
+Returns: The directory, or None if it isn't there. """
+def _load(header):
+  if not header:
+    return None
+  if header["version"] == _local["version"]:
+    # We already have this one.
+    return _local["directory"]
+
+  keys = ["%s.%s.%d" % (_HEADER_KEY, header["version"], i) \
+          for i in range(0, header["chunks"])]
+  chunks = memcache.get_multi(keys)
+  if len(chunks) != len(keys):
+    logging.warning("Lost part of the username directory.")
+    return None
+
+  usernames, synced = pickle.loads("".join([chunks[key] for key in keys]))
+  directory = UsernameDirectory(usernames, synced)
+  _local["version"] = header["version"]
+  _local["directory"] = directory
+  return directory
+
+
+""" Changes the directory in memcache. If somebody else changes it at the same
+time, we start over from their version, so that neither change gets lost.
+change: A function that takes the current directory, or None if there isn't
+one, and whether somebody else already beat us to it, and returns the new
+directory, or None to leave memcache alone. It must not modify the directory
+that it is given, because other threads could be using it.
+Returns: The new directory, or None if we didn't save one. """
+def _update(change):
+  client = memcache.Client()
+  for i in range(0, _CAS_RETRIES):
+    header = client.gets(_HEADER_KEY)
+    directory = change(_load(header), i > 0)
+    if directory == None:
+      return None
+    if _save(directory, client, header):
+      return directory
+
+  logging.error("Giving up on updating the username directory.")
+  return None
+
+
+""" Gets usernames from the domain app.
+since: If specified, only get users created after this datetime.
+Returns: A list of usernames, or None upon failure. """
+def _fetch(since=None):
+  url = "http://%s/users" % (Config().DOMAIN_HOST)
+  if since:
+    url += "?" + urllib.urlencode({"since": since.isoformat()})
+
+  response = urlfetch.fetch(url, deadline=10, follow_redirects=False)
+  if response.status_code != 200:
+    logging.critical("Failed to fetch list of users. (%d)" % \
+                     (response.status_code))
+    return None
+  return json.loads(response.content)
+
+
+""" Updates the directory with users from the domain app.
+full: If True, get everyone instead of just the users created since we last
+synced. This also drops anyone who was deleted, unless somebody else changes
+the directory while we are doing it.
+Returns: The updated directory, or None upon failure. """
+def sync(full=False):
+  started = datetime.datetime.now()
+
+  cached = None
+  if not full:
+    cached = _load(memcache.get(_HEADER_KEY))
+  incremental = (cached != None and cached.synced)
+  if not incremental:
+    logging.info("Fetching all domain users.")
+    usernames = _fetch()
+  else:
+    usernames = _fetch(since=cached.synced - _SYNC_OVERLAP)
+  if usernames == None:
+    return None
+  logging.info("Got %d domain user(s)." % (len(usernames)))
+
+  """ Adds the users that we got to the directory. """
+  def merge(latest, raced):
+    if (latest != None and (incremental or raced)):
+      # Somebody could have added users since we fetched, so keep theirs.
+      usernames_before = latest.usernames()
+    elif incremental:
+      # It went away, so we don't have anything to add these to.
+      logging.warning("Username directory expired during sync.")
+      return None
+    else:
+      usernames_before = []
+
+    directory = UsernameDirectory(usernames_before + usernames)
+    directory.synced = started
+    return directory
+
+  return _update(merge)
+
+
+""" Gets the directory, fetching it from the domain app if it isn't cached.
+Returns: The directory, or None upon failure. """
+def get():
+  directory = _load(memcache.get(_HEADER_KEY))
+  if directory != None:
+    return directory
+  return sync(full=True)
+
+
+""" Adds a username that we just created to the directory.
+username: The username to add. """
+def add(username):
+  """ Adds the username to a copy of the directory. """
+  def add_to(latest, raced):
+    if latest == None:
+      # We'll get it from the domain app next time anyway.
+      return None
+    directory = UsernameDirectory(latest.usernames(), latest.synced)
+    directory.add(username)
+    return directory
+
+  _update(add_to)